@@ -0,0 +1,442 @@
+#!/usr/bin/python
+
+"""
+Checksum manifests of the deliverables, used by make_deliverable.py.
+
+The files of a deliverable are hashed by a pool of threads (hashlib
+releases the GIL on large buffers), reading every file once for all
+the requested algorithms. The manifests are in the format of md5sum
+and sha256sum, so that the recipients can check them with e.g.
+
+    $ md5sum -c checksums.md5
+
+The digests are cached in a small SQLite database, keyed by the device,
+the inode, the size and the modification time of the file, so that a
+file that did not change (or a hardlink to a file that was already
+hashed) is never read again.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import io
+import os
+import re
+import sys
+import time
+import hashlib
+import sqlite3
+import argparse
+import textwrap
+
+
+__version__ = '0.1.0'
+
+# The supported algorithms, and the manifest of each one
+MANIFESTS = {'md5': 'checksums.md5', 'sha256': 'checksums.sha256'}
+
+# Files are read in blocks of this size
+BUFFER_SIZE = 8 << 20
+
+# The identity of a file's content, as far as the cache is concerned
+file_key = namedtuple('file_key', ['dev', 'inode', 'size', 'mtime'])
+
+# The outcome of the hashing of a tree
+hash_stats = namedtuple('hash_stats', ['files', 'hashed', 'bytes', 'secs'])
+
+
+class DigestCache(object):
+    """
+    A thin wrapper around an SQLite database, holding the digests of
+    the files already hashed.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS digests (
+                dev     INTEGER,
+                inode   INTEGER,
+                size    INTEGER,
+                mtime   INTEGER,
+                algo    TEXT,
+                digest  TEXT,
+                PRIMARY KEY (dev, inode, size, mtime, algo)
+            )""")
+        self.conn.commit()
+
+    def get(self, key, algo):
+        """
+        Return the cached digest of the file, or None.
+        """
+        row = self.conn.execute(
+            "SELECT digest FROM digests WHERE dev=? AND inode=? AND size=? "
+            "AND mtime=? AND algo=?", tuple(key) + (algo,)).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, key, algo, digest):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+            tuple(key) + (algo, digest))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def stat_key(st):
+    """
+    The cache key of a file, from its os.stat() result.
+    """
+    # The modification time in microseconds (the same on Python 2 and 3)
+    return file_key(st.st_dev, st.st_ino, st.st_size,
+                    int(round(st.st_mtime * 1e6)))
+
+
+def hash_file(path, algos):
+    """
+    Hash a file with all the given algorithms in a single read.
+
+    Returns: {algorithm: hex digest}
+    """
+
+    hashes = [(a, hashlib.new(a)) for a in algos]
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+
+    with io.open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+
+            for _, h in hashes:
+                h.update(view[:n])
+
+    return dict((a, h.hexdigest()) for a, h in hashes)
+
+
+def list_files(root, skip=()):
+    """
+    Return the (sorted) paths of all the files under root, relative to
+    it, leaving out the given names at the top level (e.g. manifests).
+    """
+
+    paths = []
+
+    for dirpath, dirs, files in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+
+        for f in files:
+            if rel == '.' and f in skip:
+                continue
+
+            paths.append(os.path.normpath(os.path.join(rel, f)))
+
+    return sorted(paths)
+
+
+def compute_digests(root, paths, algos, cache=None, workers=4):
+    """
+    Compute the digests of the files (relative to root), reusing the
+    cached ones when the files did not change.
+
+    Returns: ({path: {algorithm: hex digest}}, 'hash_stats')
+    """
+
+    start = time.time()
+    digests = {}
+    todo = []
+
+    for path in paths:
+        key = stat_key(os.stat(os.path.join(root, path)))
+        cached = {}
+
+        if cache is not None:
+            for a in algos:
+                d = cache.get(key, a)
+                if d is not None:
+                    cached[a] = d
+
+        if len(cached) == len(algos):
+            digests[path] = cached
+        else:
+            todo.append((path, key))
+
+    def job(item):
+        path, key = item
+        return path, key, hash_file(os.path.join(root, path), algos)
+
+    hashed_bytes = 0
+    pool = ThreadPool(max(1, workers))
+
+    try:
+        for path, key, result in pool.imap_unordered(job, todo):
+            digests[path] = result
+            hashed_bytes += key.size
+
+            if cache is not None:
+                for a, d in result.items():
+                    cache.put(key, a, d)
+    finally:
+        pool.close()
+        pool.join()
+
+    if cache is not None:
+        cache.commit()
+
+    return digests, hash_stats(len(paths), len(todo), hashed_bytes,
+                               time.time() - start)
+
+
+def escape_name(path):
+    """
+    The name of a file as md5sum writes it: names with a backslash or a
+    newline are escaped, and their line starts with a backslash.
+
+    Returns: (line prefix, name)
+    """
+
+    if '\\' in path or '\n' in path:
+        return '\\', path.replace('\\', '\\\\').replace('\n', '\\n')
+
+    return '', path
+
+
+def unescape_name(name):
+    return re.sub(r'\\(.)',
+                  lambda m: '\n' if m.group(1) == 'n' else m.group(1), name)
+
+
+def remove_manifests(root, algos):
+    """
+    Remove the manifests of the other algorithms from the root folder
+    (e.g. left by a previous build with more algorithms), which would
+    not match the files any more.
+
+    Returns: the list of the manifests removed
+    """
+
+    removed = []
+
+    for a in sorted(MANIFESTS):
+        manifest = os.path.join(root, MANIFESTS[a])
+
+        if a not in algos and os.path.isfile(manifest):
+            os.remove(manifest)
+            removed.append(manifest)
+
+    return removed
+
+
+def write_manifests(root, digests, algos):
+    """
+    Write a manifest (in the md5sum/sha256sum format) for every
+    algorithm in the root folder, and remove the ones of the other
+    algorithms.
+
+    Returns: the list of the manifests written
+    """
+
+    remove_manifests(root, algos)
+
+    written = []
+
+    for a in algos:
+        manifest = os.path.join(root, MANIFESTS[a])
+
+        with open(manifest, 'w') as f:
+            for path in sorted(digests):
+                prefix, name = escape_name(path.replace(os.sep, '/'))
+                f.write('{0}{1}  {2}\n'.format(prefix, digests[path][a], name))
+
+        written.append(manifest)
+
+    return written
+
+
+def read_manifest(manifest):
+    """
+    Read a manifest in the md5sum/sha256sum format.
+
+    Returns: a list of (path, hex digest)
+    """
+
+    entries = []
+
+    with open(manifest, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+
+            escaped = line.startswith('\\')
+            if escaped:
+                line = line[1:]
+
+            digest, name = line.split(' ', 1)
+
+            # ' name' (text mode) or '*name' (binary mode)
+            name = name[1:]
+            if escaped:
+                name = unescape_name(name)
+
+            entries.append((os.path.normpath(name), digest.lower()))
+
+    return entries
+
+
+def make_manifests(root, algos, cache_db=None, workers=4, skip=()):
+    """
+    Hash all the files of the deliverable at root and write its
+    manifests. The manifests (and the names in 'skip') are left out.
+
+    Returns: ('hash_stats', the manifests written)
+    """
+
+    skip = set(skip) | set(MANIFESTS.values())
+    paths = list_files(root, skip)
+
+    cache = DigestCache(cache_db) if cache_db else None
+
+    try:
+        digests, stats = compute_digests(root, paths, algos, cache, workers)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    return stats, write_manifests(root, digests, algos)
+
+
+def verify_tree(root, workers=4, skip=()):
+    """
+    Re-hash (without the cache) all the files listed in the manifests
+    found in root, and compare them with the manifests. Files of the
+    tree that are not in a manifest are reported too.
+
+    Returns: ('hash_stats', a list of problems as (path, message) tuples)
+    """
+
+    algos = [a for a in sorted(MANIFESTS)
+             if os.path.isfile(os.path.join(root, MANIFESTS[a]))]
+
+    if not algos:
+        return hash_stats(0, 0, 0, 0), [(root, 'no manifest found')]
+
+    expected = {}
+    for a in algos:
+        for path, digest in read_manifest(os.path.join(root, MANIFESTS[a])):
+            expected.setdefault(path, {})[a] = digest
+
+    problems = []
+    present = []
+
+    for path in sorted(expected):
+        if os.path.isfile(os.path.join(root, path)):
+            present.append(path)
+        else:
+            problems.append((path, 'missing'))
+
+    digests, stats = compute_digests(root, present, algos, None, workers)
+
+    for path in present:
+        for a, digest in expected[path].items():
+            if digests[path][a] != digest:
+                problems.append((path, '{0} mismatch'.format(a)))
+
+    listed = set(expected)
+    for path in list_files(root, set(skip) | set(MANIFESTS.values())):
+        if path not in listed:
+            problems.append((path, 'not in the manifest'))
+
+    return stats, problems
+
+
+def format_bytes(num_bytes):
+    """
+    Format the given number of bytes in a human readable way (e.g. 3.2G).
+    """
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if abs(num_bytes) < 1024 or unit == 'T':
+            return '{0:.1f}{1}'.format(num_bytes, unit)
+
+        num_bytes /= 1024
+
+
+def print_stats(stats):
+    print('Checksums: {0} files, {1} hashed ({2} in {3:.0f}s, {4}/s), '
+          '{5} from the cache'.format(
+            stats.files, stats.hashed, format_bytes(stats.bytes), stats.secs,
+            format_bytes(stats.bytes / max(stats.secs, 1e-3)),
+            stats.files - stats.hashed))
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Write (or verify) the checksum manifests of a deliverable."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'folder',
+            help='The deliverable folder.')
+
+    parser.add_argument(
+            '-a', '--algorithm', nargs='+', default=['md5'],
+            choices=sorted(MANIFESTS),
+            help='The checksum algorithm(s) (default: md5).')
+
+    parser.add_argument(
+            '-j', '--threads', type=int, default=4,
+            help='Number of files to hash at the same time (default: 4).')
+
+    parser.add_argument(
+            '--cache',
+            help='The digest cache database (default: no cache).')
+
+    parser.add_argument(
+            '--verify', action='store_true',
+            help='Check the files against the existing manifests instead.')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    if args.verify:
+        stats, problems = verify_tree(args.folder, args.threads)
+        print_stats(stats)
+
+        for path, message in problems:
+            print('  {0}: {1}'.format(path, message))
+
+        print('OK' if not problems else
+              '{0} problem(s) found'.format(len(problems)))
+        sys.exit(1 if problems else 0)
+
+    stats, manifests = make_manifests(args.folder, args.algorithm,
+                                      args.cache, args.threads)
+    print_stats(stats)
+    print('Written: ' + ', '.join(manifests))
+
+
+if __name__ == '__main__':
+    main()
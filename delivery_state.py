@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+"""
+The state index of a deliverable, used by make_deliverable.py to
+rebuild it incrementally.
+
+The index is a tab separated file inside the deliverable, with a line
+for every delivered file: its path in the deliverable, the file it was
+copied from, the size and modification time that file had, and its
+md5 digest. On a rebuild, the source files are compared (by their
+size and modification time) with the index, and only the new or
+changed ones are transferred; the files that disappeared upstream are
+removed from the deliverable.
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+from collections import OrderedDict
+
+import os
+
+import transfer
+
+
+# The index, in the deliverable's folder
+STATE_FILE = '.deliverable_state.tsv'
+
+# A delivered file ('dest' is relative to the deliverable's folder)
+state_entry = namedtuple('state_entry', [
+                        'dest', 'source', 'size', 'mtime', 'digest'
+                        ])
+
+# What a rebuild has to do:
+#   copy_units - the 'transfer.transfer_unit's to run
+#   files      - {unit: [(source file, dest path, size, mtime)]}, the
+#                files every unit delivers
+#   unchanged  - the 'state_entry's of the files already delivered
+#   removed    - the 'state_entry's of the files gone upstream
+update_plan = namedtuple('update_plan', [
+                        'copy_units', 'files', 'unchanged', 'removed'
+                        ])
+
+
+def file_mtime(st):
+    """
+    The modification time kept in the index (microseconds).
+    """
+    return int(round(st.st_mtime * 1e6))
+
+
+def read_state(state_file=STATE_FILE):
+    """
+    Read the index of a deliverable (empty if there is none yet).
+
+    Returns: an OrderedDict of 'state_entry's, by dest path
+    """
+
+    state = OrderedDict()
+
+    if not os.path.isfile(state_file):
+        return state
+
+    with open(state_file, 'r') as f:
+        next(f, None)
+
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != len(state_entry._fields):
+                continue
+
+            entry = state_entry(fields[0], fields[1], int(fields[2]),
+                                int(fields[3]), fields[4])
+            state[entry.dest] = entry
+
+    return state
+
+
+def write_state(entries, state_file=STATE_FILE):
+    """
+    Write the index (through a temporary file, so that an interrupted
+    run never leaves a truncated index behind).
+    """
+
+    tmp = state_file + '.tmp'
+
+    with open(tmp, 'w') as f:
+        f.write('\t'.join(state_entry._fields) + '\n')
+
+        for e in sorted(entries, key=lambda e: e.dest):
+            f.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(*e))
+
+    os.rename(tmp, state_file)
+
+
+def unit_files(unit):
+    """
+    List the files a unit delivers, as rsync would lay them out
+    ('source' into the 'dest' folder).
+
+    Returns: a list of (source file, dest path, size, mtime)
+    """
+
+    source = unit.source.rstrip('/')
+    target = os.path.join(unit.dest, os.path.basename(source))
+
+    if not os.path.isdir(source):
+        st = os.stat(source)
+        return [(source, os.path.normpath(target), st.st_size,
+                 file_mtime(st))]
+
+    files = []
+
+    for root, dirs, names in os.walk(source):
+        out_dir = os.path.join(target, os.path.relpath(root, source))
+
+        for name in names:
+            src = os.path.join(root, name)
+            st = os.stat(src)
+            files.append((src, os.path.normpath(os.path.join(out_dir, name)),
+                          st.st_size, file_mtime(st)))
+
+    return files
+
+
+def plan_update(units, state, root='.'):
+    """
+    Compare the files of the units with the index of the deliverable.
+
+    A file is unchanged if it comes from the same source, with the same
+    size and modification time, and it is still in the deliverable.
+    A unit whose files all changed (e.g. a new sample) is copied as a
+    whole, otherwise only its changed files are, one unit each.
+
+    Returns: an 'update_plan'
+    """
+
+    copy_units = []
+    files = OrderedDict()
+    unchanged = []
+    seen = set()
+
+    for unit in units:
+        changed = []
+        kept = 0
+
+        for src, dest, size, mtime in unit_files(unit):
+            seen.add(dest)
+            old = state.get(dest)
+
+            if old is not None and old.source == src and old.size == size \
+                    and old.mtime == mtime \
+                    and os.path.isfile(os.path.join(root, dest)):
+                unchanged.append(old)
+                kept += 1
+            else:
+                changed.append((src, dest, size, mtime))
+
+        if not changed:
+            continue
+
+        if not kept:
+            files[unit] = changed
+            copy_units.append(unit)
+            continue
+
+        for src, dest, size, mtime in changed:
+            file_unit = transfer.transfer_unit(unit.project, src,
+                                               os.path.dirname(dest) or '.')
+            files[file_unit] = [(src, dest, size, mtime)]
+            copy_units.append(file_unit)
+
+    removed = [e for d, e in state.items() if d not in seen]
+
+    return update_plan(copy_units, files, unchanged, removed)
+
+
+def prune(removed, root='.'):
+    """
+    Delete the files that are gone upstream from the deliverable, and
+    the folders they leave empty.
+
+    Returns: the number of files deleted
+    """
+
+    deleted = 0
+
+    for entry in removed:
+        path = os.path.join(root, entry.dest)
+
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
+            deleted += 1
+
+        # Remove the empty parent folders, up to the deliverable's root
+        parent = os.path.dirname(entry.dest)
+        while parent:
+            try:
+                os.rmdir(os.path.join(root, parent))
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    return deleted
@@ -4,13 +4,24 @@ import os
 import sys
 import argparse
 import textwrap
-import subprocess
+
+import transfer
+import checksums
+import delivery_state
 
 
 # TODO: Moved out of its initial folder, so some stuf (e.g. paths) may not work
 
 __version__ = '1.0'
 
+# The algorithms of every --checksums choice
+CHECKSUMS = {'md5': ['md5'], 'sha256': ['sha256'],
+             'both': ['md5', 'sha256'], 'none': []}
+
+# The digests of the delivered files, shared by all the deliverables
+# (relative to the deliverable's folder)
+CHECKSUM_CACHE = '../checksum_cache.db'
+
 
 def eval_projects(projects):
     try:
@@ -33,7 +44,7 @@ def make_deliverable(args):
         print("'{0}' directory does not exist. Exiting...".format(target_dir))
         exit(1)
 
-    if not eval_projects(args.project):
+    if args.project and not eval_projects(args.project):
         print("Error! Make sure the projects are \
                 part of a bigger biological project.")
         print("Use --help for more information.")
@@ -42,12 +53,20 @@ def make_deliverable(args):
     if args.output is None:
         args.output = '_'.join(args.project[0].split('_')[2:7])
 
-    # Create the deliverable directory for the project, and move to it
+    if args.verify:
+        verify_deliverable(args.output, args.streams)
+        return
+
+    # Create the deliverable directory for the project, and move to it.
+    # An existing one is only accepted when resuming a failed transfer,
+    # or when rebuilding it incrementally
     try:
         os.mkdir(args.output)
     except OSError as e:
-        print(e)
-        exit(1)
+        if not ((args.resume or args.incremental)
+                and os.path.isdir(args.output)):
+            print(e)
+            exit(1)
     finally:
         os.chdir(args.output)
 
@@ -56,28 +75,164 @@ def make_deliverable(args):
     # Create 'fastq_files' directory if fastq argument was set
     if args.fastq:
         args.fastq = 'fastq_files'
-        os.mkdir(args.fastq)
+        if not os.path.isdir(args.fastq):
+            os.mkdir(args.fastq)
 
-    # Get a dictionary of listed (sample) directories in each project
-    #sample_dirs = {}
+    # Get the (sample) directories to copy from each project
     projects_dir = '../../projects/'
+    units = transfer_units(projects_dir, args.project, args.fastq)
+
+    # Keep only what changed since the last build
+    if args.incremental:
+        plan = delivery_state.plan_update(
+                    units, delivery_state.read_state())
+        pruned = delivery_state.prune(plan.removed)
+
+        print('Incremental: {0} new/changed file(s) in {1} unit(s), {2} '
+              'unchanged, {3} removed upstream'.format(
+                sum(len(f) for f in plan.files.values()),
+                len(plan.copy_units), len(plan.unchanged), pruned))
+
+        units = plan.copy_units
+
+        for unit in units:
+            if not os.path.isdir(unit.dest):
+                os.makedirs(unit.dest)
+
+    # Link the files instead of copying them, if asked (and possible)
+    copier = transfer.rsync_copy
+    if args.link:
+        copier = transfer.LinkCopier()
+
+        if os.stat(projects_dir).st_dev != os.stat('.').st_dev:
+            print("The projects and the deliverable are not on the same "
+                  "filesystem; the files will be copied instead.")
+
+    # Copy them, a few at a time
+    results = transfer.run_transfers(units, args.streams, args.retries,
+                                     copier)
+
+    if args.link:
+        # Keep how every file got in the deliverable
+        copier.write_manifest('link_manifest.tsv')
+
+        strategies = [rec[1] for rec in copier.records]
+        print('Files: ' + ', '.join('{0} {1}'.format(
+                strategies.count(s), s) for s in sorted(set(strategies))))
+
+    if args.incremental:
+        update_state(plan, results)
+
+    if not transfer.print_summary(results):
+        print("Some of the data could not be copied. Run the same "
+              "command again with --resume to continue.")
+        exit(1)
+
+    # Write the checksum manifests of the delivered files
+    if args.checksums != 'none':
+        algos = CHECKSUMS[args.checksums]
+        stats, manifests = checksums.make_manifests(
+                                '.', algos, CHECKSUM_CACHE, args.streams,
+                                skip=[delivery_state.STATE_FILE])
+
+        checksums.print_stats(stats)
+        print('Manifests: ' + ', '.join(os.path.basename(m)
+                                         for m in manifests))
+    else:
+        # The ones of a previous build would not match the files any more
+        for manifest in checksums.remove_manifests('.', []):
+            print('Removed: ' + os.path.basename(manifest))
+
+
+def update_state(plan, results):
+    """
+    Write the state index of the deliverable: the unchanged files, and
+    the files of the units that were copied successfully (their digest
+    comes from the checksum cache, or they are hashed now). The files
+    of the failed units, and the copies that do not have the size of
+    their source, are left out, so that the next run copies them.
+    """
+
+    copied = []
+    for r in results:
+        if not r.ok:
+            continue
+
+        for src, dest, size, mtime in plan.files[r.unit]:
+            if os.path.isfile(dest) and os.path.getsize(dest) == size:
+                copied.append((src, dest, size, mtime))
+            else:
+                print('Not indexed (the copy does not match its source): '
+                      '{0}'.format(dest))
+
+    cache = checksums.DigestCache(CHECKSUM_CACHE)
+    try:
+        digests, _ = checksums.compute_digests(
+                        '.', [dest for _, dest, _, _ in copied], ['md5'],
+                        cache)
+    finally:
+        cache.close()
+
+    entries = list(plan.unchanged)
+    for src, dest, size, mtime in copied:
+        entries.append(delivery_state.state_entry(
+                        dest, src, size, mtime, digests[dest]['md5']))
 
-    cmd = 'rsync -r --progress {0} {1}'
+    delivery_state.write_state(entries)
 
-    for project in args.project:
-        # Form the dir to get the data from
-        source_dir = os.path.join(projects_dir, project + '/', 'counts/')
-        # print(source_dir)
 
-        p = subprocess.Popen(cmd.format(source_dir + '*', '.'),
-                            shell=True).wait()
+def verify_deliverable(deliverable, threads):
+    """
+    Re-hash the files of an existing deliverable, in parallel, and
+    compare them with its checksum manifests.
+    """
+
+    if not os.path.isdir(deliverable):
+        print("'{0}' does not exist. Exiting...".format(deliverable))
+        exit(1)
+
+    stats, problems = checksums.verify_tree(
+                        deliverable, threads, skip=[delivery_state.STATE_FILE])
+    checksums.print_stats(stats)
+
+    for path, message in problems:
+        print('  {0}: {1}'.format(path, message))
+
+    if problems:
+        print('{0} problem(s) found in {1}'.format(len(problems),
+                                                  deliverable))
+        exit(1)
+
+    print('{0}: OK'.format(deliverable))
+
+
+def transfer_units(projects_dir, projects, fastq_dir=None):
+    """
+    Split the deliverable into units that can be copied independently:
+    the count folder of every sample (into the deliverable's root) and,
+    if 'fastq_dir' is given, every entry of the project's fastqs folder.
+
+    Returns: a list of 'transfer.transfer_unit's
+    """
+
+    units = []
+
+    for project in projects:
+        # Form the dirs to get the data from
+        sources = [(os.path.join(projects_dir, project, 'counts'), '.')]
 
         # Copy the fastq files if the fastq argument was set
-        if args.fastq:
-            source_dir = os.path.join(projects_dir, project + '/', 'fastqs/')
+        if fastq_dir:
+            sources.append((os.path.join(projects_dir, project, 'fastqs'),
+                            fastq_dir))
+
+        for source_dir, dest in sources:
+            for entry in sorted(os.listdir(source_dir)):
+                units.append(transfer.transfer_unit(
+                                project, os.path.join(source_dir, entry),
+                                dest))
 
-            p = subprocess.Popen(cmd.format(source_dir + '*', args.fastq),
-                                shell=True).wait()
+    return units
 
 def main():
     # Move the working directory to the local root folder
@@ -107,7 +262,7 @@ def main():
             help='If set, it will also include the fastqs in the deliverable.')
 
     parser.add_argument(
-            '-p', '--project', nargs='*', required=True,
+            '-p', '--project', nargs='*',
             help='Names of the projects you want to include in the deliverable.\
             You can give multiple projects by simply separete them with space.\
             Note that the projects should be part of a bigger biological project.\
@@ -117,9 +272,48 @@ def main():
             '-o', '--output',
             help='(Optional) The name of the deliverable to be created.')
 
+    parser.add_argument(
+            '-j', '--streams', type=int, default=4,
+            help='Number of samples to copy at the same time (default: 4).')
+
+    parser.add_argument(
+            '--retries', type=int, default=2,
+            help='How many times to retry a failed copy (default: 2).')
+
+    parser.add_argument(
+            '-l', '--link', action='store_true',
+            help='Reflink (or hardlink) the files instead of copying them, \
+            when the projects and the deliverables are on the same \
+            filesystem. The strategy used for every file is written in \
+            link_manifest.tsv.')
+
+    parser.add_argument(
+            '-r', '--resume', action='store_true',
+            help='Resume an interrupted deliverable (i.e. the output \
+            folder may already exist). Partially copied files are resumed.')
+
+    parser.add_argument(
+            '-i', '--incremental', action='store_true',
+            help='Rebuild an existing deliverable: copy only the new or \
+            changed files, and remove the ones gone from the projects \
+            (tracked in the deliverable\'s .deliverable_state.tsv).')
+
+    parser.add_argument(
+            '-c', '--checksums', default='md5', choices=sorted(CHECKSUMS),
+            help='Write md5sum/sha256sum manifests of the delivered files \
+            (default: md5). Digests of unchanged files are reused.')
+
+    parser.add_argument(
+            '--verify', action='store_true',
+            help='Check an existing deliverable (-o, or the one of the \
+            given projects) against its checksum manifests, and exit.')
+
     # Parse the given arguments
     args = parser.parse_args()
 
+    if not args.project and not (args.verify and args.output):
+        parser.error('the -p/--project argument is required')
+
     # Call the function make_deliverable() to create the desired output
     make_deliverable(args)
 
@@ -9,6 +9,8 @@
 #SBATCH -n
 ?ram_memory
 #SBATCH -C
+?sbatch_mem
+#SBATCH --mem=
 ?use_qos_short
 #SBATCH --qos=
 ?time_request
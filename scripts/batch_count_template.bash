@@ -0,0 +1,98 @@
+#!/bin/bash -l
+
+# Define the variables for the sbatch job
+?uppmax_project_name
+#SBATCH -A
+?partition
+#SBATCH -p
+?num_cores
+#SBATCH -n
+?ram_memory
+#SBATCH -C
+?sbatch_mem
+#SBATCH --mem=
+?sbatch_tmp
+#SBATCH --tmp=
+?use_qos_short
+#SBATCH --qos=
+?time_request
+#SBATCH -t
+?job_description
+#SBATCH -J
+?sbatch_output
+#SBATCH --output=
+
+# # =================== STUFF BEFORE RUNNING ==================== #
+# #  -- Always change directory to the project's root dir         #
+# # where the script is located. This helps the orientation       #
+# # of the script relative to the project.                        #
+#                                                                 #
+# # Get which file was called on the bash command                 #
+# # e.g.   symlink --or-- original                                #
+# SOURCE="${BASH_SOURCE[0]}"                                      #
+#                                                                 #
+# # resolve $SOURCE until the file is no longer a symlink         #
+# while [ -h "$SOURCE" ];                                         #
+# do                                                              #
+#   DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"              #
+#   SOURCE="$(readlink "$SOURCE")"                                #
+#                                                                 #
+#   # if $SOURCE was a relative symlink, we need to resolve it    #
+#   # relative to the path where the symlink file was located     #
+#   [[ $SOURCE != /* ]] && SOURCE="$DIR/$SOURCE"                  #
+# done                                                            #
+#                                                                 #
+# # Form the directory and move there                             #
+# DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"                #
+# cd $DIR                                                         #
+                                                                #
+# Print and keep the start time to calculate the run time       #
+START_TIME=`date +%s`                                           #
+echo $(date)                                                    #
+# ============================================================= #
+
+
+# -- Run the count scripts of every project sharing this node --
+# Every member is a count script in the folder of its project (relative
+# to the batch folder), with the samples of that project to run here.
+?member_scripts
+members=""
+
+# The local disk folder of the reference the members share (if staged)
+?reference_dir
+REF_LOCAL=""
+
+# Let the members know they share the node (and the staged reference)
+export SHARED_COUNT_NODE=1
+
+pids=""
+for member in $members
+do
+  echo "Starting $member"
+  ( cd "$(dirname "$member")" && bash "$(basename "$member")" ) &
+  pids="$pids $!"
+done
+
+echo "Waiting the count scripts to finish: $members"
+failed=0
+for pid in $pids
+do
+  wait $pid || failed=1
+done
+
+if [[ -n $REF_LOCAL ]]; then
+  rm -rf "$REF_LOCAL/cellranger_ref_${SLURM_JOB_ID}${SLURM_STEP_ID:+_$SLURM_STEP_ID}"
+fi
+
+
+# ========================== STUFF AFTER RUNNING ============================= #
+# Calculate and print the run and the end time                                 #
+END_TIME=`date +%s`                                                            #
+RUN_TIME=$((END_TIME - START_TIME))                                            #
+                                                                               #
+echo $(date)                                                                   #
+printf 'Script was running for: '                                              #
+printf '%d-%02d:%02d:%02d\n' $(($RUN_TIME/86400)) $(($RUN_TIME/3600)) $(($RUN_TIME%3600/60)) $(($RUN_TIME%60))
+# ============================================================================ #
+
+exit $failed
@@ -0,0 +1,52 @@
+#!/bin/bash
+
+# Check the rsync filter that stage_lane() of mkfastq_template.bash uses
+# to copy a single lane of a run folder to the local disk: for lanes 1,
+# 10 and 11 of a run with lanes 1, 2, 10 and 11, only the L<nnn> folders
+# of that lane should be copied.
+#
+#   $ bash scripts/check_lane_filter.bash
+
+TEMPLATE="$(dirname "$0")/mkfastq_template.bash"
+
+if ! command -v rsync > /dev/null; then
+  echo "rsync is not installed, skipping."
+  exit 0
+fi
+
+# The filter options of the rsync call of stage_lane()
+FILTER=$(grep -o -- "--include \"L.*/'" "$TEMPLATE")
+if [[ -z $FILTER ]]; then
+  echo "No lane filter found in $TEMPLATE"
+  exit 1
+fi
+
+TMP=$(mktemp -d)
+trap 'rm -rf "$TMP"' EXIT
+
+for l in L001 L002 L010 L011
+do
+  mkdir -p "$TMP/run/Data/Intensities/BaseCalls/$l/C1.1" "$TMP/run/Data/Intensities/$l"
+  touch "$TMP/run/Data/Intensities/BaseCalls/$l/C1.1/s_1.bcl.gz"
+done
+touch "$TMP/run/RunInfo.xml"
+
+status=0
+
+for lane in 1 10 11
+do
+  rm -rf "$TMP/copy" && mkdir "$TMP/copy"
+  eval rsync -a $FILTER "$TMP/run/" "$TMP/copy/"
+
+  copied=$(cd "$TMP/copy" && find . -type d -name 'L[0-9][0-9][0-9]' | sed 's|.*/||' | sort -u | tr '\n' ' ')
+  expected="L$(printf %03d $lane) "
+
+  if [[ $copied == "$expected" && -f $TMP/copy/RunInfo.xml ]]; then
+    echo "lane $lane: OK"
+  else
+    echo "lane $lane: copied '$copied', expected '$expected'"
+    status=1
+  fi
+done
+
+exit $status
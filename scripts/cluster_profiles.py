@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+"""
+Cluster profiles: the partitions (node shapes) a site offers, and the
+selection of the partition and number of lanes/samples per node that
+finishes a stage of the plan the soonest.
+
+A profile is a JSON file like:
+
+    {
+      "name": "uppmax",
+      "partitions": [
+        {"name": "core", "cores": 16, "mem_gb": 128,
+         "max_walltime": "10-00:00:00", "cost": 1.0,
+         "nodes": 40, "queue_wait": "02:00:00"},
+        {"name": "node", "cores": 20, "mem_gb": 256, "constraint": "mem256GB",
+         "max_walltime": "10-00:00:00", "cost": 1.5,
+         "nodes": 10, "queue_wait": "06:00:00", "scratch_gb": 3000}
+      ]
+    }
+
+Only 'name', 'cores' and 'mem_gb' are required. 'scratch_gb' is the
+node-local disk, used when the jobs stage their data there.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+
+import math
+import json
+
+from runtime_store import parse_elapsed
+
+
+partition = namedtuple('partition', [
+                        'name', 'cores', 'mem_gb', 'max_walltime',
+                        'cost', 'nodes', 'queue_wait', 'constraint',
+                        'scratch_gb'
+                        ])
+
+# The run time formulas were fitted on nodes with this number of cores
+REF_CORES = 16
+
+# Each lane/sample should get at least this number of cores
+MIN_CORES_PER_ITEM = 4
+
+# Part of a node's memory given to cellranger (the rest is for the OS)
+USABLE_MEM = 7 / 8
+
+# Part of a node's local disk the staged jobs may fill
+USABLE_SCRATCH = 0.9
+
+# The local disk a staged lane/sample needs, per byte of its input: the
+# copy of the input, the temporary files and the outputs of cellranger
+SCRATCH_FACTOR = {'mkfastq': 2.5, 'count': 4.0}
+
+# Defaults for the optional fields of a partition
+DEFAULT_MAX_WALLTIME = '10-00:00:00'
+DEFAULT_NODES = 1000
+DEFAULT_SCRATCH_GB = 2000
+
+
+def load_profile(profile_file):
+    """
+    Read a cluster profile (JSON) file.
+
+    Returns: a list of 'partition' namedtuples
+    """
+
+    with open(profile_file, 'r') as f:
+        profile = json.load(f)
+
+    partitions = []
+    for p in profile['partitions']:
+        partitions.append(partition(
+            str(p['name']), int(p['cores']), int(p['mem_gb']),
+            parse_elapsed(p.get('max_walltime', DEFAULT_MAX_WALLTIME)),
+            float(p.get('cost', 1.0)),
+            int(p.get('nodes', DEFAULT_NODES)),
+            parse_elapsed(p.get('queue_wait', '00:00:00')),
+            p.get('constraint'),
+            int(p.get('scratch_gb', DEFAULT_SCRATCH_GB))))
+
+    if not partitions:
+        raise ValueError("No partitions found in '{0}'".format(profile_file))
+
+    return partitions
+
+
+def mem_per_core(part):
+    """
+    The memory (GB) cellranger may use for every core of the partition.
+    """
+    return part.mem_gb * USABLE_MEM / part.cores
+
+
+def scratch_need_gb(stage, input_bytes):
+    """
+    The local disk (GB) a lane/sample of the stage needs, when staged.
+    """
+    return SCRATCH_FACTOR[stage] * (input_bytes or 0) / 1e9
+
+
+def usable_scratch_gb(part):
+    return part.scratch_gb * USABLE_SCRATCH
+
+
+def max_per_node(part, item_mem_gb=None, item_scratch_gb=None):
+    """
+    The maximum number of lanes/samples a node of the partition can run:
+    each one needs MIN_CORES_PER_ITEM cores and, if given, 'item_mem_gb'
+    GB of memory and 'item_scratch_gb' GB of local disk.
+    """
+    per_node = part.cores // MIN_CORES_PER_ITEM
+
+    if item_mem_gb:
+        per_node = min(per_node, int(part.mem_gb * USABLE_MEM // item_mem_gb))
+
+    if item_scratch_gb:
+        per_node = min(per_node,
+                       int(usable_scratch_gb(part) // item_scratch_gb))
+
+    return max(1, per_node)
+
+
+def queue_ttc(part, jobs, secs, state=None):
+    """
+    The predicted time (seconds) until 'jobs' jobs of 'secs' seconds
+    each are done on the partition.
+
+    Without a 'state', it is the partition's queue wait, plus the run
+    time of the jobs times the number of waves needed when there are
+    more jobs than nodes. With a snapshot of the partition (a
+    cluster_state.partition_state), the first jobs start right away on
+    its idle nodes; the rest wait until the work queued (or running)
+    before them drains from the partition's nodes, and then run in
+    waves.
+    """
+
+    if state is None:
+        waves = int(math.ceil(jobs / part.nodes))
+        return part.queue_wait + waves * secs
+
+    if jobs <= state.idle:
+        return secs
+
+    nodes = max(state.total, 1)
+    drain = state.backlog_node_secs / nodes
+    waves = int(math.ceil((jobs - state.idle) / nodes))
+
+    return int(max(secs, drain + waves * secs))
+
+
+def layout_options(n_items, partitions, job_secs, item_mem_gb=None,
+                   item_scratch_gb=None, state=None):
+    """
+    All the (partition, items per node) layouts of a stage that fit in
+    the partitions' walltime (see choose_layout()).
+
+    Returns: a list of (time-to-completion, cost, partition, per_node,
+             number of jobs, run time of a job in seconds), best first
+    """
+
+    options = []
+
+    for part in partitions:
+        for per_node in range(1, min(max_per_node(part, item_mem_gb,
+                                                  item_scratch_gb),
+                                     n_items) + 1):
+            secs = int(job_secs(per_node) * REF_CORES / part.cores)
+
+            # The jobs would be killed before they finish
+            if secs > part.max_walltime:
+                continue
+
+            jobs = int(math.ceil(n_items / per_node))
+
+            ttc = queue_ttc(part, jobs, secs,
+                            state and state.get(part.name))
+            cost = part.cost * jobs * secs
+
+            options.append((ttc, cost, part, per_node, jobs, secs))
+
+    return sorted(options, key=lambda o: o[:2])
+
+
+def choose_layout(n_items, partitions, job_secs, item_mem_gb=None,
+                  item_scratch_gb=None, state=None):
+    """
+    Choose the partition and the number of items (lanes or samples) per
+    node that give the lowest predicted time-to-completion of a stage.
+
+    Inputs:
+        n_items:    [int] the number of lanes or samples of the stage
+        partitions: [list] the 'partition' namedtuples to choose from
+        job_secs:   [function] job_secs(per_node) gives the run time
+                    (seconds) of a job with that many items, on a node
+                    with REF_CORES cores
+        item_mem_gb: [float] (optional) the memory every item needs
+        item_scratch_gb: [float] (optional) the local disk every item
+                    needs
+        state:      [dict] (optional) a snapshot of the cluster, by
+                    partition name (see cluster_state.py)
+
+    The time-to-completion is predicted by queue_ttc(), with the run
+    time of the jobs scaled by the number of cores. Ties are broken by
+    the cost (node-seconds times the partition's relative cost).
+
+    Returns: (partition, per_node, run time of a job in seconds)
+    """
+
+    options = layout_options(n_items, partitions, job_secs, item_mem_gb,
+                             item_scratch_gb, state)
+
+    if not options:
+        raise ValueError('No partition can run the jobs within its walltime.')
+
+    ttc, cost, part, per_node, jobs, secs = options[0]
+
+    return part, per_node, secs
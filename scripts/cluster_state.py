@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+"""
+A snapshot of the state of the cluster: the idle nodes of every
+partition, and the work of the jobs queued (or running) there. The
+planner uses it (--queue-state) to choose the number of lanes/samples
+per node: many small jobs when nodes are idle, fewer and larger ones
+when they would only wait longer in the queue (see
+cluster_profiles.queue_ttc()).
+
+The snapshot is taken from 'sinfo' and 'squeue', or read from a JSON
+file written by this script, e.g. to plan against a known state:
+
+    $ python scripts/cluster_state.py -o snapshot.json
+    $ python scripts/cluster_state.py --sinfo sinfo.txt --squeue squeue.txt -o snapshot.json
+
+where the saved outputs come from
+
+    $ sinfo -h -o '%R %F' > sinfo.txt
+    $ squeue -h -r -o '%P %t %D %L' > squeue.txt
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+
+import json
+import shlex
+import argparse
+import datetime
+import textwrap
+import subprocess
+
+from runtime_store import parse_elapsed
+
+
+__version__ = '0.1.0'
+
+# The part of their time limit the queued jobs are expected to use
+LIMIT_USED = 0.6
+
+# The state of a partition:
+#   total, idle      - its nodes, and the ones free right now
+#   pending_jobs     - the jobs waiting for its nodes
+#   backlog_node_secs - the node-seconds of work of the jobs queued or
+#                      running there, before a new job gets a node
+partition_state = namedtuple('partition_state', [
+                        'name', 'total', 'idle', 'pending_jobs',
+                        'backlog_node_secs'
+                        ])
+
+SINFO_ARGS = ['-h', '-o', '%R %F']
+SQUEUE_ARGS = ['-h', '-r', '-o', '%P %t %D %L']
+
+
+def parse_sinfo(text):
+    """
+    Read the nodes of every partition from 'sinfo -h -o "%R %F"' lines
+    (<partition> <allocated>/<idle>/<other>/<total>).
+
+    Returns: {partition name: (total, idle)}
+    """
+
+    nodes = {}
+
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) != 2 or fields[1].count('/') != 3:
+            continue
+
+        alloc, idle, other, total = [int(n) for n in fields[1].split('/')]
+        old_total, old_idle = nodes.get(fields[0], (0, 0))
+        nodes[fields[0]] = (old_total + total, old_idle + idle)
+
+    return nodes
+
+
+def parse_squeue(text, limit_used=LIMIT_USED):
+    """
+    Read the queued and running jobs of every partition from
+    'squeue -h -r -o "%P %t %D %L"' lines (partition(s), state, nodes,
+    time left). A pending job is expected to use 'limit_used' of its
+    time limit; a job of several partitions counts for the first one.
+
+    Returns: {partition name: (pending jobs, backlog node-seconds)}
+    """
+
+    queue = {}
+
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+
+        part = fields[0].split(',')[0]
+
+        try:
+            secs = parse_elapsed(fields[3])
+            n_nodes = int(fields[2])
+        except ValueError:
+            # e.g. UNLIMITED or NOT_SET time limits
+            continue
+
+        pending = fields[1] == 'PD'
+        if pending:
+            secs *= limit_used
+
+        jobs, node_secs = queue.get(part, (0, 0))
+        queue[part] = (jobs + int(pending), node_secs + n_nodes * secs)
+
+    return queue
+
+
+def build_state(sinfo_text, squeue_text):
+    """
+    Returns: {partition name: 'partition_state'}
+    """
+
+    nodes = parse_sinfo(sinfo_text)
+    queue = parse_squeue(squeue_text)
+
+    return dict((name, partition_state(name, total, idle,
+                                       queue.get(name, (0, 0))[0],
+                                       int(queue.get(name, (0, 0))[1])))
+                for name, (total, idle) in nodes.items())
+
+
+def take_snapshot(sinfo_cmd='sinfo', squeue_cmd='squeue'):
+    """
+    Take the state of the cluster from the live 'sinfo' and 'squeue'.
+    """
+
+    sinfo = subprocess.check_output(shlex.split(sinfo_cmd) + SINFO_ARGS,
+                                    universal_newlines=True)
+    squeue = subprocess.check_output(shlex.split(squeue_cmd) + SQUEUE_ARGS,
+                                     universal_newlines=True)
+
+    return build_state(sinfo, squeue)
+
+
+def save_snapshot(state, snapshot_file):
+    with open(snapshot_file, 'w') as f:
+        json.dump({'taken': datetime.datetime.now().strftime(
+                                '%Y-%m-%dT%H:%M:%S'),
+                   'partitions': [s._asdict() for s in
+                                  sorted(state.values())]},
+                  f, indent=2)
+        f.write('\n')
+
+
+def load_snapshot(snapshot_file):
+    """
+    Read a snapshot written by save_snapshot().
+
+    Returns: {partition name: 'partition_state'}
+    """
+
+    with open(snapshot_file, 'r') as f:
+        data = json.load(f)
+
+    return dict((p['name'], partition_state(
+                    p['name'], int(p['total']), int(p['idle']),
+                    int(p.get('pending_jobs', 0)),
+                    int(p.get('backlog_node_secs', 0))))
+                for p in data['partitions'])
+
+
+def load_state(source):
+    """
+    The state of the cluster from a snapshot file, or from the live
+    'sinfo'/'squeue' if the source is 'live'.
+    """
+
+    if source == 'live':
+        return take_snapshot()
+
+    return load_snapshot(source)
+
+
+def print_state(state):
+    fmt = '{0:<10} {1:>6} {2:>6} {3:>8} {4:>14}'
+    print(fmt.format('partition', 'nodes', 'idle', 'pending', 'backlog/node'))
+
+    for s in sorted(state.values()):
+        print(fmt.format(s.name, s.total, s.idle, s.pending_jobs,
+                         '{0:.1f}h'.format(s.backlog_node_secs
+                                           / max(s.total, 1) / 3600)))
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Take a snapshot of the idle nodes and the queue of every " \
+                 "partition."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            '--sinfo',
+            help="A saved output of: sinfo -h -o '%%R %%F' (default: run it).")
+
+    parser.add_argument(
+            '--squeue',
+            help="A saved output of: squeue -h -r -o '%%P %%t %%D %%L' \
+            (default: run it).")
+
+    parser.add_argument(
+            '-o', '--output',
+            help='The snapshot file to write (default: only print it).')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    if args.sinfo or args.squeue:
+        if not (args.sinfo and args.squeue):
+            print("Give both --sinfo and --squeue. Exiting...")
+            exit(1)
+
+        with open(args.sinfo, 'r') as f:
+            sinfo = f.read()
+        with open(args.squeue, 'r') as f:
+            squeue = f.read()
+
+        state = build_state(sinfo, squeue)
+    else:
+        state = take_snapshot()
+
+    print_state(state)
+
+    if args.output:
+        save_snapshot(state, args.output)
+        print('Written: ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,10 +9,16 @@
 #SBATCH -n
 ?ram_memory
 #SBATCH -C
+?sbatch_mem
+#SBATCH --mem=
+?sbatch_tmp
+#SBATCH --tmp=
 ?use_qos_short
 #SBATCH --qos=
 ?time_request
 #SBATCH -t
+?array_spec
+#SBATCH --array=
 ?job_description
 #SBATCH -J
 ?sbatch_output
@@ -70,6 +76,26 @@ LOCALM=
 ?bash_lane_or_sample_list
 sample_array=""
 
+# In job array mode, every task takes its samples (and its local cores
+# and memory) from its own line of the manifest
+?array_manifest
+MANIFEST=""
+
+if [[ -n $MANIFEST ]]; then
+  read LOCALC LOCALM sample_array <<< "$(sed -n "${SLURM_ARRAY_TASK_ID}p" "metadata/$MANIFEST")"
+fi
+
+# If given, every sample runs on the node's local disk (see stage_sample)
+?scratch_dir
+SCRATCH=""
+
+# If given, the reference is read into the page cache ('warm'), or copied
+# to the node's local disk first ('stage'), once before the samples start
+?reference_cache
+REF_CACHE=""
+?reference_dir
+REF_LOCAL=""
+
 
 # -- Create the necessary variables for the project --
 # Get the hiseq directory name (without the path)
@@ -96,6 +122,60 @@ fi
 
 # Move to the 'counts' dir to run cellranger count, so its output goes there.
 cd 'counts'
+COUNTS_DIR=$(pwd)
+
+TRANSCRIPTOME="$COUNTS_DIR/../../../references/$REF_GENOME"
+
+# Read every file of a folder once, so that it is in the page cache
+warm_cache() {
+  find "$1" -type f -print0 | xargs -0 -n 16 -P 4 cat > /dev/null
+}
+
+# Copy the reference to the node's local disk, once per job (or job step
+# of a pilot job; the count scripts of a batch job share the copy: the
+# first one makes it)
+stage_reference() {
+  local dest="$REF_LOCAL/cellranger_ref_${SLURM_JOB_ID}${SLURM_STEP_ID:+_$SLURM_STEP_ID}"
+
+  mkdir -p "$dest" || return 1
+  (
+    flock 9
+    if [[ ! -e "$dest/$REF_GENOME.done" ]]; then
+      rsync -a "$TRANSCRIPTOME" "$dest/" && touch "$dest/$REF_GENOME.done"
+    fi
+  ) 9> "$dest/$REF_GENOME.lock"
+
+  [[ -e "$dest/$REF_GENOME.done" ]] || return 1
+  TRANSCRIPTOME="$dest/$REF_GENOME"
+}
+
+if [[ $REF_CACHE == "stage" ]]; then
+  echo "Staging the reference $REF_GENOME in $REF_LOCAL"
+  stage_reference || echo "The reference could not be staged, the shared one is used."
+fi
+
+if [[ -n $REF_CACHE ]]; then
+  WARM_START=`date +%s`
+  warm_cache "$TRANSCRIPTOME"
+  echo "Reference $TRANSCRIPTOME warmed in $((`date +%s` - WARM_START))s"
+fi
+
+# Run count for a sample on the node's local disk: copy the sample's
+# fastqs there, run it, and copy back only its 'outs'
+stage_sample() {
+  local sample=$1
+  local fastq_path=$2
+  local work="$SCRATCH/cellranger_${SLURM_JOB_ID}_$sample"
+
+  mkdir -p "$work/fastqs" || return 1
+  ( cd "$fastq_path" && find . -name "${sample}_S*" -print0 | rsync -a --from0 --files-from=- ./ "$work/fastqs/" ) || return 1
+
+  ( cd "$work" && "$COUNTS_DIR/../../../cellranger-1.2.1/cellranger" count --id=$sample --transcriptome="$TRANSCRIPTOME" --fastqs="$work/fastqs/" --sample=$sample --localcores=$LOCALC --localmem=$LOCALM ) || return 1
+
+  mkdir -p "$sample" && rsync -a "$work/$sample/outs" "$sample/" || return 1
+
+  rm -rf "$work"
+}
 
 
 # TODO: Get the number of iterations to calculate the localcores/localmem based on the choosen plan
@@ -109,12 +189,22 @@ do
   fastq_dir=$proj_name"_"$extr_lane
 
   # TODO: Check 'localcores' and 'localmem'. Do some automation
-  ../../../cellranger-1.2.1/cellranger count --id=$sample --transcriptome="../../../references/$REF_GENOME" --fastqs="../fastqs/$fastq_dir/outs/fastq_path/" --sample=$sample --localcores=$LOCALC --localmem=$LOCALM &
+  if [[ -n $SCRATCH ]]; then
+    stage_sample $sample "../fastqs/$fastq_dir/outs/fastq_path/" &
+  else
+    ../../../cellranger-1.2.1/cellranger count --id=$sample --transcriptome="$TRANSCRIPTOME" --fastqs="../fastqs/$fastq_dir/outs/fastq_path/" --sample=$sample --localcores=$LOCALC --localmem=$LOCALM &
+  fi
 done
 
 echo "Waiting CellRanger count to finish for samples: $sample_array"
 wait
 
+# Remove the staged reference, unless a batch job runs this script (its
+# other count scripts may still use the copy; the batch job removes it)
+if [[ $REF_CACHE == "stage" && -z $SHARED_COUNT_NODE ]]; then
+  rm -rf "$REF_LOCAL/cellranger_ref_${SLURM_JOB_ID}${SLURM_STEP_ID:+_$SLURM_STEP_ID}"
+fi
+
 # ========================== STUFF AFTER RUNNING ============================= #
 # Calculate and print the run and the end time                                 #
 END_TIME=`date +%s`                                                            #
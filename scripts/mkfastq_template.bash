@@ -9,10 +9,16 @@
 #SBATCH -n
 ?ram_memory
 #SBATCH -C
+?sbatch_mem
+#SBATCH --mem=
+?sbatch_tmp
+#SBATCH --tmp=
 ?use_qos_short
 #SBATCH --qos=
 ?time_request
 #SBATCH -t
+?array_spec
+#SBATCH --array=
 ?job_description
 #SBATCH -J
 ?sbatch_output
@@ -67,6 +73,19 @@ LOCALM=
 ?bash_lane_or_sample_list
 lanes=""
 
+# In job array mode, every task takes its lanes (and its local cores
+# and memory) from its own line of the manifest
+?array_manifest
+MANIFEST=""
+
+if [[ -n $MANIFEST ]]; then
+  read LOCALC LOCALM lanes <<< "$(sed -n "${SLURM_ARRAY_TASK_ID}p" "metadata/$MANIFEST")"
+fi
+
+# If given, every lane runs on the node's local disk (see stage_lane)
+?scratch_dir
+SCRATCH=""
+
 
 # Get the hiseq directory name (without the path)
 hiseq_dir=$(basename $HISEQ_PATH)
@@ -85,6 +104,31 @@ hiseq_dir=$(basename $HISEQ_PATH)
 
 # Move to the 'fastqs' dir to run cellranger mkfastq, so its output goes there.
 cd 'fastqs'
+FASTQS_DIR=$(pwd)
+
+# Run mkfastq for a lane on the node's local disk: copy the run folder
+# there (without the L<nnn> folders of the other lanes), run it, and
+# copy back only the 'outs' of its output folders
+stage_lane() {
+  local lane=$1
+  local work="$SCRATCH/cellranger_${SLURM_JOB_ID}_lane$lane"
+
+  mkdir -p "$work/run" || return 1
+  rsync -a --exclude 'Thumbnail_Images' --include "L$(printf %03d $lane)/" --exclude 'L[0-9][0-9][0-9]/' "$HISEQ_PATH/" "$work/run/" || return 1
+
+  ( cd "$work" && "$FASTQS_DIR/../../../cellranger-1.2.1/cellranger" mkfastq --run="$work/run" --csv="$FASTQS_DIR/../metadata/$SAMPLESHEET" --lanes=$lane --localcores=$LOCALC --localmem=$LOCALM ) || return 1
+
+  for out in "$work"/*/outs
+  do
+    [[ -d $out ]] || continue
+    pipestance=$(basename $(dirname "$out"))
+    [[ $pipestance == run ]] && continue
+
+    mkdir -p "$pipestance" && rsync -a "$out" "$pipestance/" || return 1
+  done
+
+  rm -rf "$work"
+}
 
 # TODO: Get the number of iterations to calculate the localcores/localmem based on the choosen plan
 # Run CellRanger mkfastq (separatelly for every lane)
@@ -92,7 +136,11 @@ for lane in $lanes
 do
   # Run CellRanger mkfastq command
   # TODO: Add 'localcores' and 'localmem' restrictions.
-  ../../../cellranger-1.2.1/cellranger mkfastq --run="$HISEQ_PATH" --csv="../metadata/$SAMPLESHEET" --lanes=$lane --localcores=$LOCALC --localmem=$LOCALM &
+  if [[ -n $SCRATCH ]]; then
+    stage_lane $lane &
+  else
+    ../../../cellranger-1.2.1/cellranger mkfastq --run="$HISEQ_PATH" --csv="../metadata/$SAMPLESHEET" --lanes=$lane --localcores=$LOCALC --localmem=$LOCALM &
+  fi
 done
 
 echo "Waiting CellRanger mkfastq to finish for Lanes: $lanes."
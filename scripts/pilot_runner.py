@@ -0,0 +1,234 @@
+#!/usr/bin/python
+
+"""
+The task runner of a pilot job (see --pilot of script_generator.py):
+inside a single multi-node allocation, it runs the jobs of a run file
+('<run file>_jobs.csv' in the metadata folder) as 'srun' job steps,
+instead of submitting each one of them to the queue.
+
+A step starts as soon as all the steps it waits for are done, with the
+cores and memory the planner gave its job, and at most --max-steps of
+them run at the same time (one per node of the allocation). The steps
+that wait for a failed step are skipped, as an 'afterok' dependency
+would. It is started by the pilot script, from the project's (or the
+batch's) folder:
+
+    $ python ../../scripts/pilot_runner.py metadata/run_project_jobs.csv --max-steps 4
+
+The start, end and state of every step go to '<run file>_steps.csv' in
+the metadata folder. It exits with 1 if a step failed or was skipped.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+from collections import OrderedDict
+
+import os
+import csv
+import time
+import shlex
+import argparse
+import textwrap
+import datetime
+import subprocess
+
+
+__version__ = '0.1.0'
+
+# A step of the pilot: the script (relative to the folder of the pilot),
+# the scripts it waits for, and the cores and memory (GB) of its job
+step = namedtuple('step', ['script', 'dependencies', 'cores', 'mem_gb'])
+
+# What happened to a step
+step_record = namedtuple('step_record', [
+                        'script', 'state', 'start', 'end', 'secs'
+                        ])
+
+
+def read_steps(graph_csv):
+    """
+    Read the jobs of a run file (see script_generator.write_job_graph()).
+
+    Returns: a list of 'step's, in submission order
+    """
+
+    steps = []
+
+    with open(graph_csv, 'r') as f:
+        for row in csv.DictReader(f):
+            steps.append(step(row['script'], row['dependencies'].split(),
+                              int(row.get('cores') or 0) or None,
+                              int(row.get('mem_gb') or 0) or None))
+
+    return steps
+
+
+def step_command(s, srun_cmd='srun'):
+    """
+    The srun call of a step: a single task on a single node, with the
+    cores and memory of its job, run from the folder of its script.
+
+    Returns: (command, folder)
+    """
+
+    folder, name = os.path.split(s.script)
+
+    cmd = shlex.split(srun_cmd) + ['-N1', '-n1', '--exclusive',
+                                   '--output=slurm_out/{0}.out'.format(
+                                       os.path.splitext(name)[0])]
+    if s.cores:
+        cmd.append('--cpus-per-task={0}'.format(s.cores))
+    if s.mem_gb:
+        cmd.append('--mem={0}G'.format(s.mem_gb))
+
+    return cmd + ['bash', name], folder or '.'
+
+
+def timestamp(secs):
+    return datetime.datetime.fromtimestamp(secs).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def run_steps(steps, max_steps, srun_cmd='srun', poll=5):
+    """
+    Run the steps, respecting their dependencies, at most 'max_steps'
+    at the same time.
+
+    Returns: an OrderedDict of 'step_record's, by script
+    """
+
+    state = OrderedDict((s.script, 'pending') for s in steps)
+    started = {}
+    records = OrderedDict()
+    running = {}
+
+    def finish(script, new_state, start=None):
+        end = time.time()
+        state[script] = new_state
+        records[script] = step_record(
+                            script, new_state,
+                            timestamp(start) if start else '',
+                            timestamp(end) if start else '',
+                            int(end - start) if start else 0)
+
+    while True:
+        # Skip the steps that wait for a failed (or skipped) step
+        for s in steps:
+            if state[s.script] == 'pending' and any(
+                    state.get(d) in ('failed', 'skipped')
+                    for d in s.dependencies):
+                print('{0}: skipped'.format(s.script))
+                finish(s.script, 'skipped')
+
+        # Start the ready steps, in submission order
+        for s in steps:
+            if len(running) >= max_steps:
+                break
+
+            if state[s.script] != 'pending' or any(
+                    state.get(d, 'done') != 'done' for d in s.dependencies):
+                continue
+
+            cmd, folder = step_command(s, srun_cmd)
+            print('{0}: started ({1})'.format(s.script, ' '.join(cmd)))
+
+            state[s.script] = 'running'
+            started[s.script] = time.time()
+            running[s.script] = subprocess.Popen(cmd, cwd=folder)
+
+        if not running:
+            break
+
+        time.sleep(poll)
+
+        for script, proc in list(running.items()):
+            if proc.poll() is None:
+                continue
+
+            del running[script]
+            finish(script, 'done' if proc.returncode == 0 else 'failed',
+                   started[script])
+
+            print('{0}: {1} after {2}s'.format(script, state[script],
+                                               records[script].secs))
+
+    # Steps left behind (waiting for steps that could never run)
+    for script, st in state.items():
+        if st == 'pending':
+            finish(script, 'skipped')
+
+    return records
+
+
+def write_records(records, records_csv):
+    with open(records_csv, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(step_record._fields)
+        writer.writerows(records.values())
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Run the jobs of a run file as job steps of a pilot job."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'graph',
+            help="The jobs of the run file ('metadata/<run file>_jobs.csv').")
+
+    parser.add_argument(
+            '--max-steps', type=int,
+            default=int(os.environ.get('SLURM_JOB_NUM_NODES', 1)),
+            help='Steps running at the same time (default: the nodes of the \
+            allocation).')
+
+    parser.add_argument(
+            '--srun', default='srun',
+            help='The srun command (default: %(default)s).')
+
+    parser.add_argument(
+            '--poll', type=float, default=5,
+            help='Secs between the checks of the running steps \
+            (default: %(default)s).')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.graph):
+        print("The jobs file you provided is not valid. Exiting...")
+        exit(1)
+
+    steps = read_steps(args.graph)
+    print('{0} step(s), at most {1} at the same time'.format(len(steps),
+                                                            args.max_steps))
+
+    records = run_steps(steps, max(args.max_steps, 1), args.srun, args.poll)
+
+    records_csv = args.graph.replace('_jobs.csv', '_steps.csv')
+    write_records(records, records_csv)
+
+    failed = [r.script for r in records.values() if r.state != 'done']
+    print('{0}/{1} step(s) done, see {2}'.format(len(steps) - len(failed),
+                                                 len(steps), records_csv))
+
+    if failed:
+        print('Not done: ' + ' '.join(failed))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
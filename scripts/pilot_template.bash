@@ -0,0 +1,77 @@
+#!/bin/bash -l
+
+# Define the variables for the sbatch job
+?uppmax_project_name
+#SBATCH -A
+?partition
+#SBATCH -p
+?pilot_nodes
+#SBATCH -N
+#SBATCH --ntasks-per-node=1
+?num_cores
+#SBATCH --cpus-per-task=
+?ram_memory
+#SBATCH -C
+?sbatch_mem
+#SBATCH --mem=
+?use_qos_short
+#SBATCH --qos=
+?time_request
+#SBATCH -t
+?job_description
+#SBATCH -J
+?sbatch_output
+#SBATCH --output=
+
+# # =================== STUFF BEFORE RUNNING ==================== #
+# #  -- Always change directory to the project's root dir         #
+# # where the script is located. This helps the orientation       #
+# # of the script relative to the project.                        #
+#                                                                 #
+# # Get which file was called on the bash command                 #
+# # e.g.   symlink --or-- original                                #
+# SOURCE="${BASH_SOURCE[0]}"                                      #
+#                                                                 #
+# # resolve $SOURCE until the file is no longer a symlink         #
+# while [ -h "$SOURCE" ];                                         #
+# do                                                              #
+#   DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"              #
+#   SOURCE="$(readlink "$SOURCE")"                                #
+#                                                                 #
+#   # if $SOURCE was a relative symlink, we need to resolve it    #
+#   # relative to the path where the symlink file was located     #
+#   [[ $SOURCE != /* ]] && SOURCE="$DIR/$SOURCE"                  #
+# done                                                            #
+#                                                                 #
+# # Form the directory and move there                             #
+# DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"                #
+# cd $DIR                                                         #
+                                                                #
+# Print and keep the start time to calculate the run time       #
+START_TIME=`date +%s`                                           #
+echo $(date)                                                    #
+# ============================================================= #
+
+
+# -- Run the jobs of the run file as job steps of this allocation --
+# Every job becomes an 'srun' step on one of the nodes, as soon as the
+# jobs it waits for are done (see scripts/pilot_runner.py).
+?job_graph
+GRAPH=""
+?pilot_nodes
+MAX_STEPS=
+
+python ../../scripts/pilot_runner.py "$GRAPH" --max-steps $MAX_STEPS
+status=$?
+
+# ========================== STUFF AFTER RUNNING ============================= #
+# Calculate and print the run and the end time                                 #
+END_TIME=`date +%s`                                                            #
+RUN_TIME=$((END_TIME - START_TIME))                                            #
+                                                                               #
+echo $(date)                                                                   #
+printf 'Script was running for: '                                              #
+printf '%d-%02d:%02d:%02d\n' $(($RUN_TIME/86400)) $(($RUN_TIME/3600)) $(($RUN_TIME%3600/60)) $(($RUN_TIME%60))
+# ============================================================================ #
+
+exit $status
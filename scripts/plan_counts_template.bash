@@ -0,0 +1,78 @@
+#!/bin/bash -l
+
+# Define the variables for the sbatch job
+?uppmax_project_name
+#SBATCH -A
+?partition
+#SBATCH -p
+?num_cores
+#SBATCH -n
+?ram_memory
+#SBATCH -C
+?sbatch_mem
+#SBATCH --mem=
+?use_qos_short
+#SBATCH --qos=
+?time_request
+#SBATCH -t
+?job_description
+#SBATCH -J
+?sbatch_output
+#SBATCH --output=
+
+# # =================== STUFF BEFORE RUNNING ==================== #
+# #  -- Always change directory to the project's root dir         #
+# # where the script is located. This helps the orientation       #
+# # of the script relative to the project.                        #
+#                                                                 #
+# # Get which file was called on the bash command                 #
+# # e.g.   symlink --or-- original                                #
+# SOURCE="${BASH_SOURCE[0]}"                                      #
+#                                                                 #
+# # resolve $SOURCE until the file is no longer a symlink         #
+# while [ -h "$SOURCE" ];                                         #
+# do                                                              #
+#   DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"              #
+#   SOURCE="$(readlink "$SOURCE")"                                #
+#                                                                 #
+#   # if $SOURCE was a relative symlink, we need to resolve it    #
+#   # relative to the path where the symlink file was located     #
+#   [[ $SOURCE != /* ]] && SOURCE="$DIR/$SOURCE"                  #
+# done                                                            #
+#                                                                 #
+# # Form the directory and move there                             #
+# DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"                #
+# cd $DIR                                                         #
+                                                                #
+# Print and keep the start time to calculate the run time       #
+START_TIME=`date +%s`                                           #
+echo $(date)                                                    #
+# ============================================================= #
+
+
+# -- Plan the count jobs, now that the fastqs exist --
+# The count jobs and the aggregation are planned by the read count of
+# every sample, with the arguments of the first phase, and submitted
+# from here (see run_count_phase() in scripts/script_generator.py).
+?project_dir
+PROJECT_DIR=""
+?uppmax_project_name
+ACCOUNT=""
+?plan_job_name
+JOB_NAME=""
+
+cd ../..
+python scripts/script_generator.py --plan-counts "$PROJECT_DIR" -A "$ACCOUNT" -J "$JOB_NAME"
+status=$?
+
+# ========================== STUFF AFTER RUNNING ============================= #
+# Calculate and print the run and the end time                                 #
+END_TIME=`date +%s`                                                            #
+RUN_TIME=$((END_TIME - START_TIME))                                            #
+                                                                               #
+echo $(date)                                                                   #
+printf 'Script was running for: '                                              #
+printf '%d-%02d:%02d:%02d\n' $(($RUN_TIME/86400)) $(($RUN_TIME/3600)) $(($RUN_TIME%3600/60)) $(($RUN_TIME%60))
+# ============================================================================ #
+
+exit $status
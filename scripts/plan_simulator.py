@@ -0,0 +1,367 @@
+#!/usr/bin/python
+
+"""
+An offline simulator of the generated plans: it replays the scripts of
+calculate_plan() and the dependencies build_run_file() would submit
+them with, on a model of N nodes, and reports the makespan (end to end
+turnaround), the node utilisation and the critical path.
+
+Every job takes a whole node for its run time, which is its requested
+walltime (times the --runtime-factor, e.g. 0.7 if the jobs usually end
+well before their walltime). A job starts as soon as its dependencies
+are done and a node is free; when more jobs are ready than nodes, they
+start in the order they are submitted.
+
+Several planning strategies (planner, dependencies, lanes/samples per
+node, number of nodes) can be compared side by side, e.g.
+
+    $ python scripts/plan_simulator.py -s sheet.csv --planner fixed size \
+          --deps dag barrier --count-per-node 2 4 -N 4 8
+
+Nothing is written or submitted, so it can be used as a regression
+benchmark of the planner (see --csv).
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+
+import csv
+import heapq
+import argparse
+import textwrap
+import itertools
+
+import samplesheet
+import runtime_store
+import resource_model
+import cluster_profiles
+import script_generator
+
+
+__version__ = '0.1.0'
+
+
+# A job of the simulation: its run time (secs) and the jobs it waits for
+sim_job = namedtuple('sim_job', ['name', 'secs', 'deps'])
+
+# The outcome of a simulation
+sim_result = namedtuple('sim_result', [
+                        'makespan', 'utilisation', 'critical_path',
+                        'start', 'finish'
+                        ])
+
+# A planning strategy to simulate
+strategy = namedtuple('strategy', [
+                        'planner', 'deps', 'mkfq_per_node',
+                        'count_per_node', 'nodes'
+                        ])
+
+
+def plan_jobs(plan, dependencies, runtime_factor=1.0):
+    """
+    Turn a plan (and its dependencies, see plan_dependencies(); None for
+    the barrier ones) into the list of jobs to simulate, in the order
+    they are submitted. The tasks of a job array are separate jobs, and
+    every task waits for the whole array of the previous process.
+
+    Returns: a list of 'sim_job's
+    """
+
+    if dependencies is None:
+        dependencies = script_generator.barrier_dependencies(plan)
+
+    jobs = []
+
+    # The job(s) every script of the plan turns into
+    expanded = {}
+
+    for stage in plan:
+        for info in stage:
+            secs = int(runtime_store.parse_elapsed(info.runtime)
+                       * runtime_factor)
+
+            deps = [j for d in dependencies.get(info.scr_name, [])
+                    for j in expanded[d]]
+
+            if info.array is None:
+                names = [info.scr_name]
+            else:
+                names = ['{0}[{1}]'.format(info.scr_name, i + 1)
+                         for i in range(len(info.array.chunks))]
+
+            expanded[info.scr_name] = names
+            jobs.extend(sim_job(name, secs, deps) for name in names)
+
+    return jobs
+
+
+def simulate(jobs, n_nodes):
+    """
+    Run the jobs on 'n_nodes' nodes, one job per node at a time.
+
+    The critical path is the chain of jobs that delayed the last job:
+    every job is delayed either by its last dependency, or (if it had
+    to wait for a node) by the job that freed the node.
+
+    Returns: a 'sim_result'
+    """
+
+    pending = list(jobs)
+    running = []
+    start = {}
+    finish = {}
+    blocker = {}
+    free = n_nodes
+    now = 0
+    freed_by = None
+
+    while pending or running:
+        # Start the ready jobs, in submission order, while nodes are free
+        for job in list(pending):
+            if free == 0:
+                break
+
+            if any(d not in finish for d in job.deps):
+                continue
+
+            pending.remove(job)
+            free -= 1
+
+            start[job.name] = now
+            heapq.heappush(running, (now + job.secs, len(start), job.name))
+
+            ready = max([finish[d] for d in job.deps] or [0])
+            if ready < now:
+                blocker[job.name] = freed_by
+            else:
+                blocker[job.name] = max(job.deps, key=finish.get) \
+                    if job.deps else None
+
+        if not running:
+            raise ValueError('Jobs waiting for jobs that never run: ' +
+                             ', '.join(j.name for j in pending))
+
+        # Move to the next job that finishes
+        now, _, name = heapq.heappop(running)
+        finish[name] = now
+        freed_by = name
+        free += 1
+
+    makespan = max(finish.values()) if finish else 0
+    busy = sum(j.secs for j in jobs)
+
+    path = [max(finish, key=finish.get)] if finish else []
+    while path and blocker[path[0]] is not None:
+        path.insert(0, blocker[path[0]])
+
+    return sim_result(makespan, busy / max(n_nodes * makespan, 1), path,
+                      start, finish)
+
+
+def simulate_strategy(sheet, strat, sizes=None, runtime_model=None,
+                      reference=None, profile=None, runtime_factor=1.0,
+                      resources=None):
+    """
+    Plan the samplesheet with the given 'strategy' and simulate it.
+
+    Returns: (the plan, a 'sim_result')
+    """
+
+    node = script_generator.uppmax_node._replace(
+                mkfq_per_node=strat.mkfq_per_node,
+                count_per_node=strat.count_per_node)
+
+    plan = script_generator.calculate_plan(sheet, sizes, strat.planner,
+                                           runtime_model, reference,
+                                           profile, node, resources)
+
+    dependencies = None
+    if strat.deps == 'dag':
+        dependencies = script_generator.plan_dependencies(plan,
+                                                          sheet.sample_lanes)
+
+    jobs = plan_jobs(plan, dependencies, runtime_factor)
+
+    return plan, simulate(jobs, strat.nodes)
+
+
+def print_results(results):
+    """
+    Print a table of the simulated strategies, fastest first, and the
+    critical path of the fastest one.
+    """
+
+    fmt = '{0:<8} {1:<8} {2:>6} {3:>6} {4:>6} {5:>5} {6:>14} {7:>6}'
+    print(fmt.format('planner', 'deps', 'mk/nd', 'cnt/nd', 'nodes',
+                     'jobs', 'makespan', 'util'))
+
+    ranked = sorted(results, key=lambda r: r[2].makespan)
+
+    for strat, plan, res in ranked:
+        print(fmt.format(strat.planner, strat.deps, strat.mkfq_per_node,
+                         strat.count_per_node, strat.nodes,
+                         len(res.finish),
+                         script_generator.format_walltime(res.makespan),
+                         '{0:.0%}'.format(res.utilisation)))
+
+    strat, plan, res = ranked[0]
+    print('\nCritical path of the fastest: ' + ' -> '.join(
+            '{0} ({1}-{2})'.format(
+                name, script_generator.format_walltime(res.start[name]),
+                script_generator.format_walltime(res.finish[name]))
+            for name in res.critical_path))
+
+
+def write_csv(results, csv_file):
+    """
+    Write the simulated strategies in a CSV file (e.g. to compare the
+    planner before and after a change).
+    """
+
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(strategy._fields)
+                        + ['jobs', 'makespan', 'utilisation',
+                           'critical_path'])
+
+        for strat, plan, res in results:
+            writer.writerow(list(strat)
+                            + [len(res.finish), res.makespan,
+                               '{0:.4f}'.format(res.utilisation),
+                               ' '.join(res.critical_path)])
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Simulate the plan of a samplesheet on N nodes, and " \
+                 "compare planning strategies."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            '-s', '--samplesheet', required=True,
+            help='The samplesheet to plan.')
+
+    parser.add_argument(
+            '-d', '--hiseq-datapath',
+            help='The raw data, to measure the input sizes (optional).')
+
+    parser.add_argument(
+            '-r', '--ref', default='mm', choices=['mm', 'hg'],
+            help='The reference genome (default: %(default)s).')
+
+    parser.add_argument(
+            '--runtime-db',
+            help='Run time history of past jobs, to predict the walltimes.')
+
+    parser.add_argument(
+            '--walltime-quantile', type=float, default=0.95,
+            help='See script_generator.py (default: %(default)s).')
+
+    parser.add_argument(
+            '--cluster-profile',
+            help='A JSON file with the partitions of the cluster (the \
+            lanes/samples per node are then chosen by the profile).')
+
+    parser.add_argument(
+            '--resource-model',
+            help='The memory model of the processes (see resource_model.py).')
+
+    parser.add_argument(
+            '--planner', nargs='+', default=['fixed'],
+            choices=['fixed', 'size'],
+            help='The planner(s) to compare (default: fixed).')
+
+    parser.add_argument(
+            '--deps', nargs='+', default=['dag'],
+            choices=['dag', 'barrier'],
+            help='The job dependencies to compare: only the lanes of \
+            every sample (dag), or all the previous jobs (barrier).')
+
+    parser.add_argument(
+            '--mkfq-per-node', nargs='+', type=int,
+            default=[script_generator.uppmax_node.mkfq_per_node],
+            help='Lanes per mkfastq node (default: %(default)s).')
+
+    parser.add_argument(
+            '--count-per-node', nargs='+', type=int,
+            default=[script_generator.uppmax_node.count_per_node],
+            help='Samples per count node (default: %(default)s).')
+
+    parser.add_argument(
+            '-N', '--nodes', nargs='+', type=int, default=[4],
+            help='Number of nodes available (default: %(default)s).')
+
+    parser.add_argument(
+            '--runtime-factor', type=float, default=1.0,
+            help='Run time of a job, as a fraction of its walltime \
+            (default: %(default)s).')
+
+    parser.add_argument(
+            '--csv',
+            help='Also write the results in this CSV file.')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    try:
+        sheet = samplesheet.load_samplesheet(args.samplesheet)
+    except samplesheet.SamplesheetError as e:
+        print(e)
+        exit(1)
+
+    sizes = None
+    if args.hiseq_datapath:
+        sizes = script_generator.measure_input_sizes(args.hiseq_datapath,
+                                                     sheet)
+
+    runtime_model = None
+    if args.runtime_db:
+        runtime_model = runtime_store.RuntimeModel(
+                            runtime_store.RuntimeStore(args.runtime_db),
+                            args.walltime_quantile)
+
+    profile = None
+    if args.cluster_profile:
+        profile = cluster_profiles.load_profile(args.cluster_profile)
+
+    resources = None
+    if args.resource_model:
+        resources = resource_model.load_model(args.resource_model)
+
+    results = []
+
+    for values in itertools.product(args.planner, args.deps,
+                                    args.mkfq_per_node, args.count_per_node,
+                                    args.nodes):
+        strat = strategy(*values)
+
+        plan, res = simulate_strategy(sheet, strat, sizes, runtime_model,
+                                      args.ref, profile, args.runtime_factor,
+                                      resources)
+        results.append((strat, plan, res))
+
+    print('{0} lanes, {1} samples\n'.format(len(sheet.lanes),
+                                           len(sheet.samples)))
+    print_results(results)
+
+    if args.csv:
+        write_csv(results, args.csv)
+
+
+if __name__ == '__main__':
+    main()
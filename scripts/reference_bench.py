@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+"""
+A benchmark of the reference loading of the count jobs. The samples of
+a count job start at the same moment, and every one of them reads the
+whole reference index (STAR loads it in memory). It times N concurrent
+readers of the reference (every one reads all its files) in three
+setups:
+
+    cold   - nothing of the reference is in the page cache
+    warm   - the reference is read once first (the 'warm' reference
+             cache of the count scripts)
+    staged - the reference is copied to a local folder and warmed
+             first (the 'stage' reference cache, see --local)
+
+    $ python scripts/reference_bench.py references/refdata-cellranger-mm10-1.2.0 \
+          -n 1 4 --local $SNIC_TMP
+
+For every setup it prints the time spent before the samples start
+(warming/copying), the time until the last reader has the whole index,
+and their sum: when all the samples have their index.
+
+The files are dropped from the page cache with posix_fadvise(DONTNEED)
+before every run. A network filesystem may keep them in its own cache,
+so the cold times are a lower bound there.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import io
+import os
+import csv
+import time
+import shutil
+import ctypes
+import ctypes.util
+import argparse
+import textwrap
+
+
+__version__ = '0.1.0'
+
+# Files are read in blocks of this size
+BUFFER_SIZE = 8 << 20
+
+# posix_fadvise() advice to drop the pages of a file (Linux)
+POSIX_FADV_DONTNEED = 4
+
+# The outcome of a run:
+#   prepare - secs spent before the samples start (warm/copy)
+#   loads   - secs every reader took to read the whole reference
+bench_result = namedtuple('bench_result', [
+                        'setup', 'readers', 'prepare', 'loads', 'bytes'
+                        ])
+
+_libc = None
+
+
+def evict(path):
+    """
+    Drop the pages of a file from the page cache (best effort).
+
+    Returns: whether the kernel accepted the advice
+    """
+
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _libc.posix_fadvise(fd, ctypes.c_longlong(0),
+                                   ctypes.c_longlong(0),
+                                   POSIX_FADV_DONTNEED) == 0
+    finally:
+        os.close(fd)
+
+
+def list_files(root):
+    """
+    Return the (sorted) paths of all the files under root.
+    """
+
+    paths = []
+    for dirpath, dirs, files in os.walk(root):
+        paths.extend(os.path.join(dirpath, f) for f in files)
+
+    return sorted(paths)
+
+
+def read_files(paths):
+    """
+    Read the files once, the way the index is loaded.
+
+    Returns: the number of bytes read
+    """
+
+    total = 0
+    buf = bytearray(BUFFER_SIZE)
+
+    for path in paths:
+        with io.open(path, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                total += n
+
+    return total
+
+
+def concurrent_load(paths, n_readers):
+    """
+    Let 'n_readers' readers read the files at the same time.
+
+    Returns: the secs every reader took
+    """
+
+    start = time.time()
+
+    def reader(_):
+        read_files(paths)
+        return time.time() - start
+
+    pool = ThreadPool(n_readers)
+    try:
+        return pool.map(reader, range(n_readers))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_setup(setup, reference, n_readers, local=None):
+    """
+    Run the readers in the given setup ('cold', 'warm' or 'staged', the
+    latter copies the reference into the 'local' folder).
+
+    Returns: a 'bench_result'
+    """
+
+    paths = list_files(reference)
+    for path in paths:
+        evict(path)
+
+    start = time.time()
+
+    if setup == 'staged':
+        target = os.path.join(local, 'reference_bench_{0}'.format(os.getpid()),
+                              os.path.basename(reference.rstrip('/')))
+        if os.path.exists(target):
+            shutil.rmtree(target)
+
+        shutil.copytree(reference, target)
+        paths = list_files(target)
+
+    if setup in ('warm', 'staged'):
+        read_files(paths)
+
+    prepare = time.time() - start
+    n_bytes = sum(os.path.getsize(p) for p in paths)
+
+    try:
+        loads = concurrent_load(paths, n_readers)
+    finally:
+        if setup == 'staged':
+            shutil.rmtree(os.path.dirname(target))
+
+    return bench_result(setup, n_readers, prepare, loads, n_bytes)
+
+
+def print_results(results):
+    fmt = '{0:<8} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}'
+    print(fmt.format('setup', 'readers', 'prepare', 'load mean',
+                     'load max', 'ready'))
+
+    for res in results:
+        print(fmt.format(res.setup, res.readers,
+                         '{0:.1f}s'.format(res.prepare),
+                         '{0:.1f}s'.format(sum(res.loads) / len(res.loads)),
+                         '{0:.1f}s'.format(max(res.loads)),
+                         '{0:.1f}s'.format(res.prepare + max(res.loads))))
+
+
+def write_csv(results, csv_file):
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['setup', 'readers', 'bytes', 'prepare',
+                         'load_mean', 'load_max'])
+
+        for res in results:
+            writer.writerow([res.setup, res.readers, res.bytes,
+                             '{0:.3f}'.format(res.prepare),
+                             '{0:.3f}'.format(sum(res.loads)
+                                              / len(res.loads)),
+                             '{0:.3f}'.format(max(res.loads))])
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Compare the cold, warm and staged loading of a reference " \
+                 "by N concurrent samples."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'reference',
+            help='The reference folder (e.g. references/refdata-...).')
+
+    parser.add_argument(
+            '-n', '--readers', nargs='+', type=int, default=[4],
+            help='Number(s) of samples reading the reference at the same \
+            time (default: 4).')
+
+    parser.add_argument(
+            '--local',
+            help='A local disk folder, to also time the staged setup.')
+
+    parser.add_argument(
+            '--repeat', type=int, default=1,
+            help='Times to run every setup (default: %(default)s).')
+
+    parser.add_argument(
+            '--csv',
+            help='Also write the results in this CSV file.')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.reference):
+        print("The reference path you provided is not valid. Exiting...")
+        exit(1)
+
+    setups = ['cold', 'warm']
+    if args.local:
+        setups.append('staged')
+
+    results = []
+    for n_readers in args.readers:
+        for setup in setups:
+            for _ in range(args.repeat):
+                results.append(run_setup(setup, args.reference, n_readers,
+                                         args.local))
+
+    print('{0}: {1} files, {2:.1f} GB\n'.format(
+            args.reference, len(list_files(args.reference)),
+            results[0].bytes / 1e9))
+    print_results(results)
+
+    if args.csv:
+        write_csv(results, args.csv)
+
+
+if __name__ == '__main__':
+    main()
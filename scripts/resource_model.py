@@ -0,0 +1,301 @@
+#!/usr/bin/python
+
+"""
+A memory model of the cellranger processes, used to size the jobs
+instead of giving every lane/sample a fixed 7GB per core.
+
+The peak memory (RSS) of a lane/sample is modelled per stage and
+reference genome as:
+
+    peak_GB = base + slope * input_GB
+
+and cellranger gets (--localmem) the peak plus some headroom. The STAR
+index dominates the memory of 'count', so it depends mostly on the
+reference (the human index is larger than the mouse one), while
+'mkfastq' needs a few GB per lane whatever the reference.
+
+The built-in values are starting points; they can be calibrated from
+the observed peak RSS of past jobs:
+
+    $ sacct --parsable -S 2017-01-01 -o JobID,JobName,State,MaxRSS,Submit > dump.txt
+    $ python scripts/resource_model.py dump.txt projects/*/metadata/plan_info.csv \
+          -o resources.json
+
+and the result given to the generator with --resource-model.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+
+import re
+import json
+import math
+import argparse
+import textwrap
+
+import runtime_store
+
+
+__version__ = '0.1.0'
+
+
+# The memory model of a (stage, reference): GB, GB per input GB
+mem_fit = namedtuple('mem_fit', ['base', 'slope'])
+
+# Fits of the peak RSS, by stage and reference (None: any reference)
+DEFAULT_FITS = {
+    ('mkfastq', None): mem_fit(4.0, 0.0),
+    ('count', 'mm'): mem_fit(21.0, 0.05),
+    ('count', 'hg'): mem_fit(28.0, 0.05),
+    ('count', None): mem_fit(28.0, 0.05),
+    ('aggr', None): mem_fit(8.0, 0.02)
+    }
+
+# Extra memory given on top of the predicted peak
+HEADROOM = 1.25
+
+# The stages that run as a single process for all their items: their
+# fit is of the whole job, not of a lane/sample
+WHOLE_JOB_STAGES = ('aggr',)
+
+# Minimum number of observed jobs needed to calibrate a fit
+MIN_HISTORY = runtime_store.MIN_HISTORY
+
+# The quantile of the residuals added to a calibrated fit's base
+CALIBRATION_QUANTILE = 0.95
+
+
+class ResourceModel(object):
+    """
+    Predicts the memory (GB) a lane/sample of a stage needs.
+    """
+
+    def __init__(self, fits=None, headroom=HEADROOM):
+        self.fits = dict(DEFAULT_FITS)
+        self.fits.update(fits or {})
+        self.headroom = headroom
+
+    def peak_gb(self, stage, reference=None, input_bytes=0):
+        """
+        The predicted peak RSS (GB) of a lane/sample.
+        """
+        fit = self.fits.get((stage, reference)) \
+            or self.fits.get((stage, None))
+
+        if fit is None:
+            raise ValueError("No memory model for '{0}'".format(stage))
+
+        return fit.base + fit.slope * (input_bytes or 0) / 1e9
+
+    def request_gb(self, stage, reference=None, input_bytes=0):
+        """
+        The memory (whole GB) to give to a lane/sample: its predicted
+        peak plus the headroom.
+        """
+        return int(math.ceil(self.peak_gb(stage, reference, input_bytes)
+                             * self.headroom))
+
+
+def load_model(model_file):
+    """
+    Read a model written by this script (JSON), on top of the defaults.
+
+    Returns: a ResourceModel
+    """
+
+    with open(model_file, 'r') as f:
+        data = json.load(f)
+
+    fits = {}
+    for fit in data['fits']:
+        fits[(fit['stage'], fit.get('reference'))] = mem_fit(
+                                float(fit['base']), float(fit['slope']))
+
+    return ResourceModel(fits, float(data.get('headroom', HEADROOM)))
+
+
+def save_model(model, model_file):
+    """
+    Write the fits of the model in a JSON file.
+    """
+
+    fits = [{'stage': stage, 'reference': ref,
+             'base': round(fit.base, 2), 'slope': round(fit.slope, 4)}
+            for (stage, ref), fit in sorted(model.fits.items(),
+                                            key=lambda kv: (kv[0][0],
+                                                            kv[0][1] or ''))]
+
+    with open(model_file, 'w') as f:
+        json.dump({'headroom': model.headroom, 'fits': fits}, f, indent=2)
+        f.write('\n')
+
+
+def parse_mem(value):
+    """
+    Convert a sacct memory value (e.g. 31.50G, 1234567K) to GB.
+    """
+
+    match = re.match(r'^([\d.]+)([KMGT]?)', value.strip())
+    if not match or not match.group(1):
+        return None
+
+    scale = {'': 1e-9, 'K': 2 ** 10 / 1e9, 'M': 2 ** 20 / 1e9,
+             'G': 2 ** 30 / 1e9, 'T': 2 ** 40 / 1e9}[match.group(2)]
+
+    return float(match.group(1)) * scale
+
+
+def read_peaks(dump_file):
+    """
+    Read the peak RSS of every job from a 'sacct --parsable' dump with
+    (at least) the JobID, JobName, State and MaxRSS fields. The MaxRSS
+    is reported on the job steps (e.g. 1234.batch); a job's peak is the
+    largest of its steps.
+
+    Returns: {job ID: (job name, submit time, peak GB)}, for the
+             completed jobs
+    """
+
+    names = {}
+    submits = {}
+    peaks = {}
+
+    with open(dump_file, 'r') as f:
+        header = runtime_store.parsable_fields(f.readline())
+
+        for line in f:
+            fields = runtime_store.parsable_fields(line)
+            if len(fields) != len(header):
+                continue
+
+            job = dict(zip(header, fields))
+            job_id = job['JobID'].split('.')[0]
+
+            if '.' not in job['JobID']:
+                if job['State'].startswith('COMPLETED'):
+                    names[job_id] = job['JobName']
+                    submits[job_id] = job.get('Submit')
+
+            peak = parse_mem(job.get('MaxRSS', ''))
+            if peak is not None:
+                peaks[job_id] = max(peaks.get(job_id, 0), peak)
+
+    return dict((j, (names[j], submits[j], p)) for j, p in peaks.items()
+                if j in names)
+
+
+def calibrate(observations, model=None, q=CALIBRATION_QUANTILE,
+              min_history=MIN_HISTORY):
+    """
+    Fit the memory model on observed peaks.
+
+    Input:
+        observations: [list] (stage, reference, n_items, input_bytes,
+                      peak GB) tuples, one for every past job
+
+    A job of n lanes/samples is taken to have needed peak / n per item
+    (the items of a job run at the same time, each one with its own
+    --localmem), except for the WHOLE_JOB_STAGES, whose fit is of the
+    whole job (e.g. the aggregation of all the samples). The fit is a least squares line, raised by the q
+    quantile of its residuals, so that q of the jobs would have fit.
+    The stages/references with too few jobs keep their current fit.
+
+    Returns: a new ResourceModel
+    """
+
+    model = model or ResourceModel()
+    groups = {}
+
+    for stage, ref, n_items, input_bytes, peak in observations:
+        n_items = max(int(n_items), 1)
+        if stage in WHOLE_JOB_STAGES:
+            n_items = 1
+
+        # As (n, bytes, y) rows of runtime_store.fit_linear(), with the
+        # input GB per item in the place of 'n'
+        row = ((input_bytes or 0) / n_items / 1e9, 0, peak / n_items)
+
+        groups.setdefault((stage, ref), []).append(row)
+        if ref is not None:
+            groups.setdefault((stage, None), []).append(row)
+
+    fits = dict(model.fits)
+
+    for key, rows in groups.items():
+        if len(rows) < min_history:
+            continue
+
+        # It drops the input column when it is constant
+        coefs, margin = runtime_store.fit_linear(rows, q)
+        slope = coefs[1] if len(coefs) > 1 else 0.0
+
+        fits[key] = mem_fit(max(coefs[0] + margin, 1.0), max(slope, 0.0))
+
+    return ResourceModel(fits, model.headroom)
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Calibrate the memory model from the peak RSS of past jobs."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'sacct_dump',
+            help="Output of 'sacct --parsable -o \
+            JobID,JobName,State,MaxRSS,Submit'.")
+
+    parser.add_argument(
+            'plan_info', nargs='+',
+            help="The 'metadata/plan_info.csv' file(s) of the projects.")
+
+    parser.add_argument(
+            '-o', '--output', default='resources.json',
+            help='The model file to write (default: %(default)s).')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    peaks = read_peaks(args.sacct_dump)
+
+    observations = []
+    for plan_file in args.plan_info:
+        joined = runtime_store.join_plan(
+                    plan_file, [(job_id, name, submit) for job_id,
+                                (name, submit, _) in peaks.items()])
+
+        for job_id, info in joined.items():
+            observations.append((info['stage'], info['reference'] or None,
+                                 int(info['n_items']),
+                                 int(info['input_bytes'] or 0),
+                                 peaks[job_id][2]))
+
+    model = calibrate(observations)
+    save_model(model, args.output)
+
+    print('{0} job(s) used, model written to {1}'.format(len(observations),
+                                                         args.output))
+
+    for (stage, ref), fit in sorted(model.fits.items(),
+                                    key=lambda kv: (kv[0][0],
+                                                    kv[0][1] or '')):
+        print('  {0:<8} {1:<4} {2:6.1f} GB + {3:.3f} GB/GB input'.format(
+                stage, ref or '*', fit.base, fit.slope))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+#!/usr/bin/python
+
+"""
+A local store of past job run times, used to predict the walltime
+(#SBATCH -t) of the generated scripts instead of the hard-coded
+constants in calc_run_time().
+
+The run times come from 'sacct --parsable' dumps, e.g.
+
+    $ sacct --parsable -S 2017-01-01 -o JobID,JobName,State,Elapsed,Submit > dump.txt
+
+joined with the 'plan_info.csv' file that the generator writes in the
+metadata folder of every project (see join_plan()). The latter keeps
+the stage, the number of lanes/samples, the input size and the
+reference genome of each generated script.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import csv
+import glob
+import math
+import sqlite3
+import argparse
+import textwrap
+
+
+__version__ = '0.1.0'
+
+# Default location of the run time history (next to the projects)
+DEFAULT_DB = 'projects/runtime_history.db'
+
+# Minimum number of past jobs needed before trusting a fitted model
+MIN_HISTORY = 5
+
+# Never request less than this (seconds), whatever the model says
+MIN_WALLTIME = 600
+
+
+class RuntimeStore(object):
+    """
+    A thin wrapper around an SQLite database with a single table,
+    holding one row for every (completed) job we have seen.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id      TEXT PRIMARY KEY,
+                job_name    TEXT,
+                stage       TEXT,
+                n_items     INTEGER,
+                input_bytes INTEGER,
+                reference   TEXT,
+                elapsed     INTEGER
+            )""")
+        self.conn.commit()
+
+    def add(self, job_id, job_name, stage, n_items,
+            input_bytes, reference, elapsed):
+        """
+        Add (or replace) the record of a job.
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, job_name, stage, n_items,
+             input_bytes, reference, elapsed))
+
+    def commit(self):
+        self.conn.commit()
+
+    def records(self, stage, reference=None):
+        """
+        Return a list of (n_items, input_bytes, elapsed) tuples of the
+        given stage (and reference genome, if given).
+        """
+        query = "SELECT n_items, input_bytes, elapsed FROM jobs WHERE stage=?"
+        params = [stage]
+
+        if reference is not None:
+            query += " AND reference=?"
+            params.append(reference)
+
+        return self.conn.execute(query, params).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+class RuntimeModel(object):
+    """
+    Predicts the walltime of a job from the history of a RuntimeStore.
+
+    For every stage a linear model (elapsed ~ n_items + input_bytes) is
+    fitted on the past jobs. The requested walltime is the prediction
+    plus the given quantile (e.g. 0.95) of the model's residuals, so
+    that roughly that fraction of the jobs finishes in time.
+
+    Predictions are None when there is not enough history; the caller
+    should then fall back to its own formula.
+    """
+
+    def __init__(self, store, quantile=0.95, min_history=MIN_HISTORY):
+        self.store = store
+        self.quantile = quantile
+        self.min_history = min_history
+        self._fits = {}
+
+    def predict(self, stage, n_items, input_bytes=0, reference=None):
+        """
+        Return the walltime (seconds) to request, or None.
+        """
+        fit = self._fit(stage, reference)
+
+        if fit is None:
+            return None
+
+        coefs, margin = fit
+        features = [1.0, n_items, input_bytes / 1e9][:len(coefs)]
+        secs = sum(c * x for c, x in zip(coefs, features)) + margin
+
+        return int(max(secs, MIN_WALLTIME))
+
+    def _fit(self, stage, reference):
+        """
+        Fit (and cache) the model of a stage. The jobs of the given
+        reference genome are preferred, if there are enough of them.
+        """
+        key = (stage, reference)
+
+        if key not in self._fits:
+            rows = self.store.records(stage, reference)
+
+            if len(rows) < self.min_history:
+                rows = self.store.records(stage)
+
+            if len(rows) < self.min_history:
+                self._fits[key] = None
+            else:
+                self._fits[key] = fit_linear(rows, self.quantile)
+
+        return self._fits[key]
+
+
+def fit_linear(rows, q):
+    """
+    Least squares fit of: elapsed = c0 + c1 * n_items + c2 * input_GB
+
+    The input size is left out when it is unknown (all zeros), and so
+    is the number of items when it never changes, to keep the system
+    solvable.
+
+    Returns: (coefficients, q-quantile of the residuals)
+    """
+
+    xs = [[1.0, n, (b or 0) / 1e9] for n, b, _ in rows]
+    ys = [float(e) for _, _, e in rows]
+
+    n_cols = 3
+    if not any(x[2] for x in xs):
+        n_cols = 2
+        if len(set(x[1] for x in xs)) == 1:
+            n_cols = 1
+
+    coefs = None
+    while coefs is None and n_cols > 0:
+        coefs = solve_least_squares([x[:n_cols] for x in xs], ys)
+        n_cols -= 1
+
+    residuals = [y - sum(c * v for c, v in zip(coefs, x))
+                 for x, y in zip(xs, ys)]
+
+    return coefs, quantile(residuals, q)
+
+
+def solve_least_squares(xs, ys):
+    """
+    Solve the normal equations (X'X) c = X'y with Gaussian elimination.
+    Returns None if the system is singular.
+    """
+
+    k = len(xs[0])
+
+    # Form the augmented matrix [X'X | X'y]
+    a = [[sum(x[i] * x[j] for x in xs) for j in range(k)]
+         + [sum(x[i] * y for x, y in zip(xs, ys))] for i in range(k)]
+
+    for col in range(k):
+        pivot = max(range(col, k), key=lambda r: abs(a[r][col]))
+
+        if abs(a[pivot][col]) < 1e-9:
+            return None
+
+        a[col], a[pivot] = a[pivot], a[col]
+
+        for r in range(k):
+            if r != col:
+                f = a[r][col] / a[col][col]
+                a[r] = [v - f * p for v, p in zip(a[r], a[col])]
+
+    return [a[i][k] / a[i][i] for i in range(k)]
+
+
+def quantile(values, q):
+    """
+    The q-quantile (0 <= q <= 1) of the given values, with linear
+    interpolation between the closest ranks.
+    """
+
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo = int(math.floor(pos))
+    hi = int(math.ceil(pos))
+
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def parse_elapsed(elapsed):
+    """
+    Convert a sacct time string ([DD-]HH:MM:SS or MM:SS.mmm) to seconds.
+    """
+
+    days = 0
+    if '-' in elapsed:
+        days, elapsed = elapsed.split('-')
+
+    secs = 0
+    for part in elapsed.split(':'):
+        secs = secs * 60 + float(part)
+
+    return int(int(days) * 86400 + secs)
+
+
+def parsable_fields(line):
+    """
+    Split a line of 'sacct --parsable' (every field followed by a '|')
+    or '--parsable2' (fields separated by '|') output. Only the last
+    '|' is dropped, so that the empty fields at the end are kept.
+    """
+
+    line = line.rstrip('\n')
+    if line.endswith('|'):
+        line = line[:-1]
+
+    return line.split('|')
+
+
+def read_sacct(dump_file):
+    """
+    Read a 'sacct --parsable' (or --parsable2) dump. It needs at least
+    the JobID, JobName, State and Elapsed fields, with a header line.
+
+    Returns: a list of dictionaries, one for every job (the job steps,
+             e.g. 1234.batch, are left out).
+    """
+
+    jobs = []
+
+    with open(dump_file, 'r') as f:
+        header = parsable_fields(f.readline())
+
+        for line in f:
+            fields = parsable_fields(line)
+            if len(fields) != len(header):
+                continue
+
+            job = dict(zip(header, fields))
+            if '.' in job['JobID']:
+                continue
+
+            jobs.append(job)
+
+    return jobs
+
+
+def read_plan_info(plan_file):
+    """
+    Read the 'plan_info.csv' of a project in a dictionary, by job name.
+    """
+
+    with open(plan_file, 'r') as f:
+        return dict((row['job_name'], row) for row in csv.DictReader(f))
+
+
+def read_job_ids(plan_file):
+    """
+    Read the IDs of the jobs submit_jobs.py submitted for the project
+    (or batch) of a 'plan_info.csv': every '<run file>_job_ids.csv' in
+    the same metadata folder.
+
+    Returns: a set of job IDs
+    """
+
+    job_ids = set()
+
+    for ids_file in glob.glob(os.path.join(os.path.dirname(plan_file),
+                                           '*_job_ids.csv')):
+        with open(ids_file, 'r') as f:
+            job_ids.update(row['job_id'] for row in csv.DictReader(f))
+
+    return job_ids
+
+
+def join_plan(plan_file, jobs):
+    """
+    Find the jobs of sacct that belong to the project of a
+    'plan_info.csv'. The job names repeat across projects and reruns,
+    so a name alone is not enough:
+
+      - the jobs submit_jobs.py submitted for the project (see
+        read_job_ids()) get the row of their name
+      - any other job gets the row of its name only if it was submitted
+        after the row was planned, and it is the only such job of that
+        name. Otherwise (e.g. a plan_info.csv without the 'planned'
+        column, or a dump without the Submit field) it is left out.
+
+    Input:
+        jobs: [list] (job ID, job name, submit time) tuples, the submit
+              time as sacct prints it (e.g. 2017-01-01T10:00:00), or
+              None if unknown
+
+    Returns: {job ID: plan info row}
+    """
+
+    plan = read_plan_info(plan_file)
+    known_ids = read_job_ids(plan_file)
+
+    joined = {}
+    by_name = {}
+
+    for job_id, job_name, submit in jobs:
+        row = plan.get(job_name)
+        if row is None:
+            continue
+
+        # The tasks of a job array (e.g. 1234_7) share its ID
+        base_id = job_id.split('_')[0]
+
+        if base_id in known_ids:
+            joined[job_id] = row
+        elif row.get('planned') and (submit or '')[:1].isdigit() \
+                and submit >= row['planned']:
+            by_name.setdefault(job_name, {}).setdefault(
+                base_id, []).append(job_id)
+
+    names_by_id = set(row['job_name'] for row in joined.values())
+
+    for job_name, candidates in by_name.items():
+        if job_name in names_by_id or len(candidates) != 1:
+            continue
+
+        for job_id in list(candidates.values())[0]:
+            joined[job_id] = plan[job_name]
+
+    return joined
+
+
+def ingest(store, dump_file, plan_file):
+    """
+    Add the completed jobs of a sacct dump to the store, using the
+    plan info of the project they belong to (see join_plan()).
+
+    Returns: the number of jobs added
+    """
+
+    # Only the finished jobs tell the real run time
+    jobs = [job for job in read_sacct(dump_file)
+            if job['State'].startswith('COMPLETED')]
+
+    joined = join_plan(plan_file, [(job['JobID'], job['JobName'],
+                                    job.get('Submit')) for job in jobs])
+    added = 0
+
+    for job in jobs:
+        info = joined.get(job['JobID'])
+        if info is None:
+            continue
+
+        store.add(job['JobID'], job['JobName'], info['stage'],
+                  int(info['n_items']), int(info['input_bytes'] or 0),
+                  info['reference'], parse_elapsed(job['Elapsed']))
+        added += 1
+
+    store.commit()
+
+    return added
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Add the run times of finished jobs to the run time history."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'sacct_dump',
+            help="Output of 'sacct --parsable -o \
+            JobID,JobName,State,Elapsed,Submit' (Submit matches the jobs \
+            not submitted by submit_jobs.py to the plan).")
+
+    parser.add_argument(
+            'plan_info',
+            help="The 'metadata/plan_info.csv' file of the project.")
+
+    parser.add_argument(
+            '--db', default=DEFAULT_DB,
+            help='The run time history database (default: %(default)s).')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    store = RuntimeStore(args.db)
+    added = ingest(store, args.sacct_dump, args.plan_info)
+    store.close()
+
+    print('{0} job(s) added to {1}'.format(added, args.db))
+
+
+if __name__ == '__main__':
+    main()
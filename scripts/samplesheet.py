@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+"""
+Streaming reader of the samplesheets, both in the simple cellranger
+format (Lane,Sample,Index) and in the Illumina format, where the rows
+are under the '[Data]' section (after [Header], [Reads], [Settings]).
+
+The rows are read one by one into compact, typed records, and the
+lane -> samples and sample -> lanes indexes are built on the way.
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+from collections import OrderedDict
+
+import csv
+
+
+# A row of the samplesheet
+sample_record = namedtuple('sample_record', [
+                        'lane', 'sample', 'index',
+                        'project', 'reference', 'group'
+                        ])
+
+# A whole samplesheet: its records and indexes
+sheet = namedtuple('sheet', [
+                        'records',       # [sample_record]
+                        'lanes',         # sorted unique lanes (int)
+                        'samples',       # unique samples, in file order
+                        'lane_samples',  # {lane: [samples]}
+                        'sample_lanes',  # {sample: [lanes]}
+                        'sectioned'      # True for the Illumina format
+                        ])
+
+# The accepted names of every column (case insensitive)
+COLUMNS = OrderedDict([
+            ('lane', ('lane',)),
+            ('sample', ('sample', 'sample_id')),
+            ('index', ('index', 'index_id')),
+            ('project', ('sample_project', 'project')),
+            ('reference', ('reference', 'genome', 'reference_genome')),
+            ('group', ('group', 'sample_group', 'aggr_group'))
+            ])
+
+
+class SamplesheetError(ValueError):
+    pass
+
+
+def iter_rows(lines):
+    """
+    Yield the data lines of the samplesheet (header line included). For
+    the Illumina format, only the lines of the '[Data]' section are kept.
+    """
+
+    lines = iter(lines)
+    first = next(lines, '')
+
+    if not first.startswith('['):
+        # Simple format, everything is data
+        yield first
+        for line in lines:
+            yield line
+        return
+
+    in_data = first.strip().strip(',').lower() == '[data]'
+
+    for line in lines:
+        if line.startswith('['):
+            in_data = line.strip().strip(',').lower() == '[data]'
+        elif in_data and line.strip(', \r\n'):
+            yield line
+
+
+def iter_records(csv_file):
+    """
+    Yield the 'sample_record' of every row of the samplesheet, without
+    reading the whole file in memory.
+    """
+
+    with open(csv_file, 'r') as f:
+        reader = csv.reader(iter_rows(f))
+        header = [h.strip().lower() for h in next(reader, [])]
+
+        # Find the position of every known column
+        pos = {}
+        for field, names in COLUMNS.items():
+            for name in names:
+                if name in header:
+                    pos[field] = header.index(name)
+                    break
+
+        for field in ('lane', 'sample'):
+            if field not in pos:
+                raise SamplesheetError(
+                    "No '{0}' column in '{1}'".format(field, csv_file))
+
+        for line_no, row in enumerate(reader, 2):
+            if not any(row):
+                continue
+
+            values = dict((field, row[i].strip() if i < len(row) else '')
+                          for field, i in pos.items())
+
+            try:
+                lane = int(values['lane'])
+            except ValueError:
+                raise SamplesheetError("Invalid lane '{0}' ({1}, row {2})"
+                                       .format(values['lane'], csv_file,
+                                               line_no))
+
+            yield sample_record(lane, values['sample'],
+                                values.get('index', ''),
+                                values.get('project') or None,
+                                values.get('reference') or None,
+                                values.get('group') or None)
+
+
+def load_samplesheet(csv_file):
+    """
+    Read the samplesheet and build its indexes in a single pass.
+
+    Returns: a 'sheet' namedtuple
+    """
+
+    records = []
+    lane_samples = OrderedDict()
+    sample_lanes = OrderedDict()
+
+    for rec in iter_records(csv_file):
+        records.append(rec)
+
+        samples = lane_samples.setdefault(rec.lane, [])
+        if rec.sample not in samples:
+            samples.append(rec.sample)
+
+        lanes = sample_lanes.setdefault(rec.sample, [])
+        if rec.lane not in lanes:
+            lanes.append(rec.lane)
+
+    if not records:
+        raise SamplesheetError("No samples found in '{0}'".format(csv_file))
+
+    with open(csv_file, 'r') as f:
+        sectioned = f.read(1) == '['
+
+    return sheet(records, sorted(lane_samples), list(sample_lanes),
+                 lane_samples, sample_lanes, sectioned)
+
+
+def write_simple_csv(samplesheet, csv_file):
+    """
+    Write the samplesheet in the simple cellranger format
+    (Lane,Sample,Index), as the generated scripts expect it.
+    """
+
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Lane', 'Sample', 'Index'])
+
+        for rec in samplesheet.records:
+            writer.writerow([rec.lane, rec.sample, rec.index])
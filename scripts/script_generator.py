@@ -4,10 +4,13 @@ from __future__ import division
 from __future__ import print_function
 from collections import defaultdict
 from collections import namedtuple
+from collections import OrderedDict
 
 import os
+import re
 import sys
 import csv
+import json
 import stat
 import math
 import errno
@@ -16,6 +19,15 @@ import argparse
 import textwrap
 import datetime
 import itertools
+import subprocess
+
+import samplesheet
+import runtime_store
+import template_engine
+import cluster_profiles
+import resource_model
+import cluster_state
+import submit_jobs
 
 
 __version__ = '1.0.1'
@@ -26,6 +38,21 @@ proj_struct = namedtuple('project', [
                         'aggr', 'meta', 'out'
                         ])
 
+# The work a project is missing: the lanes to demultiplex, the samples
+# to count, whether to aggregate, and the lock files of killed pipelines
+project_status = namedtuple('project_status', [
+                        'lanes', 'samples', 'aggregate', 'stale_locks'
+                        ])
+
+# A project being set up: its name, folders ('project' namedtuple, None
+# until it is created), samplesheet ('sheet', see samplesheet.py),
+# normalized hiseq data path, samplesheet file name, input sizes (None
+# if not measured) and the path of the given samplesheet
+project_setup = namedtuple('project_setup', [
+                        'name', 'project', 'sheet', 'datapath',
+                        'samplesheet_name', 'sizes', 'samplesheet_loc'
+                        ])
+
 node = namedtuple('uppmax_node', [
                         'partition', 'max_cores',
                         'mkfq_per_node', 'count_per_node'
@@ -37,9 +64,51 @@ scripts_to_gen = namedtuple('scripts_to_gen', [
                         'aggr_plan'
                         ])
 
+cranger_info = namedtuple('cr_info', [
+                        'scr_name', 'bash_list', 'localcores',
+                        'localmem', 'runtime', 'template', 'partition',
+                        'array', 'items', 'mem_request', 'scratch_gb'
+                        ])
+
+# A job array: its manifest file and the lanes/samples of every task
+array_job = namedtuple('array_job', ['manifest', 'chunks'])
+
+# Input sizes (in bytes) of every lane and sample, used by the planner
+input_sizes = namedtuple('input_sizes', ['lanes', 'samples'])
+
 # Define the nametuple for node
 uppmax_node = node('core', 16, 4, 4)
 
+# The folders of the reference genomes (in 'references/')
+REFERENCE_DIRS = {'mm': 'refdata-cellranger-mm10-1.2.0',
+                  'hg': 'refdata-cellranger-hg19-1.2.0'}
+
+# The local disk (GB) of a staged reference, if it cannot be measured
+DEFAULT_REFERENCE_GB = 30
+
+# The name of a fastq file of bcl2fastq/mkfastq:
+# <sample>_S<n>_L<lane>_<read>_001.fastq[.gz]
+FASTQ_NAME = re.compile(r'^(.+)_S\d+_L\d{3}_[RI]\d_\d{3}\.fastq(\.gz)?$')
+
+# The planning job of a two-phase plan (see --two-phase), the arguments
+# it plans the count jobs with, and the run file of the count jobs
+PLAN_COUNTS_SCRIPT = 'plan_counts.sh'
+TWO_PHASE_ARGS = 'two_phase_args.json'
+COUNTS_RUN_FILE = 'run_counts.sh'
+
+# The range of the walltime scaling by the measured input of a job
+# (see load_scale())
+MIN_LOAD_SCALE = 0.5
+MAX_LOAD_SCALE = 3.0
+
+# The partition of the 'uppmax_node', used when no cluster profile is given
+uppmax_partition = cluster_profiles.partition(
+                        uppmax_node.partition, uppmax_node.max_cores, 128,
+                        runtime_store.parse_elapsed(
+                            cluster_profiles.DEFAULT_MAX_WALLTIME),
+                        1.0, cluster_profiles.DEFAULT_NODES, 0, None,
+                        cluster_profiles.DEFAULT_SCRATCH_GB)
+
 
 def interactive_input():
     #dirlist = os.listdir('.')
@@ -112,9 +181,10 @@ def arg_input():
 
     # Form the usage note text
     usage_note = [
-                "%(prog)s [-h] -d <Data_Path> -s <Samplesheet>\n",
+                "%(prog)s [-h] (-d <Data_Path> -s <Samplesheet> | -b <Batch>)\n",
                 "\t-A <Uppmax_Project> -J <Jobname> [--qos] [-r {mm,hg}]\n",
-                "\t[--aggr-norm {mapped,raw,None}] [--version]"
+                "\t[--aggr-norm {mapped,raw,None}] [--planner {fixed,size}]\n",
+                "\t[--two-phase] [--version]"
                 ]
 
     # Form the epiloge text
@@ -190,7 +260,7 @@ def arg_input():
 
     # -- Add the arguments for the project variables group --
     group_vars.add_argument(
-                    '-d', '--hiseq-datapath', required=True, metavar='',
+                    '-d', '--hiseq-datapath', metavar='',
                     dest='hiseq_datapath',
                     help='Path of the raw hiseq data (pref. absolute).')
 
@@ -200,7 +270,7 @@ def arg_input():
                     help='Choose a reference genome [mouse, human]')
 
     group_vars.add_argument(
-                    '-s', '--samplesheet', required=True, metavar='',
+                    '-s', '--samplesheet', metavar='',
                     dest='samplesheet_loc',
                     help='Path of the metadata samplesheet (pref. absolute).')
 
@@ -209,6 +279,119 @@ def arg_input():
                     default='mapped', dest='cranger_aggr_norm',
                     help='Normalization depth across the input libraries.')
 
+    group_vars.add_argument(
+                    '--planner', choices=['fixed', 'size'],
+                    default='fixed', dest='plan_strategy',
+                    help='How to split the lanes/samples among the nodes. \
+                    fixed: in samplesheet order, size: balanced by their \
+                    input size on disk.')
+
+    group_vars.add_argument(
+                    '--runtime-db', metavar='',
+                    default=runtime_store.DEFAULT_DB, dest='runtime_db',
+                    help='Run time history of past jobs, used to predict \
+                    the walltimes (default: %(default)s).')
+
+    group_vars.add_argument(
+                    '--walltime-quantile', type=float, metavar='',
+                    default=0.95, dest='walltime_quantile',
+                    help='Fraction of the past jobs that should have \
+                    finished within the requested walltime (default: 0.95).')
+
+    group_vars.add_argument(
+                    '--job-arrays', action='store_true',
+                    dest='job_arrays',
+                    help='Generate one SLURM job array per process, \
+                    instead of one script per node.')
+
+    group_vars.add_argument(
+                    '--array-throttle', type=int, metavar='',
+                    dest='array_throttle',
+                    help='Max number of array tasks running at the same \
+                    time (only with --job-arrays).')
+
+    group_vars.add_argument(
+                    '--barrier-deps', action='store_true',
+                    dest='barrier_deps',
+                    help='Make every count job wait for all the mkfastq \
+                    jobs, instead of only the ones of its lanes.')
+
+    group_vars.add_argument(
+                    '--cluster-profile', metavar='',
+                    dest='cluster_profile',
+                    help='A JSON file with the partitions of the cluster. \
+                    If given, each process runs on the partition that \
+                    finishes it the soonest.')
+
+    group_vars.add_argument(
+                    '--resource-model', metavar='',
+                    dest='resource_model',
+                    help='A JSON file with the memory model of the \
+                    processes (see resource_model.py). Default: the \
+                    built-in one.')
+
+    group_vars.add_argument(
+                    '-b', '--batch', metavar='',
+                    dest='batch',
+                    help='A file with a <Data_Path>,<Samplesheet>[,<ref>] \
+                    line for every project to plan together (instead of \
+                    -d and -s). Their count work shares the nodes.')
+
+    group_vars.add_argument(
+                    '--resume', metavar='',
+                    dest='resume',
+                    help='An existing project folder (of the same -d and \
+                    -s) to plan only the missing work for: the lanes \
+                    without fastqs, the samples without counts and the \
+                    aggregation. No job of the project should be running.')
+
+    group_vars.add_argument(
+                    '--stage-scratch', metavar='', nargs='?',
+                    const='$SNIC_TMP', dest='stage_scratch',
+                    help='Run every lane/sample on the local disk of its \
+                    node: copy its input there and copy back only its \
+                    outputs. Optionally, the local disk folder (default: \
+                    %(const)s). Lanes/samples too large for the disk run \
+                    on the shared storage as usual.')
+
+    group_vars.add_argument(
+                    '--reference-cache', choices=['warm', 'stage'],
+                    dest='reference_cache',
+                    help='Read the reference into the page cache of the \
+                    node (warm), or copy it to the local disk of the node \
+                    first (stage, in the --stage-scratch folder or \
+                    $SNIC_TMP), once per count job, before its samples \
+                    start.')
+
+    group_vars.add_argument(
+                    '--queue-state', metavar='',
+                    dest='queue_state',
+                    help="Choose the lanes/samples per node by the state \
+                    of the cluster: 'live' (from sinfo/squeue) or a \
+                    snapshot file of cluster_state.py.")
+
+    group_vars.add_argument(
+                    '--pilot', metavar='N', type=int,
+                    dest='pilot',
+                    help='Also write a pilot job: a single allocation of N \
+                    nodes that runs all the jobs as srun job steps (see \
+                    pilot_runner.py), instead of queueing every job.')
+
+    group_vars.add_argument(
+                    '--two-phase', action='store_true',
+                    dest='two_phase',
+                    help='Submit only the mkfastq jobs, and a planning job \
+                    after them, which plans (and submits) the count jobs \
+                    and the aggregation by the read count of every \
+                    sample, once its fastqs exist.')
+
+    group_vars.add_argument(
+                    '--plan-counts', metavar='',
+                    dest='plan_counts',
+                    help='The second phase of --two-phase (run by the \
+                    planning job): a project folder to plan the count \
+                    jobs of, from its fastqs.')
+
 
     # -- The rest, general arguments --
     parser.add_argument(
@@ -222,26 +405,24 @@ def arg_input():
     return args
 
 
-def run(args):
-    # Get a dictionary of args
-    args_dict = vars(args)
-
-    # Add the predefind settings for Uppmax
-    args_dict['num_cores'] = uppmax_node.max_cores
-    args_dict['partition'] = uppmax_node.partition
-
-
-    # -- Argument Checks and Corrections --
-
-    # Format Job description string properly
-    args.job_description = args.job_description.replace(' ', '_')
+def prepare_project(args, hiseq_datapath, samplesheet_loc, project_dir=None):
+    """
+    Check the paths of a (hiseq run, samplesheet) pair, read the
+    samplesheet and measure the input of the project. With an existing
+    'project_dir' (when resuming it), the samplesheet is put in its
+    metadata folder; otherwise the project's folder is created later,
+    once the plan is known (see create_project()). It exits if a path
+    is not valid.
+
+    Returns: a 'project_setup' namedtuple
+    """
 
     # Check whether the given samplesheet path is valid or not.
-    if os.path.exists(args.samplesheet_loc):
+    if os.path.exists(samplesheet_loc):
         pass
-    elif os.path.exists('scripts/' + args.samplesheet_loc):
+    elif os.path.exists('scripts/' + samplesheet_loc):
         try:
-            args.samplesheet_loc = fix_path(args.samplesheet_loc)
+            samplesheet_loc = fix_path(samplesheet_loc)
         except:
             raise
     else:
@@ -249,11 +430,11 @@ def run(args):
         exit(1)
 
     # Check whether the given hiseq data path is valid or not.
-    if os.path.exists(args.hiseq_datapath):
+    if os.path.exists(hiseq_datapath):
         pass
-    elif os.path.exists('scripts/' + args.hiseq_datapath):
+    elif os.path.exists('scripts/' + hiseq_datapath):
         try:
-            args.hiseq_datapath = fix_path(args.hiseq_datapath)
+            hiseq_datapath = fix_path(hiseq_datapath)
         except:
             raise
     else:
@@ -261,13 +442,13 @@ def run(args):
         exit(1)
 
     # Normalize the hiseq project path argument
-    args.hiseq_datapath = os.path.normpath(args.hiseq_datapath)
+    hiseq_datapath = os.path.normpath(hiseq_datapath)
 
     # Take the hiseq project name from the given hiseq path
-    hiseq_project = os.path.basename(args.hiseq_datapath)
+    hiseq_project = os.path.basename(hiseq_datapath)
 
     # Take the samplesheet name from the given path (unique for each user)
-    samplesheet_name = os.path.basename(args.samplesheet_loc)
+    samplesheet_name = os.path.basename(samplesheet_loc)
 
     # Extract the hiseq project name by keeping the last part, starting
     # from the 2nd char, and the samplesheet name without the extension
@@ -275,394 +456,2017 @@ def run(args):
     project_name = hiseq_project.split('_')[-1][1:] \
                         + '_' + samplesheet_name[:-4]
 
+    # Read the samplesheet records (and its lane/sample indexes)
+    try:
+        sheet = samplesheet.load_samplesheet(samplesheet_loc)
+    except samplesheet.SamplesheetError as e:
+        print(e)
+        exit(1)
+
+    # Use the existing project folder, if resuming it
+    project = None
+    if project_dir is not None:
+        project = existing_project_structure(project_dir)
+        place_samplesheet(project, sheet, samplesheet_loc, samplesheet_name)
+
+    # Measure the lanes/samples, to balance the work among the nodes
+    sizes = None
+    if args.plan_strategy == 'size' or os.path.exists(args.runtime_db) \
+            or args.resource_model or args.stage_scratch:
+        sizes = measure_input_sizes(hiseq_datapath, sheet)
+
+    return project_setup(project_name, project, sheet, hiseq_datapath,
+                         samplesheet_name, sizes, samplesheet_loc)
+
+
+def create_project(setup):
+    """
+    Create the folder structure of a prepared project (see
+    prepare_project()) and put the samplesheet in its metadata folder.
+
+    Returns: the 'project_setup', with its 'project' folders
+    """
+
     # Generate the project folder and its subfolders.
-    project = build_project_structure(project_name)
+    project = build_project_structure(setup.name)
     print("The project's folder structure has been created.")
 
-    # Move/Copy the samplesheet in the correct location
-    move_files(args.samplesheet_loc, project.meta, copy=True)
+    place_samplesheet(project, setup.sheet, setup.samplesheet_loc,
+                      setup.samplesheet_name)
+
+    return setup._replace(project=project)
+
+
+def place_samplesheet(project, sheet, samplesheet_loc, samplesheet_name):
+    """
+    Move/Copy the samplesheet in the project's metadata folder. The
+    scripts expect the simple (Lane,Sample,Index) format, so an Illumina
+    samplesheet is converted to it.
+    """
+
+    meta_sheet = project.meta + samplesheet_name
+
+    if sheet.sectioned:
+        samplesheet.write_simple_csv(sheet, meta_sheet)
+    elif not (os.path.exists(meta_sheet)
+              and os.path.samefile(samplesheet_loc, meta_sheet)):
+        move_files(samplesheet_loc, project.meta, copy=True)
     print('The samplesheet has been put in the appropriate location.')
 
-    # Get the samplesheet data in a dictionary
-    samplesheet_dict = csv_to_dict(args.samplesheet_loc)
 
-    # Remove duplicated Lanes
-    samplesheet_dict['Lane'] = sorted(list(set(samplesheet_dict['Lane'])))
+def load_models(args):
+    """
+    Load the run time history, the cluster profile, the memory model and
+    the state of the cluster given in the arguments (None for the ones
+    not given).
 
-    # Keep only the NAME of the samplesheet, instead of the full path.
-    args.samplesheet_loc = os.path.basename(args.samplesheet_loc)
+    Returns: (runtime model, cluster profile, resource model, cluster
+             state)
+    """
 
-    print('Calculating the plan for this project...')
-    run_plan = calculate_plan(samplesheet_dict)
+    # Load the run time history (if any) to predict the walltimes
+    runtime_model = None
+    if os.path.exists(args.runtime_db):
+        runtime_model = runtime_store.RuntimeModel(
+                            runtime_store.RuntimeStore(args.runtime_db),
+                            args.walltime_quantile)
+
+    # Load the cluster profile (if any) to choose among its partitions
+    profile = None
+    if args.cluster_profile:
+        profile = cluster_profiles.load_profile(args.cluster_profile)
+
+    # Load the memory model of the processes (if not the built-in one)
+    resources = None
+    if args.resource_model:
+        resources = resource_model.load_model(args.resource_model)
+
+    # Take (or read) the idle nodes and the queue of every partition
+    queue_state = None
+    if args.queue_state:
+        try:
+            queue_state = cluster_state.load_state(args.queue_state)
+        except (OSError, IOError, ValueError,
+                subprocess.CalledProcessError) as e:
+            print("Could not get the state of the cluster: {0}. "
+                  "Exiting...".format(e))
+            exit(1)
 
-    # if len(run_plan.aggr_plan) > 2:
-    if  run_plan.aggr_plan:
-        # Create a CSV file with the counts to be used by the 'cellranger aggr'
-        args_dict['aggr_csv_meta_file'] = create_aggr_csv(
-                                                    project,
-                                                    samplesheet_dict)
+        cluster_state.print_state(queue_state)
 
-        args_dict['aggregation_id'] = 'AGGR_' + project_name
+    return runtime_model, profile, resources, queue_state
 
-    # Get the job description in a var to use it as prefix in the for loop
-    job_descr = args.job_description
 
-    print('Creating the appropriate scripts...')
+def script_arguments(args_dict, info, job_name):
+    """
+    Form the template arguments of a script of the plan (a 'cr_info'),
+    on top of the common arguments in 'args_dict'.
 
-    scr_names = [[],[],[]]
+    Returns: a new dictionary
+    """
 
-    # Loop to generate the necessary files
-    for i, plan_pack in enumerate(run_plan):
-        for plan in list(itertools.chain(plan_pack)):
-            # Unpack the packed plan variables
-            scr_name, bash_list, loc, lom, runtime, template = plan
+    # Unpack the packed plan variables
+    scr_name, bash_list, loc, lom, runtime, template, part, \
+        array, items, mem_request, scratch_gb = info
 
-            # Get the script names for each process
-            scr_names[i].append(scr_name)
+    # Start from a copy of the common arguments, so that
+    # nothing is carried over from one script to the next
+    script_args = dict(args_dict)
 
-            # Append the SBATCH job description with
-            # the script name (no extension)
-            args.job_description = job_descr + '_' + scr_name[:-3]
+    # The SBATCH job description
+    script_args['job_description'] = job_name
 
-            # Assign the script name to be used
-            args_dict['output'] = scr_name
+    # Assign the script name to be used
+    script_args['output'] = scr_name
 
-            # Assign the slurm output name to be used
-            # sbatch_out = project.out + scr_name[:-3] + '.out'
-            sbatch_out = 'slurm_out/' + scr_name[:-3] + '.out'
-            args_dict['sbatch_output'] = sbatch_out
+    # Assign the slurm output name to be used
+    # sbatch_out = project.out + scr_name[:-3] + '.out'
+    sbatch_out = 'slurm_out/' + scr_name[:-3] + '.out'
 
-            # Add an argument for the list of lanes or samples
-            args_dict['bash_lane_or_sample_list'] = bash_list
+    # Add the job array settings (one output file per task)
+    script_args['array_spec'] = None
+    script_args['array_manifest'] = None
 
-            args_dict['cranger_localcores'] = loc
-            args_dict['cranger_localmem'] = lom
+    if array is not None:
+        sbatch_out = 'slurm_out/' + scr_name[:-3] + '_%a.out'
 
-            if args.use_qos_short:
-                args_dict['time_request'] = "15:00"
-            else:
-                args_dict['time_request'] = runtime
+        script_args['array_spec'] = array_spec(len(array.chunks),
+                                               args_dict['array_throttle'])
+        script_args['array_manifest'] = array.manifest
 
-            # Generate the script, given the arguments and the template
-            generate_script(args_dict, template=template)
+    script_args['sbatch_output'] = sbatch_out
 
-            # Move the generated script to the appropriate location
-            move_files(scr_name, project.root)
+    # Add an argument for the list of lanes or samples
+    script_args['bash_lane_or_sample_list'] = bash_list
 
+    script_args['cranger_localcores'] = loc
+    script_args['cranger_localmem'] = lom
 
-    # Create and move the script to run all the sbatches
-    run_file = build_run_file(scr_names)
-    move_files(run_file, project.root)
+    # Add the settings of the partition the script will run on
+    script_args['partition'] = part.name
+    script_args['num_cores'] = part.cores
+    script_args['ram_memory'] = part.constraint
+    script_args['sbatch_mem'] = '{0}G'.format(mem_request)
 
-    # TODO: Create link to the run_script.sh from the project root directory
-    link_name = "run_project_" + project_name
-    symlink_force(project.root + "run_project.sh", link_name)
+    # Stage the work on the node's local disk, if it fits there
+    script_args['scratch_dir'] = None
+    script_args['sbatch_tmp'] = None
 
-    # Edit the template file to generate the desired script
-    #edit_template(args)
+    if scratch_gb is not None:
+        script_args['scratch_dir'] = args_dict['stage_scratch']
 
-    print('Done.')
+    # Warm (or stage) the reference once, before the samples start
+    script_args['reference_cache'] = None
+    script_args['reference_dir'] = None
 
+    if args_dict['reference_cache'] and template == 'count_template.bash':
+        script_args['reference_cache'] = args_dict['reference_cache']
 
-# TODO!!!!!
-# TODO: Use the $SLURM_JOB_ID, to suffix the job_id <<<--- doesn't work!!!
-# TODO!!!!
+        if args_dict['reference_cache'] == 'stage':
+            script_args['reference_dir'] = args_dict['stage_scratch'] \
+                                           or '$SNIC_TMP'
+            scratch_gb = (scratch_gb or 0) + reference_scratch_gb(
+                                            args_dict['reference_genome'])
 
+    if scratch_gb is not None:
+        script_args['sbatch_tmp'] = '{0}G'.format(scratch_gb)
 
-def calculate_plan(samplesheet):
-    """
-    It gets a samplesheet (it should be in the form of a dictionary),
-    and it calculates how many scripts should be generated and some
-    details they should have, based on an earlier initialized global
-    namedtuple variable named 'uppmax_node'.
+    if args_dict['use_qos_short']:
+        script_args['time_request'] = "15:00"
+    else:
+        script_args['time_request'] = runtime
 
-    It returns a namedtuple with two lists, each contains a number of lists.
-    Each inner list keeps three strings: the output script name, a string
-    with space sep lanes or samples (BASH style list), and the name of the
-    template to be used for the script's construction.
-    """
+    return script_args
 
-    mpn = uppmax_node.mkfq_per_node
-    cpn = uppmax_node.count_per_node
 
-    # Calculate the number of mkfastq scripts to be generated
-    mkfastq_scripts = len(samplesheet['Lane']) / mpn
-    mkfastq_scripts = int(math.ceil(mkfastq_scripts))
+def run(args):
+    # Get a dictionary of args
+    args_dict = vars(args)
 
-    # Calculate the number of count scripts to be generated
-    count_scripts = len(samplesheet['Sample']) / cpn
-    count_scripts = int(math.ceil(count_scripts))
 
-    # Initialize the predefind namedtuple with 2/3 empty lists
-    # if count_scripts == 1:
-    #     plan = scripts_to_gen([], [], None)
-    # else:
-    plan = scripts_to_gen([], [], [])
+    # -- Argument Checks and Corrections --
 
-    cranger_info = namedtuple('cr_info', [
-                                'scr_name', 'bash_list', 'localcores',
-                                'localmem', 'runtime', 'template'
-                                ])
+    # Format Job description string properly
+    args.job_description = args.job_description.replace(' ', '_')
 
-    # Generate the names for the mkfastq scripts
-    for i in range(mkfastq_scripts):
-        # Form the script name
-        script_name = 'mkfastq_' + str(i+1) + '.sh'
+    if args.pilot is not None and (args.pilot < 1 or args.job_arrays):
+        print("A pilot job needs at least one node, and no job arrays. "
+              "Exiting...")
+        exit(1)
 
-        # Get the lanes corespond to each script (in BASH style string list)
-        lanes = samplesheet['Lane'][i * mpn: (i+1) * mpn]
-        lanes_str = " ".join(map(str, lanes))
+    # The second phase of a two-phase plan, run by its planning job
+    if args.plan_counts:
+        run_count_phase(args)
+        return
 
-        # Get the cores per lane (to be added to the $LOCALC var)
-        cores_per_lane = uppmax_node.max_cores // len(lanes)
+    if args.two_phase and (args.batch or args.resume or args.pilot):
+        print("A two-phase plan is made for a single new project, without "
+              "a pilot job. Exiting...")
+        exit(1)
+
+    # Plan several projects together
+    if args.batch:
+        if args.hiseq_datapath or args.samplesheet_loc:
+            print("Give either a batch file (-b), or -d and -s. Exiting...")
+            exit(1)
 
-        mem_per_lane = cores_per_lane * 7
+        if args.resume:
+            print("A batch of projects cannot be resumed. Exiting...")
+            exit(1)
 
-        runtime = calc_run_time(len(lanes), 'mkfastq_runtime')
+        run_batch(args)
+        return
 
-        mkfastq_info = cranger_info(script_name, lanes_str,
-                                    cores_per_lane, mem_per_lane,
-                                    runtime, 'mkfastq_template.bash')
+    # Plan only the work an existing project is missing
+    if args.resume:
+        run_resume(args)
+        return
 
-        plan.mkfastq_plan.append(mkfastq_info)
+    if not (args.hiseq_datapath and args.samplesheet_loc):
+        print("Both the hiseq data path (-d) and the samplesheet (-s) "
+              "are needed. Exiting...")
+        exit(1)
 
+    setup = prepare_project(args, args.hiseq_datapath, args.samplesheet_loc)
+    project_name, sheet, sizes = setup.name, setup.sheet, setup.sizes
 
-    # Generate the names for the count scripts
-    for i in range(count_scripts):
-        # Form the script name
-        script_name = 'count_' + str(i+1) + '.sh'
+    # The scripts get the normalized hiseq path, and only the NAME of
+    # the samplesheet, instead of the full path.
+    args.hiseq_datapath = setup.datapath
+    args.samplesheet_loc = setup.samplesheet_name
 
-        # Get the samples corespond to each script (in BASH style string list)
-        samples = samplesheet['Sample'][i * cpn: (i+1) * cpn]
-        samples_str = " ".join(map(str, samples))
+    runtime_model, profile, resources, queue_state = load_models(args)
 
-        cores_per_sample = uppmax_node.max_cores // len(samples)
-        mem_per_sample = cores_per_sample * 7
+    print('Calculating the plan for this project...')
+    run_plan = calculate_plan(sheet, sizes, args.plan_strategy,
+                              runtime_model, args.reference_genome, profile,
+                              resources=resources,
+                              stage_scratch=bool(args.stage_scratch),
+                              queue_state=queue_state)
 
-        runtime = calc_run_time(len(samples), 'count_runtime')
+    # Create the project's folder only now that the plan is possible
+    setup = create_project(setup)
+    project = setup.project
 
-        count_info = cranger_info(script_name, samples_str,
-                                cores_per_sample, mem_per_sample,
-                                runtime, 'count_template.bash')
+    # Plan only the mkfastq jobs for now; the planning job plans the
+    # rest once the fastqs exist (see run_count_phase())
+    planner = None
+    if args.two_phase:
+        planner = plan_counts_info(run_plan, sheet)
+        run_plan = run_plan._replace(count_plan=[], aggr_plan=[])
 
-        plan.count_plan.append(count_info)
+        save_two_phase_args(project, args)
 
+        args_dict['project_dir'] = project.root
+        args_dict['plan_job_name'] = args.job_description
 
-    if len(samplesheet['Sample']) != 1:
-        cores = uppmax_node.max_cores
-        mem = uppmax_node.max_cores * 7
+    if profile:
+        print_plan_layout(run_plan)
 
-        runtime = calc_run_time(len(samplesheet['Sample']),
-                                'aggr_runtime')
+    if sizes is not None:
+        print_plan_balance(run_plan, sizes)
 
-        aggr_info = cranger_info('aggregation.sh', None,
-                                cores, mem, runtime,
-                                'aggr_template.bash')
+    # Turn every mkfastq/count process into a single job array
+    if args.job_arrays:
+        run_plan = array_plan(run_plan, project)
 
-        plan.aggr_plan.append(aggr_info)
+    # The planning job takes the place of the count jobs
+    if planner is not None:
+        run_plan = run_plan._replace(count_plan=[planner])
 
-    return plan
+    # Make every job wait only for the jobs that produce its input
+    # (a job array waits for the whole array of the previous process)
+    dependencies = None
+    if not (args.barrier_deps or args.job_arrays):
+        dependencies = plan_dependencies(run_plan, sheet.sample_lanes)
+        print_critical_path(run_plan, dependencies)
 
+    # if len(run_plan.aggr_plan) > 2:
+    if  run_plan.aggr_plan:
+        # Create a CSV file with the counts to be used by the 'cellranger aggr'
+        args_dict['aggr_csv_meta_file'] = create_aggr_csv(project, sheet)
 
-def calc_run_time(iters, time_tag):
-    if time_tag == 'mkfastq_runtime':
-        secs = 486 * iters + 3771 #+ 7200
+        args_dict['aggregation_id'] = 'AGGR_' + project_name
 
-    elif time_tag == 'count_runtime':
-        secs = 9033 * iters + 139080 #+ 14400
+    # Get the job description in a var to use it as prefix in the for loop
+    job_descr = args.job_description
 
-    elif time_tag == 'aggr_runtime':
-        secs = 1098 * iters + 11282 #+ 7200
+    print('Creating the appropriate scripts...')
 
-    else:
-        print('The time tag given is incorrect.\nExiting...')
-        exit(4)
+    scr_names = [[],[],[]]
 
-    # Transform the seconds into datetime ([d days, ]HH:MM:SS)
-    uptime = str(datetime.timedelta(seconds=secs))
+    # Keep what each script does, to learn its run time when it is done
+    plan_info = []
 
-    # Return the datetime if there are no days (i.e. HH:MM:SS)
-    if len(uptime.split()) == 1:
-        return uptime
+    # The (template, output, arguments) of every script to generate
+    scripts = []
 
-    # If there are days, return the datetime appropriately (i.e. d-HH:MM:SS)
-    return uptime.split()[0] + '-' + uptime.split()[-1]
+    # Loop to form the arguments of the necessary files
+    for i, plan_pack in enumerate(run_plan):
+        for plan in list(itertools.chain(plan_pack)):
+            # Get the script names for each process
+            scr_names[i].append(plan.scr_name)
 
+            # Append the SBATCH job description with
+            # the script name (no extension)
+            script_args = script_arguments(
+                            args_dict, plan,
+                            job_descr + '_' + plan.scr_name[:-3])
 
+            # The planning job is not a count job to learn from
+            if plan is not planner:
+                plan_info.append(plan_info_row(
+                                    script_args['job_description'], i,
+                                    plan, sizes, args.reference_genome))
 
-def create_aggr_csv(project, samplesheet, fieldnames=None):
-    """
-    It geberates a .csv file that contains the appropriate information
-    about the 'count' output folders (named after the sample names in
-    the samplesheet), needed to run the aggregation process.
+            # Generate it right in the project's folder
+            scripts.append((plan.template, project.root + plan.scr_name,
+                            script_args))
 
-    Return: Generated file's name
-    """
+    # Generate the scripts, given their arguments and templates
+    generate_scripts(scripts)
 
-    meta_csv = project.meta + 'aggregation_meta.csv'
-    with open(meta_csv, 'w') as f:
-        if fieldnames is None:
-            fieldnames = ['library_id', 'molecule_h5']
+    write_plan_info(project, plan_info)
 
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+    # Create and move the script to run all the sbatches
+    run_file = build_run_file(scr_names, dependencies=dependencies)
+    move_files(run_file, project.root)
 
-        # writer.writeheader() -> added on Python 2.7; it won't work on 2.6
-        writer.writerow(dict((fn, fn) for fn in writer.fieldnames))
+    # The same jobs, for submit_jobs.py (and the pilot job, if any)
+    write_job_graph(project, run_plan, dependencies, run_file)
 
-        for sample in samplesheet['Sample']:
-            # Form the path to the 'molecule_h5' file
-            mol_path = '../counts/' + sample + '/outs/molecule_info.h5'
+    if args.pilot:
+        write_pilot_script(project, run_plan, dependencies, run_file,
+                           args_dict, job_descr, args.pilot)
 
-            # Write the row to the .csv output file
-            writer.writerow({
-                        fieldnames[0]: sample,
-                        fieldnames[1]: mol_path
-                        })
+    # TODO: Create link to the run_script.sh from the project root directory
+    link_name = "run_project_" + project_name
+    symlink_force(project.root + "run_project.sh", link_name)
 
-    return os.path.basename(meta_csv)
+    # Edit the template file to generate the desired script
+    #edit_template(args)
 
+    if planner is not None:
+        print('The count jobs will be planned by {0}{1}, after the mkfastq '
+              'jobs.'.format(project.root, PLAN_COUNTS_SCRIPT))
 
-def generate_script(args_dict, template):
-    """
-    This function creates a new file based on a (given) template,
-    placing the appropriate given arguments in the right place.
+    print('Done.')
 
-    Areas that need to be edited on the template script should
-    contain a '?' at the beginning of the line, followed by a
-    string that matches the given argument keys.
 
-    This function will delete this line, after either appending
-    the next line with the right value (if the value was given),
-    or deleting the next line too (if no value was given or if
-    no such a key was found).
+def plan_counts_info(plan, sheet):
+    """
+    The planning job of a two-phase plan (see run_count_phase()): a
+    single core job that waits for the mkfastq jobs of all the samples,
+    on the partition of the count jobs.
 
-    template: { 'mkfastq', 'count' }
+    Returns: a 'cr_info' namedtuple
     """
 
-    # Get a set of the given keys
-    args_keys = set(args_dict.keys())
+    part = plan.count_plan[0].partition if plan.count_plan \
+        else uppmax_partition
+    part = part._replace(cores=1)
 
-    if not os.path.exists(template):
-        # Form the path that the template is expected to be.
-        temp = fix_path(template)
+    return cranger_info(PLAN_COUNTS_SCRIPT, None, 1, 2, '1:00:00',
+                        'plan_counts_template.bash', part, None,
+                        sheet.samples, 4, None)
 
-        if not temp:
-            print("Could not find the template file \
-                    '{0}' ".format(template), end='')
 
-            print("in the scripts folder. Exiting...")
-            exit(1)
-        else:
-            template = temp
+def save_two_phase_args(project, args):
+    """
+    Keep the arguments of the first phase in the project's metadata
+    folder, for the planning job to plan the count jobs with.
+    """
 
-    # Avoid replacing/losing the template file...
-    # if args_dict['output'] == template \
-    #     or args_dict['output'] == "mkfastq_template.bash" \
-    #     or args_dict['output'] == "count_template.bash":
-    #
-    #     print("The output name should NOT be \
-    #             the same as the template script.")
-    #     exit(3)
+    with open(project.meta + TWO_PHASE_ARGS, 'w') as f:
+        json.dump(vars(args), f, indent=2, sort_keys=True)
+        f.write('\n')
 
-    # Open the template script in read mode
-    with open(template, 'r') as template:
-        template_buf = iter(template.readlines())
 
-    # Open/Create the output file in write mode.
-    with open(args_dict['output'], 'w') as output:
-        for line in template_buf:
-            # Lines starting with '?' in the template, indicate
-            # positions where the argument keys can be found
-            if line.startswith('?'):
-                # Gets the string after '?' in a list
-                linesplit = line[1:].split()
+def run_count_phase(args):
+    """
+    The second phase of a two-phase plan, run by its planning job once
+    the mkfastq jobs are done: measure every sample from its fastqs (see
+    measure_fastq_sizes()), plan the count jobs balanced by it, and the
+    aggregation, with the arguments of the first phase, and write them
+    in 'run_counts.sh'. Inside a SLURM job they are also submitted (see
+    submit_jobs.py). Running it again only submits the jobs not
+    submitted yet.
+    """
 
-                # Get the matches of the key set and the linesplit as list
-                arg_match = list(args_keys.intersection(linesplit))
+    if not os.path.isdir(args.plan_counts):
+        print("The project folder you provided is not valid. Exiting...")
+        exit(1)
 
-                # Check whether only one match found
-                if arg_match and len(arg_match) == 1:
-                    # Get the value of the matched key
-                    arg_val = args_dict[arg_match[0]]
+    project = existing_project_structure(args.plan_counts)
 
-                    # If the value is None, line should be omitted
-                    if arg_val is None:
-                        line = ''
-                        next(template_buf, None)
+    if not os.path.exists(project.meta + TWO_PHASE_ARGS):
+        print("'{0}' was not planned with --two-phase. Exiting...".format(
+                project.root))
+        exit(1)
 
-                    else:
-                        # Get the next line and strip any extra whitespace
-                        next_line = next(template_buf).strip()
+    if not os.path.exists(project.root + COUNTS_RUN_FILE):
+        plan_count_phase(project)
+    else:
+        print('The count jobs are already planned in {0}{1}.'.format(
+                project.root, COUNTS_RUN_FILE))
 
-                        # Is the last char of the line a quotation mark or a '='?
-                        if next_line[-1:] in ('"', "'"):
-                            # Place the argument value between quotation marks
-                            line = next_line[:-1] \
-                                    + str(arg_val) \
-                                    + next_line[-1:] + '\n'
+    if not os.environ.get('SLURM_JOB_ID'):
+        print('Run {0}{1} (or scripts/submit_jobs.py {0} --run-file {1}) '
+              'to submit the count jobs.'.format(project.root,
+                                                 COUNTS_RUN_FILE))
+        return
 
-                        elif next_line[-1:] is '=':
-                            # Place the argument value next to '=' without space
-                            line = next_line + str(arg_val) + '\n'
-                        else:
-                            # Place the argument value at the end of the line
-                            line = next_line + ' ' + str(arg_val) + '\n'
+    graph_csv = submit_jobs.graph_file(project.root, COUNTS_RUN_FILE)
+    ids_csv = submit_jobs.ids_file(project.root, COUNTS_RUN_FILE)
+    ids = submit_jobs.read_job_ids(ids_csv)
 
-                else:
-                    # If more or None matches found line should be omitted
-                    line = ''
-                    next(template_buf, None)
+    print('Submitting the count jobs...')
+    try:
+        submit_jobs.submit_jobs(project.root,
+                                submit_jobs.read_job_graph(graph_csv),
+                                ids, ids_csv)
+    except submit_jobs.SubmitError as e:
+        print(e)
+        print('Run scripts/submit_jobs.py {0} --run-file {1} to submit the '
+              'rest.'.format(project.root, COUNTS_RUN_FILE))
+        exit(1)
 
-            # Write the edited template file into the final script file
-            output.write(line)
+    print('Done.')
 
 
-def csv_to_dict(csv_file):
+def plan_count_phase(project):
     """
-    Get the content of a csv file as a list dictionary.
-
-    i.e.
-        print(dict['column1'])
-        >>> ['Bob', 'Rob', 'John']
+    Plan the count jobs and the aggregation of a two-phase project (see
+    run_count_phase()), and generate their scripts and run file.
     """
 
-    file_columns = defaultdict(list)
+    # The arguments of the first phase
+    with open(project.meta + TWO_PHASE_ARGS, 'r') as f:
+        args = argparse.Namespace(**json.load(f))
 
-    with open(csv_file, 'r') as f:
-        sheet = csv.DictReader(f)
+    args_dict = vars(args)
 
-        for row in sheet:
-            for key, val in row.items():
-                file_columns[key].append(val)
+    try:
+        sheet = samplesheet.load_samplesheet(project.meta
+                                             + args.samplesheet_loc)
+    except samplesheet.SamplesheetError as e:
+        print(e)
+        exit(1)
 
-    return file_columns
+    # The flowcell part of the fastq folders (see the count template),
+    # and the name of the project, as in prepare_project()
+    flowcell = os.path.basename(args.hiseq_datapath).split('_')[-1][1:]
+    aggregation_id = 'AGGR_' + flowcell + '_' + args.samplesheet_loc[:-4]
 
+    sample_sizes, measure = measure_fastq_sizes(project, sheet, flowcell)
 
-def build_project_structure(project_name):
-    """
-    This function creates the folder structure to support a new project.
-    """
+    if not any(sample_sizes.values()):
+        print("No fastqs found in {0}. Did the mkfastq jobs finish? "
+              "Exiting...".format(project.fastqs))
+        exit(1)
 
-    # Form the name of the project folder to be created inside 'projects'
-    project_dir = 'projects/' + 'project_' + project_name
+    missing = [sample for sample in sheet.samples
+               if not sample_sizes.get(sample)]
+    if missing:
+        print('  No fastqs found for: ' + ' '.join(missing))
 
-    # Check if a folder with the given name already exists
-    # If exists, try suffixing with an ascending number
-    count = itertools.count(1)
+    sizes = input_sizes({}, sample_sizes)
 
-    while os.path.exists(project_dir):
-        print("A folder with the given project name, already exists.")
-        project_dir = '_'.join(project_dir.split('_')[:7]) \
-                        + '_' + str(count.next())
+    runtime_model, profile, resources, queue_state = load_models(args)
 
-        print("Trying: " + project_dir)
+    print('Planning the count jobs by the {0} of every sample...'.format(
+            measure))
+    run_plan = calculate_plan(sheet._replace(lanes=[]), sizes, 'size',
+                              runtime_model, args.reference_genome, profile,
+                              resources=resources,
+                              stage_scratch=bool(args.stage_scratch),
+                              queue_state=queue_state, scale_by_load=True)
 
-    # Form the name of the necessary folders in the project dir
-    fastq_dir = project_dir + '/fastqs/'
-    count_dir = project_dir + '/counts/'
-    meta_dir = project_dir + '/metadata/'
-    out_dir = project_dir + '/slurm_out/'
-    aggr_dir = project_dir + '/aggregation/'
+    if profile:
+        print_plan_layout(run_plan)
+
+    print_plan_balance(run_plan, sizes)
+
+    if args.job_arrays:
+        run_plan = array_plan(run_plan, project)
+
+    dependencies = None
+    if not (args.barrier_deps or args.job_arrays):
+        dependencies = plan_dependencies(run_plan, sheet.sample_lanes)
+
+    if run_plan.aggr_plan:
+        args_dict['aggr_csv_meta_file'] = create_aggr_csv(project, sheet)
+        args_dict['aggregation_id'] = aggregation_id
+
+    print('Creating the appropriate scripts...')
+
+    scr_names = [[],[],[]]
+    plan_info = []
+    scripts = []
+
+    for i, plan_pack in enumerate(run_plan):
+        for plan in plan_pack:
+            scr_names[i].append(plan.scr_name)
+
+            script_args = script_arguments(
+                            args_dict, plan,
+                            args.job_description + '_' + plan.scr_name[:-3])
+
+            plan_info.append(plan_info_row(script_args['job_description'],
+                                           i, plan, sizes,
+                                           args.reference_genome))
+
+            scripts.append((plan.template, project.root + plan.scr_name,
+                            script_args))
+
+    generate_scripts(scripts)
+
+    # Keep the rows of the mkfastq jobs, for the run time history
+    plan_file = project.meta + 'plan_info.csv'
+    if os.path.exists(plan_file):
+        with open(plan_file, 'r') as f:
+            plan_info = list(csv.DictReader(f)) + plan_info
+
+    write_plan_info(project, plan_info)
+
+    run_file = build_run_file(scr_names, dependencies=dependencies,
+                              output_name=COUNTS_RUN_FILE)
+    move_files(run_file, project.root)
+
+    write_job_graph(project, run_plan, dependencies, run_file)
+
+
+def read_batch_file(batch_file):
+    """
+    Read the projects of a batch: a line for every project, with its
+    hiseq data path, its samplesheet and (optionally) its reference
+    genome, separated by commas. Empty lines and lines starting with
+    '#' are skipped.
+
+    Returns: a list of (data path, samplesheet, reference or None)
+    """
+
+    entries = []
+
+    with open(batch_file, 'r') as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() \
+                    or row[0].strip().startswith('#'):
+                continue
+
+            fields = [field.strip() for field in row] + [None]
+
+            if len(fields) < 3 or fields[2] not in (None, '', 'mm', 'hg'):
+                print("Invalid line in the batch file: " + ','.join(row))
+                exit(1)
+
+            entries.append((fields[0], fields[1], fields[2] or None))
+
+    return entries
+
+
+def run_batch(args):
+    """
+    Plan the projects of a batch file together (see calculate_batch_plan()).
+
+    Every project gets its usual folder, with its mkfastq scripts, its
+    aggregation and a count script for its samples on every shared node.
+    The shared count jobs, the plan info of the batch and the run file
+    that submits all the jobs go to a batch folder ('projects/batch_<J>').
+    """
+
+    args_dict = vars(args)
+
+    if args.job_arrays:
+        print("Job arrays are not supported in batch mode. Exiting...")
+        exit(1)
+
+    entries = read_batch_file(args.batch)
+    if not entries:
+        print("No projects found in the batch file. Exiting...")
+        exit(1)
+
+    setups = [prepare_project(args, datapath, sheet_loc)
+              for datapath, sheet_loc, _ in entries]
+    refs = [ref or args.reference_genome for _, _, ref in entries]
+
+    runtime_model, profile, resources, queue_state = load_models(args)
+
+    print('Calculating the plan for {0} projects...'.format(len(setups)))
+    project_plans, count_plan, own_nodes = calculate_batch_plan(
+                                setups, refs, args.plan_strategy,
+                                runtime_model, profile, resources=resources,
+                                stage_scratch=bool(args.stage_scratch),
+                                queue_state=queue_state)
+
+    # Create the folders only now that the plan is possible
+    setups = [create_project(setup) for setup in setups]
+    batch = build_batch_structure(args.job_description)
+
+    print('  count: {0} samples on {1} shared node(s), instead of {2} '
+          'with separate nodes per project'.format(
+            sum(len(info.items) for info in count_plan), len(count_plan),
+            own_nodes))
+
+    # The path of a project's script, relative to the batch folder
+    def rel(p, scr_name):
+        return '../' + os.path.basename(setups[p].project.root.rstrip('/')) \
+            + '/' + scr_name
+
+    # The whole batch as a single plan, with (project index, lane/sample)
+    # items, to form the dependencies between the jobs
+    combined = scripts_to_gen(
+        [info._replace(scr_name=rel(p, info.scr_name),
+                       items=[(p, i) for i in info.items])
+         for p, plan in enumerate(project_plans)
+         for info in plan.mkfastq_plan],
+        count_plan,
+        [info._replace(scr_name=rel(p, info.scr_name),
+                       items=[(p, i) for i in info.items])
+         for p, plan in enumerate(project_plans)
+         for info in plan.aggr_plan])
+
+    dependencies = None
+    if not args.barrier_deps:
+        sample_lanes = dict(((p, sample), [(p, lane) for lane in lanes])
+                            for p, setup in enumerate(setups)
+                            for sample, lanes
+                            in setup.sheet.sample_lanes.items())
+
+        dependencies = plan_dependencies(combined, sample_lanes)
+        print_critical_path(combined, dependencies)
+
+    job_descr = args.job_description
+
+    print('Creating the appropriate scripts...')
+
+    scripts = []
+
+    for p, (setup, plan) in enumerate(zip(setups, project_plans)):
+        project = setup.project
+
+        # The arguments every script of the project shares
+        p_args = dict(args_dict)
+        p_args['hiseq_datapath'] = setup.datapath
+        p_args['samplesheet_loc'] = setup.samplesheet_name
+        p_args['reference_genome'] = refs[p]
+
+        if plan.aggr_plan:
+            p_args['aggr_csv_meta_file'] = create_aggr_csv(project,
+                                                           setup.sheet)
+            p_args['aggregation_id'] = 'AGGR_' + setup.name
+
+        plan_info = []
+
+        for i, stage in ((0, plan.mkfastq_plan), (2, plan.aggr_plan)):
+            for info in stage:
+                script_args = script_arguments(
+                                p_args, info, '_'.join([job_descr, setup.name,
+                                                        info.scr_name[:-3]]))
+
+                plan_info.append(plan_info_row(script_args['job_description'],
+                                               i, info, setup.sizes, refs[p]))
+
+                scripts.append((info.template, project.root + info.scr_name,
+                                script_args))
+
+        # The count script of the project's samples on every shared node
+        for info in count_plan:
+            samples = [sample for q, sample in info.items if q == p]
+            if not samples:
+                continue
+
+            member = info._replace(scr_name='shared_' + info.scr_name,
+                                   bash_list=' '.join(samples),
+                                   items=samples)
+
+            script_args = script_arguments(
+                            p_args, member,
+                            job_descr + '_' + info.scr_name[:-3])
+
+            scripts.append((member.template, project.root + member.scr_name,
+                            script_args))
+
+        write_plan_info(project, plan_info)
+
+    # The shared count jobs, in the batch folder
+    batch_info = []
+
+    for info in count_plan:
+        projects = []
+        for p, _ in info.items:
+            if p not in projects:
+                projects.append(p)
+
+        script_args = script_arguments(args_dict, info,
+                                       job_descr + '_' + info.scr_name[:-3])
+        script_args['member_scripts'] = ' '.join(
+                        rel(p, 'shared_' + info.scr_name) for p in projects)
+
+        scripts.append(('batch_count_template.bash',
+                        batch.root + info.scr_name, script_args))
+
+        input_bytes = sum(setups[p].sizes.samples.get(sample, 0)
+                          for p, sample in info.items
+                          if setups[p].sizes is not None)
+
+        batch_info.append({'job_name': script_args['job_description'],
+                           'stage': 'count', 'n_items': len(info.items),
+                           'input_bytes': input_bytes,
+                           'reference': refs[projects[0]]
+                           if len(set(refs[p] for p in projects)) == 1
+                           else ''})
+
+    # Generate the scripts, given their arguments and templates
+    generate_scripts(scripts)
+
+    write_plan_info(batch, batch_info)
+
+    # Create and move the script to run all the sbatches
+    scr_names = [[info.scr_name for info in stage] for stage in combined]
+    run_file = build_run_file(scr_names, output_name='run_batch.sh',
+                              dependencies=dependencies)
+    move_files(run_file, batch.root)
+
+    write_job_graph(batch, combined, dependencies, run_file)
+
+    if args.pilot:
+        write_pilot_script(batch, combined, dependencies, run_file,
+                           args_dict, job_descr, args.pilot)
+
+    link_name = "run_" + os.path.basename(batch.root.rstrip("/"))
+    symlink_force(batch.root + "run_batch.sh", link_name)
+
+    print('Done.')
+
+
+def run_resume(args):
+    """
+    Plan only the work an existing project is missing (see
+    inspect_project()), and generate its scripts and a new run file
+    ('resume_<N>.sh') in the project's folder. The scripts get a
+    'resume_<N>_' prefix, so that the scripts of the earlier runs are
+    kept as they were, and the job names an '_r<N>' suffix, so that the
+    run times of the new jobs are not mixed up with the ones of the
+    first run.
+    """
+
+    args_dict = vars(args)
+
+    if not os.path.isdir(args.resume):
+        print("The project folder you provided is not valid. Exiting...")
+        exit(1)
+
+    setup = prepare_project(args, args.hiseq_datapath, args.samplesheet_loc,
+                            project_dir=args.resume)
+    project, sheet, sizes = setup.project, setup.sheet, setup.sizes
+
+    args.hiseq_datapath = setup.datapath
+    args.samplesheet_loc = setup.samplesheet_name
+
+    # The flowcell part of the fastq folders (see the count template)
+    flowcell = os.path.basename(setup.datapath).split('_')[-1][1:]
+    aggregation_id = 'AGGR_' + setup.name
+
+    status = inspect_project(project, sheet, flowcell, aggregation_id)
+
+    print('  {0}/{1} lane(s) to demultiplex, {2}/{3} sample(s) to count, '
+          'aggregation {4}'.format(
+            len(status.lanes), len(sheet.lanes), len(status.samples),
+            len(sheet.samples), 'to run' if status.aggregate else 'done'))
+
+    # Let cellranger resume the pipelines of the killed jobs
+    for lock in status.stale_locks:
+        print('  Removing the stale lock ' + lock)
+        os.remove(lock)
+
+    if not (status.lanes or status.samples or status.aggregate):
+        print('Nothing left to do.')
+        return
+
+    runtime_model, profile, resources, queue_state = load_models(args)
+
+    print('Calculating the plan for the remaining work...')
+    remaining = sheet._replace(lanes=status.lanes, samples=status.samples)
+
+    run_plan = calculate_plan(remaining, sizes, args.plan_strategy,
+                              runtime_model, args.reference_genome, profile,
+                              resources=resources,
+                              stage_scratch=bool(args.stage_scratch),
+                              queue_state=queue_state)
+
+    # The aggregation always takes all the samples
+    aggr_plan = []
+    if status.aggregate:
+        aggr_plan = calculate_plan(sheet, sizes, args.plan_strategy,
+                                   runtime_model, args.reference_genome,
+                                   profile, resources=resources,
+                                   stage_scratch=bool(args.stage_scratch),
+                                   queue_state=queue_state).aggr_plan
+
+    run_plan = run_plan._replace(aggr_plan=aggr_plan)
+
+    # The first free resume number
+    resume_no = 1
+    while os.path.exists(project.root + 'resume_{0}.sh'.format(resume_no)):
+        resume_no += 1
+
+    prefix = 'resume_{0}_'.format(resume_no)
+
+    # Turn every mkfastq/count process into a single job array
+    if args.job_arrays:
+        run_plan = array_plan(run_plan, project, prefix)
+    else:
+        run_plan = prefix_plan(run_plan, prefix)
+
+    dependencies = None
+    if not (args.barrier_deps or args.job_arrays):
+        dependencies = plan_dependencies(run_plan, sheet.sample_lanes)
+        print_critical_path(run_plan, dependencies)
+
+    if run_plan.aggr_plan:
+        args_dict['aggr_csv_meta_file'] = create_aggr_csv(project, sheet)
+        args_dict['aggregation_id'] = aggregation_id
+
+    job_descr = '{0}_r{1}'.format(args.job_description, resume_no)
+
+    print('Creating the appropriate scripts...')
+
+    scr_names = [[],[],[]]
+    plan_info = []
+    scripts = []
+
+    for i, plan_pack in enumerate(run_plan):
+        for plan in plan_pack:
+            scr_names[i].append(plan.scr_name)
+
+            # The job names keep the script names of the first run
+            script_args = script_arguments(
+                            args_dict, plan,
+                            job_descr + '_' + plan.scr_name[len(prefix):-3])
+
+            plan_info.append(plan_info_row(script_args['job_description'],
+                                           i, plan, sizes,
+                                           args.reference_genome))
+
+            scripts.append((plan.template, project.root + plan.scr_name,
+                            script_args))
+
+    generate_scripts(scripts)
+
+    # Keep the rows of the earlier runs, for the run time history
+    plan_file = project.meta + 'plan_info.csv'
+    if os.path.exists(plan_file):
+        with open(plan_file, 'r') as f:
+            plan_info = list(csv.DictReader(f)) + plan_info
+
+    write_plan_info(project, plan_info)
+
+    run_file = build_run_file(scr_names, dependencies=dependencies,
+                              output_name='resume_{0}.sh'.format(resume_no))
+    move_files(run_file, project.root)
+
+    write_job_graph(project, run_plan, dependencies, run_file)
+
+    if args.pilot:
+        write_pilot_script(project, run_plan, dependencies, run_file,
+                           args_dict, job_descr, args.pilot)
+
+    print('Run {0}resume_{1}.sh to submit the remaining jobs.'.format(
+            project.root, resume_no))
+    print('Done.')
+
+
+def inspect_project(project, sheet, flowcell, aggregation_id):
+    """
+    Inspect the folder of a project, to find the work it is missing:
+
+        lanes     - the lanes whose fastqs are missing, and which have
+                    samples still to count
+        samples   - the samples without a 'molecule_info.h5'
+        aggregate - whether the aggregation has to run (again)
+
+    The pipeline folders of the jobs that were killed keep cellranger's
+    '_lock' file, which stops it from resuming them; they are listed in
+    'stale_locks'.
+
+    Returns: a 'project_status' namedtuple
+    """
+
+    stale_locks = []
+
+    def done(path, output):
+        lock = os.path.join(path, '_lock')
+        finished = os.path.exists(os.path.join(path, 'outs', output))
+
+        if os.path.exists(lock) and not finished:
+            stale_locks.append(lock)
+
+        return finished and not os.path.exists(lock)
+
+    samples = [sample for sample in sheet.samples
+               if not done(project.counts + sample, 'molecule_info.h5')]
+
+    lanes = [lane for lane in sheet.lanes
+             if set(sheet.lane_samples.get(lane, [])).intersection(samples)
+             and not done('{0}{1}_{2}'.format(project.fastqs, flowcell, lane),
+                          'fastq_path')]
+
+    aggregate = len(sheet.samples) != 1 and \
+        (bool(samples) or not done(project.aggr + aggregation_id, ''))
+
+    return project_status(lanes, samples, aggregate, stale_locks)
+
+
+# TODO!!!!!
+# TODO: Use the $SLURM_JOB_ID, to suffix the job_id <<<--- doesn't work!!!
+# TODO!!!!
+
+
+def calculate_plan(samplesheet, sizes=None, strategy='fixed',
+                   runtime_model=None, reference=None, profile=None,
+                   node=None, resources=None, stage_scratch=False,
+                   queue_state=None, scale_by_load=False):
+    """
+    It gets a samplesheet (a 'sheet' namedtuple, see samplesheet.py),
+    and it calculates how many scripts should be generated and some
+    details they should have, based on an earlier initialized global
+    namedtuple variable named 'uppmax_node'.
+
+    The lanes and samples are split into chunks (one per node) either
+    in the order they appear in the samplesheet ('fixed' strategy), or
+    balanced by their input size on disk ('size' strategy). The latter
+    needs the 'sizes' argument, as returned by measure_input_sizes().
+
+    If a 'runtime_model' is given (see runtime_store.RuntimeModel), the
+    walltimes are predicted from the history of past jobs.
+
+    If a cluster 'profile' is given (a list of partitions, as returned by
+    cluster_profiles.load_profile()), the partition and the number of
+    lanes/samples per node are chosen for every stage, so that the stage
+    finishes as soon as possible. Otherwise 'uppmax_node' is used (or
+    the given 'node', e.g. to try other numbers of lanes/samples per node).
+
+    The memory of every lane/sample comes from the 'resources' model (a
+    resource_model.ResourceModel, the built-in one if not given), by
+    stage, reference genome and input size. A node runs only as many
+    lanes/samples as fit in its memory, and the job requests (SBATCH
+    --mem) the memory of its lanes/samples instead of the whole node.
+
+    With 'stage_scratch', the mkfastq/count jobs run on the local disk
+    of their node: a node runs only as many lanes/samples as fit on its
+    disk, and the job requests (SBATCH --tmp) the disk they need.
+
+    If a 'queue_state' is given (a snapshot of the cluster, see
+    cluster_state.py), the lanes/samples per node are chosen by the idle
+    nodes and the queue of the partitions, even without a 'profile'.
+
+    With 'scale_by_load' (the sizes are measured from the fastqs, see
+    run_count_phase()), the walltime of every mkfastq/count job the
+    formulas give is scaled by its input (see load_scale()).
+
+    It returns a namedtuple with three lists, one for every process.
+    Each list keeps a 'cr_info' namedtuple for every script: the output
+    script name, a string with space sep lanes or samples (BASH style
+    list), the cellranger local cores/memory, the walltime, the template
+    to be used for the script's construction, the partition to run on,
+    the job array (if any), the lanes/samples themselves, the memory
+    (GB) to request for the job and the local disk (GB) to request for
+    it (None if it does not stage its work there).
+    """
+
+    if node is None:
+        node = uppmax_node
+
+    if resources is None:
+        resources = resource_model.ResourceModel()
+
+    # Initialize the predefind namedtuple with 3 empty lists
+    plan = scripts_to_gen([], [], [])
+
+    stages = [
+        ('mkfastq', samplesheet.lanes, sizes and sizes.lanes,
+         node.mkfq_per_node, plan.mkfastq_plan),
+        ('count', samplesheet.samples, sizes and sizes.samples,
+         node.count_per_node, plan.count_plan)
+        ]
+
+    for stage, items, item_sizes, per_node, stage_plan in stages:
+        stage_plan.extend(plan_stage(stage, items, item_sizes, per_node,
+                                     strategy, runtime_model, reference,
+                                     profile, resources,
+                                     stage_scratch=stage_scratch,
+                                     queue_state=queue_state,
+                                     scale_by_load=scale_by_load))
+
+
+    if len(samplesheet.samples) != 1:
+        n_samples = len(samplesheet.samples)
+        total_bytes = sizes and sum(sizes.samples.values())
+
+        def job_secs(n):
+            return calc_run_secs(n_samples, 'aggr_runtime', runtime_model,
+                                 total_bytes, reference)
+
+        # The aggregation always runs as a single job, on a whole node
+        if profile:
+            part, _, secs = choose_layout_or_exit(
+                                'aggregation', 1, profile, job_secs,
+                                state=queue_state)
+        else:
+            part, secs = uppmax_partition, job_secs(1)
+
+        cores = part.cores
+        mem = min(resources.request_gb('aggr', reference, total_bytes),
+                  int(part.mem_gb * cluster_profiles.USABLE_MEM))
+
+        runtime = partition_walltime(secs, part, 'aggregation')
+
+        aggr_info = cranger_info('aggregation.sh', None,
+                                cores, mem, runtime,
+                                'aggr_template.bash', part, None,
+                                samplesheet.samples, mem, None)
+
+        plan.aggr_plan.append(aggr_info)
+
+    return plan
+
+
+def calculate_batch_plan(setups, refs, strategy='fixed', runtime_model=None,
+                         profile=None, node=None, resources=None,
+                         stage_scratch=False, queue_state=None):
+    """
+    Plan several projects together. Every project keeps its mkfastq and
+    aggregation scripts (see calculate_plan()), while the samples of all
+    the projects are packed together into the count scripts, so that
+    small projects do not leave their nodes partially empty.
+
+    Input:
+        setups: [list] the 'project_setup's of the projects
+        refs:   [list] the reference genome of every project
+
+    Returns: (a 'scripts_to_gen' for every project, without count
+             scripts; the shared count scripts, whose items are
+             (project index, sample) tuples; the number of count
+             scripts the projects would need on their own)
+    """
+
+    if node is None:
+        node = uppmax_node
+
+    plans = []
+    own_nodes = 0
+
+    for setup, ref in zip(setups, refs):
+        plan = calculate_plan(setup.sheet, setup.sizes, strategy,
+                              runtime_model, ref, profile, node, resources,
+                              stage_scratch, queue_state)
+
+        own_nodes += len(plan.count_plan)
+        plans.append(plan._replace(count_plan=[]))
+
+    items = [(p, sample) for p, setup in enumerate(setups)
+             for sample in setup.sheet.samples]
+
+    item_sizes = None
+    if all(setup.sizes is not None for setup in setups):
+        item_sizes = dict(((p, sample), setups[p].sizes.samples.get(sample, 0))
+                          for p, sample in items)
+
+    item_refs = dict((item, refs[item[0]]) for item in items)
+
+    # The run time is predicted by the common reference, if there is one
+    reference = refs[0] if len(set(refs)) == 1 else None
+
+    count_plan = plan_stage('count', items, item_sizes, node.count_per_node,
+                            strategy, runtime_model, reference, profile,
+                            resources, item_refs, stage_scratch,
+                            queue_state)
+
+    # Name the samples after their project in the (informative) list
+    count_plan = [info._replace(bash_list=' '.join(
+                    '{0}/{1}'.format(setups[p].name, sample)
+                    for p, sample in info.items)) for info in count_plan]
+
+    return plans, count_plan, own_nodes
+
+
+def plan_stage(stage, items, item_sizes, per_node, strategy='fixed',
+               runtime_model=None, reference=None, profile=None,
+               resources=None, item_refs=None, stage_scratch=False,
+               queue_state=None, scale_by_load=False):
+    """
+    Split the lanes/samples of a stage ('mkfastq' or 'count') into the
+    scripts that run them, one per node (see calculate_plan()).
+
+    Input:
+        items:      [list] the lanes/samples of the stage
+        item_sizes: [dict] (optional) their input size (bytes)
+        per_node:   [int] lanes/samples per node, without a 'profile'
+        item_refs:  [dict] (optional) the reference genome of every item,
+                    if not the 'reference' (e.g. samples of several projects)
+        stage_scratch: [bool] run the items on the nodes' local disk
+        queue_state: [dict] (optional) a snapshot of the cluster, to
+                    choose the items per node by (see cluster_state.py)
+        scale_by_load: [bool] scale the walltimes of the formulas by the
+                    input of every chunk (see load_scale())
+
+    Returns: a list of 'cr_info' namedtuples
+    """
+
+    # e.g. the mkfastq stage of the count phase of a two-phase plan
+    if not items:
+        return []
+
+    if resources is None:
+        resources = resource_model.ResourceModel()
+
+    stage_plan = []
+    time_tag = stage + '_runtime'
+
+    # Average input size of an item, to estimate the chunks' run time
+    avg_bytes = 0
+    if item_sizes:
+        avg_bytes = sum(item_sizes.values()) // len(item_sizes)
+
+    def job_secs(n):
+        return calc_run_secs(n, time_tag, runtime_model,
+                             n * avg_bytes, reference)
+
+    # The memory (GB) every item needs
+    item_mem = dict((item, resources.request_gb(
+                        stage, (item_refs or {}).get(item, reference),
+                        item_sizes and item_sizes.get(item, 0)))
+                    for item in items)
+
+    # The local disk (GB) every item needs, if staged
+    item_scratch = {}
+    if stage_scratch:
+        item_scratch = dict((item, cluster_profiles.scratch_need_gb(
+                                stage, item_sizes and item_sizes.get(item, 0)))
+                            for item in items)
+
+    def fitting_scratch(part, group):
+        # The largest need of the items that fit on the partition's disk
+        needs = [item_scratch[item] for item in group if item in item_scratch
+                 and item_scratch[item] <= cluster_profiles.usable_scratch_gb(part)]
+        return max(needs) if needs else None
+
+    def group_layout(group):
+        # Choose where to run the group, and how many items per node
+        max_item_mem = max(item_mem[item] for item in group) \
+            if group else None
+
+        if profile or queue_state:
+            partitions = profile or [uppmax_partition]
+
+            max_scratch = max([fitting_scratch(p, group) for p in partitions]
+                              or [None])
+            part, group_per_node, _ = choose_layout_or_exit(
+                                    stage, len(group), partitions, job_secs,
+                                    max_item_mem, max_scratch, queue_state)
+
+            if queue_state and group:
+                print_layout_tradeoff(stage, cluster_profiles.layout_options(
+                                        len(group), [part], job_secs,
+                                        max_item_mem, max_scratch,
+                                        queue_state),
+                                      group_per_node)
+
+            return part, group_per_node
+
+        part = uppmax_partition
+        return part, min(per_node, cluster_profiles.max_per_node(
+                                    part, max_item_mem,
+                                    fitting_scratch(part, group)))
+
+    # Split the lanes/samples into the chunks each node will run. Items
+    # of different references never share a node, so that every node
+    # loads (and caches) a single reference index; the partition and the
+    # items per node are chosen for every reference by its own memory
+    # need, e.g. the mouse samples of a batch are not packed as human ones.
+    chunks = []
+    too_large = set()
+    for group in group_by_reference(items, item_refs):
+        part, group_per_node = group_layout(group)
+
+        # The items too large for the local disk run on the shared storage
+        group_too_large = [item for item in group if item in item_scratch and
+                           item_scratch[item] >
+                           cluster_profiles.usable_scratch_gb(part)]
+        if group_too_large:
+            print('  {0}: {1} too large for the local disk of {2}, not '
+                  'staged'.format(stage,
+                                  ' '.join(map(str, sorted(group_too_large))),
+                                  part.name))
+        too_large.update(group_too_large)
+
+        # Calculate the number of scripts to be generated
+        n_scripts = int(math.ceil(len(group) / group_per_node))
+
+        chunks.extend((chunk, part) for chunk in
+                      chunk_work(group, group_per_node, n_scripts,
+                                 item_sizes, strategy))
+
+    for i, (chunk, part) in enumerate(chunks):
+        # Form the script name
+        script_name = stage + '_' + str(i+1) + '.sh'
+
+        # Get the items corespond to each script (BASH style string list)
+        chunk_str = " ".join(map(str, chunk))
+
+        # Get the cores/memory per item (for the $LOCALC/$LOCALM vars)
+        cores_per_item = part.cores // len(chunk)
+        mem_per_item = max(item_mem[item] for item in chunk)
+
+        # The memory the job requests, at most the node's usable memory
+        mem_request = min(len(chunk) * mem_per_item,
+                          int(part.mem_gb * cluster_profiles.USABLE_MEM))
+
+        load = item_sizes and sum(chunk_loads([chunk], item_sizes))
+
+        secs = calc_run_secs(len(chunk), time_tag, runtime_model, load,
+                             reference)
+
+        # The formulas know only the number of items, not their input
+        if scale_by_load and avg_bytes and (runtime_model is None or
+                runtime_model.predict(stage, len(chunk), load,
+                                      reference) is None):
+            secs = int(secs * load_scale(load, len(chunk), avg_bytes))
+
+        runtime = partition_walltime(secs, part, stage)
+
+        # The local disk the job requests, if all its items are staged
+        scratch_gb = None
+        if stage_scratch and not set(chunk).intersection(too_large):
+            scratch_gb = max(1, int(math.ceil(sum(item_scratch[item]
+                                                  for item in chunk))))
+
+        stage_plan.append(cranger_info(script_name, chunk_str,
+                                       cores_per_item, mem_per_item,
+                                       runtime, stage + '_template.bash',
+                                       part, None, chunk, mem_request,
+                                       scratch_gb))
+
+    return stage_plan
+
+
+def choose_layout_or_exit(stage, *args, **kwargs):
+    """
+    Choose the partition and the lanes/samples per node of a stage (see
+    cluster_profiles.choose_layout()). It exits if no partition can run
+    the stage's jobs (e.g. all their walltime limits are too short).
+    """
+
+    try:
+        return cluster_profiles.choose_layout(*args, **kwargs)
+    except ValueError as e:
+        print("Cannot plan the {0} jobs: {1} Exiting...".format(stage, e))
+        exit(1)
+
+
+def array_plan(plan, project, prefix=''):
+    """
+    Turn the mkfastq and count scripts of the plan into one job array
+    script per process (their names, and the names of their manifests,
+    prefixed with 'prefix', see prefix_plan()). The lanes/samples and the local cores/memory of
+    every array task are written in a manifest file in the project's
+    metadata folder (one line per task, in $SLURM_ARRAY_TASK_ID order):
+
+        <localcores> <localmem> <lane_or_sample> [<lane_or_sample> ...]
+
+    The walltime of the array is the longest walltime of its tasks.
+
+    Returns: the new plan (the aggregation is only prefixed)
+    """
+
+    arrays = []
+
+    for stage in (plan.mkfastq_plan, plan.count_plan):
+        if not stage:
+            arrays.append(stage)
+            continue
+
+        name = prefix + stage[0].template.split('_')[0]
+        manifest = project.meta + name + '_manifest.txt'
+
+        with open(manifest, 'w') as f:
+            for info in stage:
+                f.write('{0} {1} {2}\n'.format(info.localcores,
+                                              info.localmem, info.bash_list))
+
+        longest = max(stage,
+                      key=lambda inf: runtime_store.parse_elapsed(inf.runtime))
+
+        chunks = [info.items for info in stage]
+
+        # Every task gets the memory of the largest one
+        mem_request = max(info.mem_request for info in stage)
+
+        # The same for the local disk, if every task is staged
+        scratch_gb = None
+        if all(info.scratch_gb is not None for info in stage):
+            scratch_gb = max(info.scratch_gb for info in stage)
+
+        arrays.append([longest._replace(
+                        scr_name=name + '_array.sh', bash_list=None,
+                        array=array_job(os.path.basename(manifest), chunks),
+                        items=None, mem_request=mem_request,
+                        scratch_gb=scratch_gb)])
+
+    return scripts_to_gen(arrays[0], arrays[1],
+                          prefix_plan(plan, prefix).aggr_plan)
+
+
+def prefix_plan(plan, prefix):
+    """
+    Prefix the script names of the plan (e.g. 'resume_1_'), so that its
+    scripts do not overwrite the ones of an earlier run of the project.
+    """
+
+    return scripts_to_gen(*[[info._replace(scr_name=prefix + info.scr_name)
+                             for info in stage] for stage in plan])
+
+
+def array_spec(n_tasks, throttle=None):
+    """
+    Form the value of the '#SBATCH --array=' option, e.g. 1-24%4
+    """
+
+    spec = '1-{0}'.format(n_tasks)
+
+    if throttle:
+        spec += '%{0}'.format(throttle)
+
+    return spec
+
+
+def partition_walltime(secs, part, stage):
+    """
+    Form the walltime to request for a job that is expected to run for
+    'secs' seconds (on a node with REF_CORES cores) on the given partition.
+    It exits if that is over the partition's walltime limit (e.g. a
+    chunk with more input than the layout assumed), rather than request
+    less time and have the job killed.
+    """
+
+    secs = secs * cluster_profiles.REF_CORES // part.cores
+
+    if secs > part.max_walltime:
+        print("Cannot plan the {0} jobs: a job needs {1}, over the {2} "
+              "walltime limit of {3}. Exiting...".format(
+                stage, format_walltime(secs),
+                format_walltime(part.max_walltime), part.name))
+        exit(1)
+
+    return format_walltime(secs)
+
+
+def group_by_reference(items, item_refs=None):
+    """
+    Split the items into groups of the same reference genome, in the
+    order the references first appear (a single group without
+    'item_refs').
+    """
+
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault((item_refs or {}).get(item), []).append(item)
+
+    return list(groups.values()) or [[]]
+
+
+def chunk_work(items, per_node, n_chunks, sizes=None, strategy='fixed'):
+    """
+    Split the given items (lanes or samples) into 'n_chunks' chunks,
+    of at most 'per_node' items each.
+
+    strategy: 'fixed' - consecutive slices, in samplesheet order
+              'size'  - longest-processing-time-first packing, using
+                        the 'sizes' dictionary {item: bytes}
+
+    If no sizes are known, it falls back to the fixed chunking.
+    """
+
+    if strategy == 'size' and sizes and any(sizes.values()):
+        return lpt_chunks(items, sizes, per_node, n_chunks)
+
+    return [items[i * per_node: (i+1) * per_node] for i in range(n_chunks)]
+
+
+def lpt_chunks(items, sizes, per_node, n_chunks):
+    """
+    Longest-processing-time-first bin packing. The items are sorted
+    by size (largest first) and each one goes to the least loaded
+    chunk that still has room for it (max 'per_node' items), so the
+    heaviest chunk (i.e. the plan's makespan) is kept as low as possible.
+
+    The items of every chunk keep their samplesheet order.
+    """
+
+    # Remember the original position of each item
+    order = dict((item, pos) for pos, item in reversed(list(enumerate(items))))
+
+    chunks = [[] for _ in range(n_chunks)]
+    loads = [0] * n_chunks
+
+    for item in sorted(items, key=lambda it: sizes.get(it, 0), reverse=True):
+        # Pick the least loaded chunk that is not full yet
+        free = [i for i in range(n_chunks) if len(chunks[i]) < per_node]
+        target = min(free, key=lambda i: (loads[i], len(chunks[i])))
+
+        chunks[target].append(item)
+        loads[target] += sizes.get(item, 0)
+
+    # Drop any empty chunk and restore the samplesheet order in each
+    return [sorted(c, key=order.get) for c in chunks if c]
+
+
+def load_scale(load, n_items, avg_bytes):
+    """
+    How much longer (or shorter) than the formula's walltime a job of
+    'n_items' items with a total input of 'load' bytes should run: its
+    input relative to 'n_items' average items (of 'avg_bytes'), within
+    MIN_LOAD_SCALE and MAX_LOAD_SCALE.
+    """
+
+    scale = load / (n_items * avg_bytes)
+
+    return min(max(scale, MIN_LOAD_SCALE), MAX_LOAD_SCALE)
+
+
+def chunk_loads(chunks, sizes):
+    """
+    Return the total input size (bytes) of every chunk.
+    """
+    return [sum(sizes.get(item, 0) for item in c) for c in chunks]
+
+
+def measure_input_sizes(datapath, samplesheet):
+    """
+    Measure the input size (in bytes) of every lane and sample of the
+    samplesheet, by looking at the data under the given hiseq data path.
+
+    Lanes: The size of the BCL folder of each lane, i.e.
+           <datapath>/Data/Intensities/BaseCalls/L00N/
+
+    Samples: The size of the fastq files of the sample, if any exist under
+             <datapath> (see FASTQ_NAME). Otherwise the bytes
+             of every lane are split evenly among the samples of the lane.
+
+    Returns: an 'input_sizes' namedtuple of two dictionaries
+    """
+
+    basecalls = os.path.join(datapath, 'Data', 'Intensities', 'BaseCalls')
+
+    lane_sizes = {}
+    for lane in samplesheet.lanes:
+        lane_dir = os.path.join(basecalls, 'L{0:03d}'.format(lane))
+        lane_sizes[lane] = dir_size(lane_dir)
+
+    # Find the fastq files (if any) of each sample under the data path
+    fastq_sizes = defaultdict(int)
+    samples = set(samplesheet.samples)
+
+    for root, dirs, files in os.walk(datapath):
+        # Skip the (huge) BCL folders, there are no fastqs there
+        dirs[:] = [d for d in dirs if d != 'BaseCalls']
+
+        for f in files:
+            sample = fastq_sample(f)
+            if sample in samples:
+                fastq_sizes[sample] += os.path.getsize(os.path.join(root, f))
+
+    # Otherwise, give each sample an even share of the lanes it is on
+    sample_sizes = defaultdict(int)
+    for lane, lane_smpls in samplesheet.lane_samples.items():
+        for sample in lane_smpls:
+            if sample in fastq_sizes:
+                sample_sizes[sample] = fastq_sizes[sample]
+            else:
+                sample_sizes[sample] += lane_sizes.get(lane, 0) \
+                                        // len(lane_smpls)
+
+    return input_sizes(lane_sizes, dict(sample_sizes))
+
+
+def measure_fastq_sizes(project, sheet, flowcell):
+    """
+    Measure every sample of a project from the output of its mkfastq
+    jobs (<fastqs>/<flowcell>_<lane>/outs/fastq_path/): by its number of
+    reads, from the bcl2fastq 'Stats/Stats.json' of its lanes, or else
+    by the size of its fastq files. The reads are turned into bytes (by
+    the average bytes per read of the fastqs), so that they can be used
+    as input sizes.
+
+    Returns: ({sample: bytes}, 'read count' or 'fastq size')
+    """
+
+    samples = set(sheet.samples)
+    reads = defaultdict(int)
+    fastq_sizes = defaultdict(int)
+    all_stats = True
+
+    for lane in sheet.lanes:
+        fastq_path = '{0}{1}_{2}/outs/fastq_path'.format(project.fastqs,
+                                                          flowcell, lane)
+
+        stats_file = os.path.join(fastq_path, 'Stats', 'Stats.json')
+        if os.path.isfile(stats_file):
+            with open(stats_file, 'r') as f:
+                stats = json.load(f)
+
+            for result in stats.get('ConversionResults', []):
+                for demux in result.get('DemuxResults', []):
+                    sample = demux.get('SampleName') or demux.get('SampleId')
+                    if sample in samples:
+                        reads[sample] += int(demux.get('NumberReads', 0))
+        else:
+            all_stats = False
+
+        for root, dirs, files in os.walk(fastq_path):
+            for f in files:
+                sample = fastq_sample(f)
+                if sample in samples:
+                    fastq_sizes[sample] += os.path.getsize(
+                                            os.path.join(root, f))
+
+    if not (all_stats and sum(reads.values())):
+        return dict(fastq_sizes), 'fastq size'
+
+    # The bytes of an average read, to keep the sizes in bytes
+    bytes_per_read = 1
+    if sum(fastq_sizes.values()):
+        bytes_per_read = sum(fastq_sizes.values()) / sum(reads.values())
+
+    return dict((sample, int(n * bytes_per_read))
+                for sample, n in reads.items()), 'read count'
+
+
+def fastq_sample(file_name):
+    """
+    The sample of a fastq file (see FASTQ_NAME), e.g. PBMC_Stim of
+    PBMC_Stim_S1_L001_R1_001.fastq.gz, or None if it is not a fastq.
+    """
+
+    match = FASTQ_NAME.match(file_name)
+
+    return match.group(1) if match else None
+
+
+def dir_size(path):
+    """
+    Return the total size (in bytes) of the files under the given path.
+    A path that does not exist has a size of 0.
+    """
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                # e.g. broken links
+                pass
+
+    return total
+
+
+def reference_scratch_gb(reference):
+    """
+    The local disk (GB) a staged copy of the reference needs: the size
+    of its folder in 'references/', if it is there.
+    """
+
+    ref_bytes = 0
+    if reference in REFERENCE_DIRS:
+        ref_bytes = dir_size(os.path.join('references',
+                                          REFERENCE_DIRS[reference]))
+
+    if not ref_bytes:
+        return DEFAULT_REFERENCE_GB
+
+    return int(math.ceil(ref_bytes / 1e9))
+
+
+def human_size(num_bytes):
+    """
+    Format the given number of bytes in a human readable way (e.g. 3.2G).
+    """
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if abs(num_bytes) < 1024 or unit == 'T':
+            return '{0:.1f}{1}'.format(num_bytes, unit)
+
+        num_bytes /= 1024
+
+
+def print_plan_balance(plan, sizes):
+    """
+    Print the input size each node gets, for the mkfastq and count
+    scripts of the given plan.
+    """
+
+    for stage, stage_sizes in ((plan.mkfastq_plan, sizes.lanes),
+                               (plan.count_plan, sizes.samples)):
+        loads = chunk_loads([info.items for info in stage], stage_sizes)
+
+        for info, load in zip(stage, loads):
+            print('  {0:<14} {1:>8}  [{2}]'.format(
+                    info.scr_name, human_size(load), info.bash_list))
+
+        if loads:
+            print('  Largest node input: {0}'.format(human_size(max(loads))))
+
+
+def print_layout_tradeoff(stage, options, per_node):
+    """
+    Print the predicted time-to-result and the node hours of every
+    number of lanes/samples per node ('options' of one partition, see
+    cluster_profiles.layout_options()), marking the chosen one.
+    """
+
+    print('  {0} on {1}: lanes/samples per node, jobs, results ready in, '
+          'node hours'.format(stage, options[0][2].name))
+
+    for ttc, cost, part, n, jobs, secs in sorted(options,
+                                                 key=lambda o: o[3]):
+        print('  {0} {1:>4} {2:>5} {3:>12} {4:>8.1f}'.format(
+                '*' if n == per_node else ' ', n, jobs,
+                format_walltime(ttc), jobs * secs / 3600))
+
+
+def print_plan_layout(plan):
+    """
+    Print the partition and the number of scripts chosen for every process.
+    """
+
+    for stage in plan:
+        if not stage:
+            continue
+
+        part = stage[0].partition
+        print('  {0:<8} {1} script(s) on {2} ({3} cores, {4}GB{5})'.format(
+                stage[0].template.split('_')[0], len(stage), part.name,
+                part.cores, part.mem_gb,
+                ', ' + part.constraint if part.constraint else ''))
+
+
+def calc_run_time(iters, time_tag, runtime_model=None,
+                  input_bytes=0, reference=None):
+    """
+    Calculate the walltime to request (e.g. 1-02:30:00) for a script that
+    runs the given number of iterations (lanes or samples) of a process.
+    See calc_run_secs().
+    """
+
+    return format_walltime(calc_run_secs(iters, time_tag, runtime_model,
+                                         input_bytes, reference))
+
+
+def calc_run_secs(iters, time_tag, runtime_model=None,
+                  input_bytes=0, reference=None):
+    """
+    Calculate the run time (seconds) of a script that runs the given
+    number of iterations (lanes or samples) of a process (time_tag).
+
+    If a 'runtime_model' is given and it has enough history for the
+    process, its prediction is used. Otherwise the walltime comes from
+    the (fitted once) linear formulas below.
+    """
+
+    secs = None
+    if runtime_model is not None:
+        secs = runtime_model.predict(time_tag[:-len('_runtime')], iters,
+                                     input_bytes or 0, reference)
+
+    if secs is not None:
+        pass
+
+    elif time_tag == 'mkfastq_runtime':
+        secs = 486 * iters + 3771 #+ 7200
+
+    elif time_tag == 'count_runtime':
+        secs = 9033 * iters + 139080 #+ 14400
+
+    elif time_tag == 'aggr_runtime':
+        secs = 1098 * iters + 11282 #+ 7200
+
+    else:
+        print('The time tag given is incorrect.\nExiting...')
+        exit(4)
+
+    return secs
+
+
+def format_walltime(secs):
+    """
+    Transform the given seconds into a SLURM walltime string.
+    """
+
+    # Transform the seconds into datetime ([d days, ]HH:MM:SS)
+    uptime = str(datetime.timedelta(seconds=secs))
+
+    # Return the datetime if there are no days (i.e. HH:MM:SS)
+    if len(uptime.split()) == 1:
+        return uptime
+
+    # If there are days, return the datetime appropriately (i.e. d-HH:MM:SS)
+    return uptime.split()[0] + '-' + uptime.split()[-1]
+
+
+
+def plan_info_row(job_name, stage_idx, info, sizes, reference):
+    """
+    Form the 'plan_info.csv' row of a generated script: its job name,
+    stage, number of lanes/samples, input size, reference genome and
+    when it was planned (its jobs are submitted after that, see
+    runtime_store.join_plan()).
+    """
+
+    stage = ('mkfastq', 'count', 'aggr')[stage_idx]
+    items = info.items
+
+    # The tasks of a job array share its job name; describe the largest
+    if info.array is not None:
+        items = max(info.array.chunks, key=len)
+
+    input_bytes = 0
+    if sizes is not None:
+        stage_sizes = sizes.lanes if stage == 'mkfastq' else sizes.samples
+        input_bytes = sum(chunk_loads([items], stage_sizes))
+
+    return {'job_name': job_name, 'stage': stage, 'n_items': len(items),
+            'input_bytes': input_bytes, 'reference': reference,
+            'planned': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def write_plan_info(project, rows):
+    """
+    Write the 'plan_info.csv' file in the project's metadata folder.
+    runtime_store.py joins it with 'sacct' dumps, to learn the run time
+    of every kind of job.
+
+    Return: Generated file's name
+    """
+
+    fieldnames = ['job_name', 'stage', 'n_items', 'input_bytes', 'reference',
+                  'planned']
+
+    meta_csv = project.meta + 'plan_info.csv'
+    with open(meta_csv, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+
+        writer.writerow(dict((fn, fn) for fn in writer.fieldnames))
+        writer.writerows(rows)
+
+    return os.path.basename(meta_csv)
+
+
+def write_job_graph(project, plan, dependencies=None,
+                    run_file='run_project.sh'):
+    """
+    Write the jobs of a run file in the project's metadata folder
+    ('<run file>_jobs.csv'), for submit_jobs.py: in submission order,
+    every script with the scripts it waits for (see plan_dependencies();
+    if not given, all the scripts of the previous process), its number
+    of tasks (for a job array), and the cores and memory (GB) of its
+    job. The script paths are relative to the project's (or the batch's)
+    folder.
+
+    Return: Generated file's name
+    """
+
+    if dependencies is None:
+        dependencies = barrier_dependencies(plan)
+
+    graph_csv = project.meta + os.path.splitext(run_file)[0] + '_jobs.csv'
+
+    with open(graph_csv, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['script', 'dependencies', 'tasks', 'cores',
+                         'mem_gb'])
+
+        for stage in plan:
+            for info in stage:
+                tasks = len(info.array.chunks) if info.array else 1
+
+                writer.writerow([info.scr_name,
+                                 ' '.join(dependencies.get(info.scr_name,
+                                                           [])),
+                                 tasks, info.partition.cores,
+                                 info.mem_request])
+
+    return os.path.basename(graph_csv)
+
+
+def write_pilot_script(project, plan, dependencies, run_file, args_dict,
+                       job_descr, nodes):
+    """
+    Write a pilot job for the jobs of a run file: a single allocation of
+    'nodes' nodes, in which pilot_runner.py runs every job as an srun
+    job step (see write_job_graph()). It is named after the run file
+    (e.g. 'pilot_project.sh' for 'run_project.sh').
+
+    Every node gets the cores and the memory of the largest job, and
+    the walltime is the makespan of the plan on that many nodes (see
+    plan_simulator.py). If the makespan is over the walltime limit of
+    the partition, the nodes are raised until it fits; if it never fits,
+    no pilot job is written (the jobs are submitted one by one).
+
+    Return: Generated file's name (None if not written)
+    """
+
+    # Imported here, as plan_simulator.py imports this module
+    import plan_simulator
+
+    infos = [info for stage in plan for info in stage]
+
+    # The nodes are of the partition of the count jobs (the largest ones)
+    part = (plan[1] or infos)[0].partition
+
+    # No more nodes than the jobs that can run at the same time
+    max_nodes = min(max(len(stage) for stage in plan), part.nodes)
+    nodes = asked = min(nodes, max_nodes)
+
+    jobs = plan_simulator.plan_jobs(plan, dependencies)
+    makespan = plan_simulator.simulate(jobs, nodes).makespan
+
+    # More nodes, until the pilot fits in the walltime limit
+    while makespan > part.max_walltime and nodes < max_nodes:
+        nodes += 1
+        makespan = plan_simulator.simulate(jobs, nodes).makespan
+
+    if makespan > part.max_walltime:
+        print('No pilot job: the jobs need {0} even on {1} node(s), over the '
+              'walltime limit of {2} ({3}). Submit them with {4} '
+              'instead.'.format(format_walltime(makespan), nodes, part.name,
+                                format_walltime(part.max_walltime),
+                                run_file))
+        return None
+
+    if nodes > asked:
+        print('  The pilot job needs {0} node(s) (instead of {1}) to finish '
+              'within the walltime limit of {2}.'.format(nodes, asked,
+                                                         part.name))
+
+    stem = os.path.splitext(run_file)[0]
+    pilot_name = 'pilot_' + (stem[4:] if stem.startswith('run_') else stem) \
+                 + '.sh'
+
+    script_args = dict(args_dict)
+    script_args['job_description'] = job_descr + '_' + pilot_name[:-3]
+    script_args['output'] = pilot_name
+    script_args['sbatch_output'] = 'slurm_out/' + pilot_name[:-3] + '.out'
+    script_args['partition'] = part.name
+    script_args['pilot_nodes'] = nodes
+    script_args['num_cores'] = max(info.partition.cores for info in infos)
+    script_args['ram_memory'] = part.constraint
+    script_args['sbatch_mem'] = '{0}G'.format(
+                                    max(info.mem_request for info in infos))
+    script_args['job_graph'] = 'metadata/' + stem + '_jobs.csv'
+
+    if args_dict['use_qos_short']:
+        script_args['time_request'] = "15:00"
+    else:
+        script_args['time_request'] = format_walltime(makespan)
+
+    generate_scripts([('pilot_template.bash', project.root + pilot_name,
+                       script_args)])
+
+    print('Pilot job: {0} node(s) for {1} job(s), walltime {2}. Submit it '
+          'with: (cd {3} && sbatch {4})'.format(
+            nodes, len(infos), script_args['time_request'],
+            project.root.rstrip('/'), pilot_name))
+
+    return pilot_name
+
+
+def create_aggr_csv(project, samplesheet, fieldnames=None):
+    """
+    It geberates a .csv file that contains the appropriate information
+    about the 'count' output folders (named after the sample names in
+    the samplesheet), needed to run the aggregation process.
+
+    samplesheet: a 'sheet' namedtuple (see samplesheet.py)
+
+    Return: Generated file's name
+    """
+
+    meta_csv = project.meta + 'aggregation_meta.csv'
+    with open(meta_csv, 'w') as f:
+        if fieldnames is None:
+            fieldnames = ['library_id', 'molecule_h5']
+
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+
+        # writer.writeheader() -> added on Python 2.7; it won't work on 2.6
+        writer.writerow(dict((fn, fn) for fn in writer.fieldnames))
+
+        for sample in samplesheet.samples:
+            # Form the path to the 'molecule_h5' file
+            mol_path = '../counts/' + sample + '/outs/molecule_info.h5'
+
+            # Write the row to the .csv output file
+            writer.writerow({
+                        fieldnames[0]: sample,
+                        fieldnames[1]: mol_path
+                        })
+
+    return os.path.basename(meta_csv)
+
+
+def generate_script(args_dict, template):
+    """
+    This function creates a new file based on a (given) template,
+    placing the appropriate given arguments in the right place.
+
+    Areas that need to be edited on the template script should
+    contain a '?' at the beginning of the line, followed by a
+    string that matches the given argument keys.
+
+    This function will delete this line, after either appending
+    the next line with the right value (if the value was given),
+    or deleting the next line too (if no value was given or if
+    no such a key was found).
+
+    The output file is named after args_dict['output'].
+
+    template: { 'mkfastq', 'count' }
+    """
+
+    generate_scripts([(template, args_dict['output'], args_dict)])
+
+
+def generate_scripts(jobs):
+    """
+    Create many scripts in one pass (see generate_script()). Every
+    template is parsed only once (see template_engine.py).
+
+    Input:
+        jobs: [list] of (template name, output name, arguments) tuples
+
+    Returns: the list of the generated file names
+    """
+
+    templates = {}
+    resolved = []
+
+    for template, output, script_args in jobs:
+        if template not in templates:
+            templates[template] = find_template(template)
+
+        resolved.append((templates[template], output, script_args))
+
+    return template_engine.render_batch(resolved)
+
+
+def find_template(template):
+    """
+    Return the path of the given template, looking also in the scripts
+    folder. It exits if the template cannot be found.
+    """
+
+    if os.path.exists(template):
+        return template
+
+    # Form the path that the template is expected to be.
+    temp = fix_path(template)
+
+    if not temp:
+        print("Could not find the template file \
+                '{0}' ".format(template), end='')
+
+        print("in the scripts folder. Exiting...")
+        exit(1)
+
+    return temp
+
+
+def build_project_structure(project_name):
+    """
+    This function creates the folder structure to support a new project.
+    """
+
+    # Form the name of the project folder to be created inside 'projects'
+    project_dir = 'projects/' + 'project_' + project_name
+
+    # Check if a folder with the given name already exists
+    # If exists, try suffixing with an ascending number
+    count = itertools.count(1)
+
+    while os.path.exists(project_dir):
+        print("A folder with the given project name, already exists.")
+        project_dir = '_'.join(project_dir.split('_')[:7]) \
+                        + '_' + str(count.next())
+
+        print("Trying: " + project_dir)
+
+    # Form the name of the necessary folders in the project dir
+    fastq_dir = project_dir + '/fastqs/'
+    count_dir = project_dir + '/counts/'
+    meta_dir = project_dir + '/metadata/'
+    out_dir = project_dir + '/slurm_out/'
+    aggr_dir = project_dir + '/aggregation/'
 
     # Try to create the project folder
     try:
@@ -693,7 +2497,54 @@ def build_project_structure(project_name):
     return project
 
 
-def build_run_file(file_names, output_name=None):
+def existing_project_structure(project_dir):
+    """
+    The folder structure of an existing project (e.g. to resume it). It
+    exits if the folder is not a project's.
+
+    Returns: a 'project' namedtuple
+    """
+
+    project_dir = os.path.normpath(project_dir)
+    folders = ['fastqs', 'counts', 'aggregation', 'metadata', 'slurm_out']
+
+    if not all(os.path.isdir(os.path.join(project_dir, f)) for f in folders):
+        print("'{0}' is not a project folder. Exiting...".format(project_dir))
+        exit(1)
+
+    return proj_struct(*[project_dir + '/'] + [project_dir + '/' + f + '/'
+                                              for f in folders])
+
+
+def build_batch_structure(batch_name):
+    """
+    Create the folder of a batch of projects (see run_batch()), with
+    its 'metadata' and 'slurm_out' folders.
+
+    Returns: a 'project' namedtuple (without the fastqs, counts and
+             aggregation folders)
+    """
+
+    batch_dir = 'projects/batch_' + batch_name
+
+    # If it already exists, suffix it with an ascending number
+    count = itertools.count(1)
+    base_dir = batch_dir
+
+    while os.path.exists(batch_dir):
+        batch_dir = base_dir + '_' + str(next(count))
+
+    meta_dir = batch_dir + '/metadata/'
+    out_dir = batch_dir + '/slurm_out/'
+
+    os.mkdir(batch_dir)
+    os.mkdir(meta_dir)
+    os.mkdir(out_dir)
+
+    return proj_struct(batch_dir + '/', None, None, None, meta_dir, out_dir)
+
+
+def build_run_file(file_names, output_name=None, dependencies=None):
     """
     Create a file to run all the sbatches, while keeping track
     of the dependencies between them. i.e. mkfastq should run
@@ -704,6 +2555,9 @@ def build_run_file(file_names, output_name=None):
     Input:
         file_names: [list] A 2D list with the script names
                     for each process
+        dependencies: [dict] (optional) The scripts every script should
+                    wait for (see plan_dependencies()). If not given,
+                    each process waits for all the jobs of the previous.
 
     Returns:
         output_name: [string] It returns the output file name
@@ -735,13 +2589,22 @@ def build_run_file(file_names, output_name=None):
     cnt_number = len(cnt_names)
 
     # Template of the commands to form for calling the sbatch jobs
-    initial_job = "job{0}=$(sbatch {1} | awk '{{print $4}}')\n"
-    mid_job = "job{0}=$(sbatch --dependency=afterok{1} {2} | awk '{{print $4}}')\n"
-    final_job = "sbatch --dependency=afterok{0} {1}\n"
+    job_call = "job{0}=$({1} | awk '{{print $4}}')\n"
 
     if output_name is None:
         output_name = 'run_project.sh'
 
+    # The job number of every script, as they are written below
+    job_ids = dict((name, i + 1)
+                   for i, name in enumerate(mkfq_names + cnt_names))
+
+    def dep_string(scr_name, first, last):
+        if dependencies is None:
+            return job_dependencies(first, last)
+
+        return ''.join(':$job{0}'.format(job_ids[dep])
+                       for dep in dependencies.get(scr_name, []))
+
     # Open the template script in read mode
     with open(template, 'r') as template:
         template_buf = iter(template.readlines())
@@ -759,30 +2622,38 @@ def build_run_file(file_names, output_name=None):
 
         # Form and Write the mkfastq sbatch calls to the output file
         for mk_scr in mkfq_names:
-            f.write(initial_job.format(job_counter, mk_scr))
+            f.write(job_call.format(job_counter, sbatch_call(mk_scr)))
             job_counter += 1
 
         # Leave some space between the processes
         f.write('\n')
 
-        # Get the job dependencies for the count process
-        dep_jobs = job_dependencies(1, mk_number + 1)
-
         # Form and Write the count sbatch calls to the output file
         for c_scr in cnt_names:
-            f.write(mid_job.format(job_counter, dep_jobs, c_scr))
+            # Get the job dependencies of the count script
+            dep_jobs = dep_string(c_scr, 1, mk_number + 1)
+
+            f.write(job_call.format(job_counter,
+                                    sbatch_call(c_scr, dep_jobs)))
+
             job_counter += 1
 
         # Leave some space between the processes
         f.write('\n')
 
-        # Get the job dependencies for the aggregation process
-        dep_jobs = job_dependencies(mk_number + 1,
-                                    mk_number + cnt_number + 1)
-
         # Form and Write the aggr sbatch calls to the output file
         for aggr_scr in aggr_names:
-            f.write(final_job.format(dep_jobs, aggr_scr))
+            # Get the job dependencies for the aggregation process
+            dep_jobs = dep_string(aggr_scr, mk_number + 1,
+                                  mk_number + cnt_number + 1)
+
+            call = sbatch_call(aggr_scr, dep_jobs)
+
+            # Do not leave the folder of the run file
+            if os.path.dirname(aggr_scr):
+                call = '(' + call + ')'
+
+            f.write(call + '\n')
 
         # Make the file executable
         mode = os.fstat(f.fileno()).st_mode
@@ -792,6 +2663,133 @@ def build_run_file(file_names, output_name=None):
     return output_name
 
 
+def sbatch_call(scr_name, dep_jobs=''):
+    """
+    Form the sbatch call of a script, e.g.
+
+        sbatch --dependency=afterok:$job1:$job2 count_1.sh
+
+    A script in another folder (e.g. the project scripts of a batch) is
+    submitted from its own folder, where it expects to run.
+    """
+
+    call = 'sbatch '
+    if dep_jobs:
+        call += '--dependency=afterok{0} '.format(dep_jobs)
+
+    folder, name = os.path.split(scr_name)
+    call += name
+
+    if folder:
+        call = 'cd {0} && {1}'.format(folder, call)
+
+    return call
+
+
+def plan_dependencies(plan, sample_lanes):
+    """
+    Form the dependency graph (DAG) of the plan's scripts. Every count
+    script depends only on the mkfastq scripts that produce the fastqs
+    of its samples (i.e. that run their lanes), and the aggregation on
+    the count scripts of its samples (i.e. all of them).
+
+    Returns: a dictionary {script name: [script names it depends on]}
+    """
+
+    dependencies = {}
+
+    # Which mkfastq script runs every lane
+    lane_script = {}
+    for info in plan.mkfastq_plan:
+        for lane in info.items:
+            lane_script[lane] = info.scr_name
+
+    for info in plan.count_plan:
+        scripts = set(lane_script[lane]
+                      for sample in info.items
+                      for lane in sample_lanes.get(sample, [])
+                      if lane in lane_script)
+
+        # Keep the order the scripts are submitted in
+        dependencies[info.scr_name] = [mk.scr_name for mk in plan.mkfastq_plan
+                                       if mk.scr_name in scripts]
+
+    # The aggregation waits for the count scripts of its samples (a
+    # count script of a batch may also run samples of other projects)
+    for info in plan.aggr_plan:
+        samples = set(info.items)
+        dependencies[info.scr_name] = [c.scr_name for c in plan.count_plan
+                                       if samples.intersection(c.items)]
+
+    return dependencies
+
+
+def critical_path(plan, dependencies):
+    """
+    Calculate when every script of the plan would finish, if it started
+    as soon as its dependencies finished (and there were enough nodes),
+    using the requested walltimes as run times.
+
+    Returns: ({script name: finish time (secs)}, [the critical path])
+    """
+
+    finish = {}
+    parent = {}
+
+    for stage in plan:
+        for info in stage:
+            deps = dependencies.get(info.scr_name, [])
+            start = max([finish[d] for d in deps] or [0])
+
+            finish[info.scr_name] = start \
+                + runtime_store.parse_elapsed(info.runtime)
+            parent[info.scr_name] = max(deps, key=finish.get) if deps else None
+
+    # Walk back from the script that finishes last
+    path = [max(finish, key=finish.get)] if finish else []
+    while path and parent[path[0]] is not None:
+        path.insert(0, parent[path[0]])
+
+    return finish, path
+
+
+def barrier_dependencies(plan):
+    """
+    The dependencies of the plan when every process waits for all the
+    jobs of the previous one (i.e. the --barrier-deps behaviour).
+    """
+
+    dependencies = {}
+
+    for prev, stage in zip(plan, plan[1:]):
+        for info in stage:
+            dependencies[info.scr_name] = [p.scr_name for p in prev]
+
+    return dependencies
+
+
+def print_critical_path(plan, dependencies):
+    """
+    Print the critical path of the plan, and how much earlier the count
+    results are expected, compared to waiting for all the mkfastq jobs.
+    """
+
+    finish, path = critical_path(plan, dependencies)
+    barrier, _ = critical_path(plan, barrier_dependencies(plan))
+
+    print('  Critical path: {0} ({1})'.format(
+            ' -> '.join(path), format_walltime(finish[path[-1]])))
+
+    gains = [barrier[info.scr_name] - finish[info.scr_name]
+             for info in plan.count_plan]
+
+    if gains:
+        print('  Count results ready {0} earlier on average (max {1}), '
+              'compared to waiting for all the mkfastq jobs.'.format(
+                format_walltime(sum(gains) // len(gains)),
+                format_walltime(max(gains))))
+
+
 def job_dependencies(first, last):
     """
     Create the dependencies for the sbatch jobs.
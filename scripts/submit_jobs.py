@@ -0,0 +1,440 @@
+#!/usr/bin/python
+
+"""
+Submit the jobs of a project (or a batch of projects) to SLURM, instead
+of running its 'run_project.sh'.
+
+It reads the jobs of a run file from the project's metadata folder
+('<run file>_jobs.csv', written by the generator) and submits them in
+order with 'sbatch --parsable', every job with an 'afterok' dependency
+on the job IDs of the jobs it waits for:
+
+    $ python scripts/submit_jobs.py projects/<project> [--max-submit 200]
+
+The job IDs are recorded in '<run file>_job_ids.csv' as soon as every
+job is submitted. A submission that fails with a transient scheduler
+error (e.g. a timeout of the controller) is retried with an exponential
+backoff; any other failure stops the submission, so that no job is ever
+submitted without its dependencies. Running it again submits only the
+jobs that are not in the job IDs file yet.
+
+A timed out sbatch may have queued the job after all. Every submission
+is tagged with a unique '--comment', so before a retry the queue is
+searched for the job with that comment; if it is there, its ID is
+recorded instead of submitting the job again. (Job names repeat in
+every project, so a job of the same name may belong to another one.)
+
+With --max-submit the submissions wait while the user's jobs in the
+queue (every task of an array counts, as for the MaxSubmitJobs limit)
+would go over the limit.
+
+'scripts/fake_slurm/' has a stand-in 'sbatch' and 'squeue', to try it
+without a cluster:
+
+    $ PATH=$PWD/scripts/fake_slurm:$PATH python scripts/submit_jobs.py ...
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+from collections import OrderedDict
+
+import os
+import re
+import csv
+import time
+import uuid
+import shlex
+import argparse
+import datetime
+import textwrap
+import subprocess
+
+
+__version__ = '0.1.0'
+
+# Parts of the scheduler's error messages worth a retry
+TRANSIENT_ERRORS = [
+    'socket timed out',
+    'timed out',
+    'temporarily unavailable',
+    'try again',
+    'unable to contact slurm controller',
+    'connection refused',
+    'slurm_persist_conn',
+    'send/recv'
+    ]
+
+# A job of the run file: the script (relative to the project's folder),
+# the scripts it waits for and its number of tasks
+graph_job = namedtuple('graph_job', ['script', 'dependencies', 'tasks'])
+
+# A submitted job
+submitted_job = namedtuple('submitted_job', ['script', 'job_id', 'submitted'])
+
+
+class SubmitError(Exception):
+    pass
+
+
+def graph_file(folder, run_file):
+    return os.path.join(folder, 'metadata',
+                        os.path.splitext(run_file)[0] + '_jobs.csv')
+
+
+def ids_file(folder, run_file):
+    return os.path.join(folder, 'metadata',
+                        os.path.splitext(run_file)[0] + '_job_ids.csv')
+
+
+def read_job_graph(graph_csv):
+    """
+    Read the jobs of a run file (see script_generator.write_job_graph()).
+
+    Returns: a list of 'graph_job's, in submission order
+    """
+
+    jobs = []
+
+    with open(graph_csv, 'r') as f:
+        for row in csv.DictReader(f):
+            jobs.append(graph_job(row['script'], row['dependencies'].split(),
+                                  int(row.get('tasks') or 1)))
+
+    return jobs
+
+
+def read_job_ids(ids_csv):
+    """
+    Read the jobs already submitted (empty if none).
+
+    Returns: an OrderedDict of 'submitted_job's, by script
+    """
+
+    ids = OrderedDict()
+
+    if not os.path.isfile(ids_csv):
+        return ids
+
+    with open(ids_csv, 'r') as f:
+        for row in csv.DictReader(f):
+            ids[row['script']] = submitted_job(row['script'], row['job_id'],
+                                               row['submitted'])
+
+    return ids
+
+
+def write_job_ids(ids, ids_csv):
+    """
+    Write the submitted jobs (through a temporary file, so that an
+    interrupted run never leaves a truncated file behind).
+    """
+
+    tmp = ids_csv + '.tmp'
+
+    with open(tmp, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(submitted_job._fields)
+        writer.writerows(ids.values())
+
+    os.rename(tmp, ids_csv)
+
+
+def is_transient(message):
+    message = message.lower()
+    return any(e in message for e in TRANSIENT_ERRORS)
+
+
+def run_command(cmd, cwd=None, retries=5, backoff=30, sleep=time.sleep,
+                recover=None):
+    """
+    Run a scheduler command, retrying it (after backoff, 2 * backoff,
+    4 * backoff, ... secs) while it fails with a transient error.
+
+    If given, recover() is called after every transient error, before
+    any retry: if it returns an output (e.g. a timed out submission
+    that was queued after all), that output is used instead.
+
+    Returns: its output
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+            out, err = proc.communicate()
+        except OSError as e:
+            raise SubmitError("Could not run '{0}': {1}".format(cmd[0], e))
+
+        if proc.returncode == 0:
+            return out
+
+        message = (err or out).strip() \
+            or 'exit status {0}'.format(proc.returncode)
+
+        if is_transient(message) and recover is not None:
+            out = recover()
+            if out is not None:
+                print('  {0} (but it went through)'.format(message))
+                return out
+
+        if not is_transient(message) or attempt == retries:
+            raise SubmitError("'{0}' failed: {1}".format(' '.join(cmd),
+                                                         message))
+
+        delay = backoff * 2 ** attempt
+        print('  {0} (retry in {1}s)'.format(message, delay))
+        sleep(delay)
+
+
+def script_job_name(path):
+    """
+    The job name of a script: its '#SBATCH -J' (or --job-name), or else
+    its file name, as sbatch names it.
+    """
+
+    with open(path, 'r') as f:
+        for line in f:
+            match = re.match(r'^#SBATCH\s+(?:-J\s*|--job-name[=\s]\s*)(\S+)',
+                             line)
+            if match:
+                return match.group(1)
+
+    return os.path.basename(path)
+
+
+def queued_job(job_name, comment, squeue_cmd='squeue', **retry):
+    """
+    Look for the user's job of the given name in the queue that was
+    submitted with the given (unique) comment.
+
+    Returns: its job ID, or None
+    """
+
+    cmd = shlex.split(squeue_cmd) + ['-h', '-n', job_name, '-o', '%i %k',
+                                     '-u', os.environ.get('USER', '')]
+
+    for line in run_command(cmd, **retry).splitlines():
+        fields = line.strip().split(None, 1)
+
+        # A pending job array is listed as <job id>_[1-10]
+        if len(fields) == 2 and fields[1] == comment:
+            return fields[0].split('_')[0]
+
+    return None
+
+
+def sbatch(script, dep_ids, folder, sbatch_cmd='sbatch',
+           squeue_cmd='squeue', **retry):
+    """
+    Submit a script from its own folder (where it expects to run), with
+    an 'afterok' dependency on the given job IDs. The job is tagged with
+    a unique comment, so that a submission that timed out can be looked
+    for in the queue (see queued_job()) before it is retried, and is not
+    queued twice.
+
+    Returns: the job ID
+    """
+
+    comment = 'submit_jobs:' + uuid.uuid4().hex
+
+    cmd = shlex.split(sbatch_cmd) + ['--parsable', '--comment=' + comment]
+    if dep_ids:
+        cmd.append('--dependency=afterok:' + ':'.join(dep_ids))
+    cmd.append(os.path.basename(script))
+
+    job_name = script_job_name(os.path.join(folder, script))
+
+    def recover():
+        return queued_job(job_name, comment, squeue_cmd, **retry)
+
+    out = run_command(cmd, os.path.join(folder, os.path.dirname(script)),
+                      recover=recover, **retry)
+
+    # <job id>[;<cluster>]
+    job_id = out.strip().split(';')[0]
+    if not re.match(r'^\d+$', job_id):
+        raise SubmitError("Unexpected sbatch output for {0}: '{1}'".format(
+                            script, out.strip()))
+
+    return job_id
+
+
+def queued_tasks(squeue_cmd='squeue', **retry):
+    """
+    The number of the user's jobs in the queue (every array task counts).
+    """
+
+    cmd = shlex.split(squeue_cmd) + ['-h', '-r', '-o', '%i',
+                                     '-u', os.environ.get('USER', '')]
+
+    return len([line for line in run_command(cmd, **retry).splitlines()
+                if line.strip()])
+
+
+def wait_for_slots(tasks, max_submit, squeue_cmd='squeue', poll=60,
+                   sleep=time.sleep, **retry):
+    """
+    Wait until 'tasks' more jobs fit in the queue under 'max_submit'.
+    A job larger than the limit waits for an empty queue.
+    """
+
+    while True:
+        queued = queued_tasks(squeue_cmd, sleep=sleep, **retry)
+
+        if queued + tasks <= max_submit or queued == 0:
+            return queued
+
+        print('  {0} jobs in the queue, waiting for {1} free slot(s) '
+              '(limit {2})'.format(queued, tasks, max_submit))
+        sleep(poll)
+
+
+def submit_jobs(folder, jobs, ids, ids_csv, sbatch_cmd='sbatch',
+                squeue_cmd='squeue', max_submit=None, poll=60,
+                retries=5, backoff=30, sleep=time.sleep):
+    """
+    Submit the jobs not submitted yet, in order, recording the job ID
+    of every one in 'ids' (and 'ids_csv') as soon as it is submitted.
+
+    Returns: the number of jobs submitted
+    """
+
+    retry = {'retries': retries, 'backoff': backoff, 'sleep': sleep}
+    n_submitted = 0
+
+    for job in jobs:
+        if job.script in ids:
+            continue
+
+        missing = [d for d in job.dependencies if d not in ids]
+        if missing:
+            raise SubmitError('{0} waits for jobs that were not submitted: '
+                              '{1}'.format(job.script, ' '.join(missing)))
+
+        if max_submit:
+            wait_for_slots(job.tasks, max_submit, squeue_cmd, poll, **retry)
+
+        job_id = sbatch(job.script, [ids[d].job_id for d in job.dependencies],
+                        folder, sbatch_cmd, squeue_cmd, **retry)
+
+        ids[job.script] = submitted_job(
+                            job.script, job_id,
+                            datetime.datetime.now().strftime(
+                                '%Y-%m-%dT%H:%M:%S'))
+        write_job_ids(ids, ids_csv)
+        n_submitted += 1
+
+        print('  {0}: {1}{2}'.format(
+                job.script, job_id,
+                ' (after ' + ', '.join(job.dependencies) + ')'
+                if job.dependencies else ''))
+
+    return n_submitted
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Submit the jobs of a project (or a batch) to SLURM, " \
+                 "with their dependencies."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'folder',
+            help='The project (or batch) folder.')
+
+    parser.add_argument(
+            '--run-file', default=None,
+            help='The run file whose jobs to submit (default: run_project.sh, \
+            or run_batch.sh in a batch folder), e.g. resume_1.sh.')
+
+    parser.add_argument(
+            '--max-submit', type=int, default=None,
+            help="The site's MaxSubmitJobs limit: wait while the queue is \
+            full (default: no limit).")
+
+    parser.add_argument(
+            '--retries', type=int, default=5,
+            help='Retries of a transient scheduler error (default: %(default)s).')
+
+    parser.add_argument(
+            '--backoff', type=float, default=30,
+            help='Secs before the first retry, doubled every time \
+            (default: %(default)s).')
+
+    parser.add_argument(
+            '--poll', type=float, default=60,
+            help='Secs between the checks of a full queue (default: %(default)s).')
+
+    parser.add_argument(
+            '--sbatch', default='sbatch',
+            help='The sbatch command (default: %(default)s).')
+
+    parser.add_argument(
+            '--squeue', default='squeue',
+            help='The squeue command (default: %(default)s).')
+
+    parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only list the jobs that would be submitted.')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    run_file = args.run_file
+    if run_file is None:
+        run_file = 'run_project.sh'
+        if os.path.isfile(graph_file(args.folder, 'run_batch.sh')):
+            run_file = 'run_batch.sh'
+
+    graph_csv = graph_file(args.folder, run_file)
+    if not os.path.isfile(graph_csv):
+        print("No jobs found for '{0}' ({1} is missing). Exiting...".format(
+                run_file, graph_csv))
+        exit(1)
+
+    jobs = read_job_graph(graph_csv)
+    ids_csv = ids_file(args.folder, run_file)
+    ids = read_job_ids(ids_csv)
+
+    todo = [job for job in jobs if job.script not in ids]
+    print('{0}: {1} job(s), {2} already submitted'.format(
+            run_file, len(jobs), len(jobs) - len(todo)))
+
+    if args.dry_run:
+        for job in todo:
+            print('  {0} (after: {1})'.format(
+                    job.script, ' '.join(job.dependencies) or '-'))
+        return
+
+    try:
+        n_submitted = submit_jobs(args.folder, jobs, ids, ids_csv,
+                                  args.sbatch, args.squeue, args.max_submit,
+                                  args.poll, args.retries, args.backoff)
+    except SubmitError as e:
+        print(e)
+        print('{0} job(s) submitted, see {1}. Run again to submit the '
+              'rest.'.format(len(ids) - (len(jobs) - len(todo)), ids_csv))
+        exit(1)
+
+    print('{0} job(s) submitted, the job IDs are in {1}'.format(n_submitted,
+                                                              ids_csv))
+
+
+if __name__ == '__main__':
+    main()
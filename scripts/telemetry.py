@@ -0,0 +1,531 @@
+#!/usr/bin/python
+
+"""
+Resource telemetry of the submitted jobs: how much of the walltime,
+the cores and the memory they requested they actually used.
+
+The records come from 'sacct --parsable' dumps with the fields:
+
+    JobID,JobName,State,Elapsed,Timelimit,AllocCPUS,TotalCPU,ReqMem,
+    MaxRSS,MaxDiskRead,MaxDiskWrite,Submit
+
+(or from running such a command, e.g. a local stand-in of sacct, with
+--sacct-command), and optionally from the output of 'seff <job id>'.
+They are joined with the 'plan_info.csv' file of every project (see
+runtime_store.join_plan()) and kept in a local database, one row per
+job, e.g.
+
+    $ sacct --parsable -S 2017-01-01 -o JobID,JobName,State,Elapsed,\\
+          Timelimit,AllocCPUS,TotalCPU,ReqMem,MaxRSS,MaxDiskRead,\\
+          MaxDiskWrite,Submit > dump.txt
+    $ python scripts/telemetry.py projects/<project>/metadata/plan_info.csv \\
+          --sacct dump.txt
+
+Then a report is printed for every project, with the efficiency of
+every stage and a flag for the over- or under-provisioned ones.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+
+import os
+import re
+import shlex
+import sqlite3
+import argparse
+import textwrap
+import subprocess
+
+import runtime_store
+import resource_model
+import script_generator
+
+
+__version__ = '0.1.0'
+
+# Default location of the telemetry database (next to the projects)
+DEFAULT_DB = 'projects/telemetry.db'
+
+# The sacct fields read (and asked for, with --sacct-command)
+SACCT_FIELDS = ['JobID', 'JobName', 'State', 'Elapsed', 'Timelimit',
+                'AllocCPUS', 'TotalCPU', 'ReqMem', 'MaxRSS',
+                'MaxDiskRead', 'MaxDiskWrite', 'Submit']
+
+# A stage is over-provisioned when its jobs use less than this fraction
+# of the cores, memory or walltime they request...
+LOW_USE = {'cpu': 0.5, 'mem': 0.5, 'time': 0.3}
+
+# ...and under-provisioned when they use more than this (or fail for
+# lack of memory/time)
+HIGH_USE = {'mem': 0.9, 'time': 0.9}
+
+# The states of the jobs that ran out of what they requested
+STARVED_STATES = ('OUT_OF_MEMORY', 'TIMEOUT')
+
+# The usage of a job:
+#   elapsed, timelimit, cpu_secs - seconds (timelimit None if unlimited)
+#   req_mem_gb, max_rss_gb       - GB (None if unknown)
+#   read_gb, write_gb            - GB read/written by the busiest step
+#   submitted                    - the submit time (None if unknown)
+job_usage = namedtuple('job_usage', [
+                        'job_id', 'job_name', 'state', 'elapsed',
+                        'timelimit', 'cpus', 'cpu_secs', 'req_mem_gb',
+                        'max_rss_gb', 'read_gb', 'write_gb', 'submitted'
+                        ])
+
+# The efficiency of a stage of a project (fractions; None if unknown)
+stage_report = namedtuple('stage_report', [
+                        'stage', 'jobs', 'failed', 'starved', 'elapsed',
+                        'cpu_eff', 'mem_eff', 'time_used', 'read_gb',
+                        'write_gb', 'flags'
+                        ])
+
+
+class TelemetryStore(object):
+    """
+    A thin wrapper around an SQLite database with a single table,
+    holding the usage of every job we have seen.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                job_id      TEXT PRIMARY KEY,
+                project     TEXT,
+                job_name    TEXT,
+                stage       TEXT,
+                n_items     INTEGER,
+                input_bytes INTEGER,
+                reference   TEXT,
+                state       TEXT,
+                elapsed     INTEGER,
+                timelimit   INTEGER,
+                cpus        INTEGER,
+                cpu_secs    INTEGER,
+                req_mem_gb  REAL,
+                max_rss_gb  REAL,
+                read_gb     REAL,
+                write_gb    REAL
+            )""")
+        self.conn.commit()
+
+    def add(self, project, info, usage):
+        """
+        Add (or replace) the usage of a job, with its 'plan_info.csv' row.
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO usage VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (usage.job_id, project, usage.job_name, info['stage'],
+             int(info['n_items']), int(info['input_bytes'] or 0),
+             info['reference'], usage.state, usage.elapsed,
+             usage.timelimit, usage.cpus, usage.cpu_secs, usage.req_mem_gb,
+             usage.max_rss_gb, usage.read_gb, usage.write_gb))
+
+    def commit(self):
+        self.conn.commit()
+
+    def records(self, project):
+        """
+        Return {stage: [job_usage]} of the jobs of a project.
+        """
+        rows = self.conn.execute(
+            "SELECT stage, job_id, job_name, state, elapsed, timelimit, "
+            "cpus, cpu_secs, req_mem_gb, max_rss_gb, read_gb, write_gb "
+            "FROM usage WHERE project=? ORDER BY job_id", (project,))
+
+        stages = {}
+        for row in rows:
+            # The submit time is only needed to ingest a job
+            stages.setdefault(row[0], []).append(
+                job_usage(*(tuple(row[1:]) + (None,))))
+
+        return stages
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_req_mem(value, cpus):
+    """
+    Convert a sacct ReqMem value to GB. The older sacct versions suffix
+    it with 'n' (per node) or 'c' (per core, so times the cores).
+    """
+
+    value = value.strip()
+    per_core = value.endswith('c')
+
+    gb = resource_model.parse_mem(value.rstrip('nc'))
+    if gb is not None and per_core:
+        gb *= cpus
+
+    return gb
+
+
+def parse_sacct(lines):
+    """
+    Read the usage of every job of a 'sacct --parsable' output (a header
+    line, then one line per job or job step). The memory and I/O are
+    reported on the steps (e.g. 1234.batch); a job gets the largest of
+    its steps. The tasks of a job array (e.g. 1234_7) are separate jobs.
+
+    Returns: a list of 'job_usage's, in the order of the output
+    """
+
+    lines = iter(lines)
+    header = runtime_store.parsable_fields(next(lines, ''))
+
+    jobs = []
+    steps = {}
+
+    for line in lines:
+        fields = runtime_store.parsable_fields(line)
+        if len(fields) != len(header):
+            continue
+
+        rec = dict(zip(header, fields))
+        job_id = rec['JobID'].split('.')[0]
+
+        if '.' not in rec['JobID']:
+            cpus = int(rec.get('AllocCPUS') or 0)
+            limit = rec.get('Timelimit', '')
+
+            jobs.append(job_usage(
+                job_id, rec['JobName'], rec['State'].split()[0],
+                runtime_store.parse_elapsed(rec['Elapsed']),
+                runtime_store.parse_elapsed(limit)
+                if limit[:1].isdigit() else None,
+                cpus,
+                runtime_store.parse_elapsed(rec['TotalCPU'])
+                if rec.get('TotalCPU') else None,
+                parse_req_mem(rec.get('ReqMem', ''), cpus),
+                None, None, None, rec.get('Submit') or None))
+
+        # Keep the largest memory/I/O of the job and its steps
+        peak = steps.setdefault(job_id, [None, None, None])
+        for i, field in enumerate(('MaxRSS', 'MaxDiskRead', 'MaxDiskWrite')):
+            value = resource_model.parse_mem(rec.get(field, ''))
+            if value is not None:
+                peak[i] = max(peak[i], value) if peak[i] is not None \
+                    else value
+
+    return [job._replace(max_rss_gb=steps[job.job_id][0],
+                         read_gb=steps[job.job_id][1],
+                         write_gb=steps[job.job_id][2]) for job in jobs]
+
+
+def parse_seff(text):
+    """
+    Read the output of 'seff <job id>'. Only what sacct might miss is
+    kept: the job ID (and name, if printed), the state, the cores, the
+    CPU time and the memory used/requested.
+
+    Returns: a dictionary, by the field names of 'job_usage'
+    """
+
+    rec = {}
+
+    patterns = [
+        ('job_id', r'^Job ID:\s*(\S+)', str),
+        ('job_name', r'^Job Name:\s*(\S+)', str),
+        ('state', r'^State:\s*(\S+)', str),
+        ('cpus', r'^Cores(?: per node)?:\s*(\d+)', int),
+        ('cpu_secs', r'^CPU Utilized:\s*(\S+)', runtime_store.parse_elapsed),
+        ('elapsed', r'^Job Wall-clock time:\s*(\S+)',
+         runtime_store.parse_elapsed),
+        ('max_rss_gb', r'^Memory Utilized:\s*([\d.]+ ?[KMGT]?)B',
+         lambda v: resource_model.parse_mem(v.replace(' ', ''))),
+        ('req_mem_gb', r'^Memory Efficiency:.* of ([\d.]+ ?[KMGT]?)B',
+         lambda v: resource_model.parse_mem(v.replace(' ', '')))
+        ]
+
+    for field, pattern, convert in patterns:
+        match = re.search(pattern, text, re.MULTILINE)
+        if match:
+            rec[field] = convert(match.group(1))
+
+    return rec
+
+
+def merge_seff(jobs, seff_recs):
+    """
+    Fill in the usage of the sacct jobs with their seff records; the
+    seff records of jobs sacct did not report are added, if they name
+    their job.
+
+    Returns: the list of 'job_usage's
+    """
+
+    by_id = dict((rec.get('job_id'), rec) for rec in seff_recs)
+    merged = []
+
+    for job in jobs:
+        rec = by_id.pop(job.job_id, {})
+        merged.append(job._replace(**dict(
+                (k, v) for k, v in rec.items()
+                if getattr(job, k) is None)))
+
+    for job_id, rec in sorted(by_id.items()):
+        if rec.get('job_name') and rec.get('elapsed') is not None:
+            values = dict((f, None) for f in job_usage._fields)
+            values.update(rec)
+            merged.append(job_usage(**values))
+
+    return merged
+
+
+def run_sacct(command, names):
+    """
+    Run sacct (or a local stand-in) for the given job names.
+
+    Returns: its output lines
+    """
+
+    cmd = shlex.split(command) + [
+            '--parsable', '--format=' + ','.join(SACCT_FIELDS),
+            '--name=' + ','.join(sorted(names))]
+
+    return subprocess.check_output(cmd).decode('utf-8').splitlines(True)
+
+
+def project_name(plan_file):
+    """
+    The name of the project of a 'projects/<project>/metadata/plan_info.csv'
+    """
+    return os.path.basename(os.path.dirname(os.path.dirname(
+                            os.path.abspath(plan_file))))
+
+
+def ingest(store, project, plan_file, jobs):
+    """
+    Add the jobs of the project (see runtime_store.join_plan()) to the
+    store. The jobs still pending or running are left out.
+
+    Returns: the number of jobs added
+    """
+
+    joined = runtime_store.join_plan(plan_file, [
+                (job.job_id, job.job_name, job.submitted) for job in jobs])
+    added = 0
+
+    for job in jobs:
+        info = joined.get(job.job_id)
+
+        if info is None or job.state in ('PENDING', 'RUNNING'):
+            continue
+
+        store.add(project, info, job)
+        added += 1
+
+    store.commit()
+
+    return added
+
+
+def ratio(used, requested):
+    """
+    The total used over the total requested, or None if either is unknown.
+    """
+
+    pairs = [(u, r) for u, r in zip(used, requested)
+             if u is not None and r]
+
+    if not pairs:
+        return None
+
+    return sum(u for u, _ in pairs) / sum(r for _, r in pairs)
+
+
+def stage_efficiency(stage, jobs):
+    """
+    Summarise the usage of the jobs of a stage, and flag it:
+
+        over  - the completed jobs use little of the cores, memory or
+                walltime they request (LOW_USE)
+        under - some jobs ran out of memory/time, or they use almost all
+                of what they request (HIGH_USE)
+
+    Returns: a 'stage_report'
+    """
+
+    done = [j for j in jobs if j.state.startswith('COMPLETED')]
+    starved = [j for j in jobs if j.state.startswith(STARVED_STATES)]
+
+    cpu_eff = ratio([j.cpu_secs for j in done],
+                    [j.elapsed * (j.cpus or 0) for j in done])
+    mem_eff = ratio([j.max_rss_gb for j in done],
+                    [j.req_mem_gb for j in done])
+    time_used = ratio([j.elapsed for j in done],
+                      [j.timelimit for j in done])
+
+    # The busiest job tells whether the stage is close to its limits
+    peak_mem = max([j.max_rss_gb / j.req_mem_gb for j in done
+                    if j.max_rss_gb is not None and j.req_mem_gb] or [None])
+    peak_time = max([j.elapsed / j.timelimit for j in done
+                     if j.timelimit] or [None])
+
+    mem_high = peak_mem is not None and peak_mem > HIGH_USE['mem']
+    time_high = peak_time is not None and peak_time > HIGH_USE['time']
+
+    flags = []
+    if starved:
+        flags.append('under: {0} job(s) {1}'.format(
+                len(starved), '/'.join(sorted(set(j.state for j in starved)))))
+    if mem_high:
+        flags.append('under: memory {0:.0%} used'.format(peak_mem))
+    if time_high:
+        flags.append('under: walltime {0:.0%} used'.format(peak_time))
+
+    # A stage is not over-provisioned if its busiest job was close to
+    # the limit, whatever the average
+    for name, label, value, high in (('cpu', 'cores', cpu_eff, False),
+                                     ('mem', 'memory', mem_eff, mem_high),
+                                     ('time', 'walltime', time_used,
+                                      time_high)):
+        if value is not None and value < LOW_USE[name] and not high:
+            flags.append('over: {0} {1:.0%} used'.format(label, value))
+
+    return stage_report(
+            stage, len(jobs), len(jobs) - len(done), len(starved),
+            max([j.elapsed for j in done] or [0]), cpu_eff, mem_eff,
+            time_used,
+            sum(j.read_gb or 0 for j in jobs),
+            sum(j.write_gb or 0 for j in jobs), flags)
+
+
+def project_report(store, project):
+    """
+    Returns: a list of 'stage_report's, in the order of the pipeline
+    """
+
+    stages = store.records(project)
+    order = {'mkfastq': 0, 'count': 1, 'aggr': 2}
+
+    return [stage_efficiency(stage, stages[stage])
+            for stage in sorted(stages, key=lambda s: (order.get(s, 3), s))]
+
+
+def print_report(project, reports):
+    """
+    Print the efficiency of every stage of a project.
+    """
+
+    def pct(value):
+        return '-' if value is None else '{0:.0%}'.format(value)
+
+    print('Project {0}'.format(project))
+
+    if not reports:
+        print('  no finished jobs recorded\n')
+        return
+
+    fmt = '  {0:<8} {1:>5} {2:>6} {3:>12} {4:>6} {5:>6} {6:>6} {7:>9} {8:>9}'
+    print(fmt.format('stage', 'jobs', 'failed', 'longest', 'cpu', 'mem',
+                     'time', 'read GB', 'write GB'))
+
+    for rep in reports:
+        print(fmt.format(rep.stage, rep.jobs, rep.failed,
+                         script_generator.format_walltime(rep.elapsed),
+                         pct(rep.cpu_eff), pct(rep.mem_eff),
+                         pct(rep.time_used),
+                         '{0:.1f}'.format(rep.read_gb),
+                         '{0:.1f}'.format(rep.write_gb)))
+
+    for rep in reports:
+        for flag in rep.flags:
+            print('  {0}: {1}'.format(rep.stage, flag))
+
+    print()
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Record the resource usage of the jobs of the projects, " \
+                 "and report the efficiency of every stage."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'plan_info', nargs='+',
+            help="The 'metadata/plan_info.csv' file(s) of the projects.")
+
+    parser.add_argument(
+            '--sacct', nargs='+', default=[],
+            help="Output(s) of 'sacct --parsable -o {0}'.".format(
+                    ','.join(SACCT_FIELDS)))
+
+    parser.add_argument(
+            '--sacct-command',
+            help="Run this command (e.g. 'sacct -S 2017-01-01', or a local \
+            stand-in) to get the records of the projects' jobs.")
+
+    parser.add_argument(
+            '--seff', nargs='+', default=[],
+            help="Output(s) of 'seff <job id>', one per file.")
+
+    parser.add_argument(
+            '--db', default=DEFAULT_DB,
+            help='The telemetry database (default: %(default)s).')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    jobs = []
+    for dump in args.sacct:
+        with open(dump, 'r') as f:
+            jobs.extend(parse_sacct(f))
+
+    plans = [(project_name(p), p) for p in args.plan_info]
+
+    if args.sacct_command:
+        names = set(name for p in args.plan_info
+                    for name in runtime_store.read_plan_info(p))
+
+        try:
+            jobs.extend(parse_sacct(run_sacct(args.sacct_command, names)))
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Could not run {0}: {1}'.format(args.sacct_command, e))
+            exit(1)
+
+    seff_recs = []
+    for seff_file in args.seff:
+        with open(seff_file, 'r') as f:
+            seff_recs.append(parse_seff(f.read()))
+
+    jobs = merge_seff(jobs, seff_recs)
+
+    store = TelemetryStore(args.db)
+
+    for project, plan_file in plans:
+        added = ingest(store, project, plan_file, jobs)
+        if added:
+            print('{0} job(s) of {1} added to {2}'.format(added, project,
+                                                          args.db))
+
+    print()
+
+    for project, _ in plans:
+        print_report(project, project_report(store, project))
+
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+"""
+A compiled (and cached) version of the template renderer that used to
+live in script_generator.generate_script().
+
+Areas that need to be edited on the template script should contain a
+'?' at the beginning of the line, followed by a string that matches
+one of the given argument keys. The '?' line is deleted, after either
+appending the next line with the right value (if the value was given),
+or deleting the next line too (if no value was given or if no such a
+key was found). If the next line ends with a quotation mark, the value
+goes between the quotation marks, if it ends with a '=' right after it,
+otherwise at the end of the line, after a space.
+
+Every template is parsed once into a list of literal text segments and
+placeholder slots, and kept in a cache until the file changes on disk.
+
+Run this file to compare it with the line by line renderer:
+
+    $ python scripts/template_engine.py scripts/count_template.bash -n 5000
+"""
+
+from __future__ import print_function
+from collections import namedtuple
+
+import os
+import io
+import sys
+import time
+import argparse
+import textwrap
+
+
+__version__ = '0.1.0'
+
+
+# A placeholder: the candidate keys of its '?' line, and the text to put
+# before/after the value. 'prefix' is None when the '?' line is the last
+# line of the template (i.e. it has no line to place the value on)
+slot = namedtuple('slot', ['keys', 'prefix', 'suffix'])
+
+# The compiled templates, by path: {path: (mtime, segments)}
+_cache = {}
+
+
+def compile_lines(lines):
+    """
+    Compile the lines of a template into a list of segments. A segment
+    is either a string (literal text, copied as it is), or a 'slot'.
+    """
+
+    segments = []
+    literal = []
+
+    lines = iter(lines)
+    for line in lines:
+        if not line.startswith('?'):
+            literal.append(line)
+            continue
+
+        if literal:
+            segments.append(''.join(literal))
+            literal = []
+
+        # The line after the '?' line is where the value goes
+        next_line = next(lines, None)
+        keys = frozenset(line[1:].split())
+
+        if next_line is None:
+            segments.append(slot(keys, None, None))
+            continue
+
+        next_line = next_line.strip()
+
+        # Is the last char of the line a quotation mark or a '='?
+        if next_line[-1:] in ('"', "'"):
+            segments.append(slot(keys, next_line[:-1],
+                                 next_line[-1:] + '\n'))
+
+        elif next_line[-1:] == '=':
+            segments.append(slot(keys, next_line, '\n'))
+
+        else:
+            segments.append(slot(keys, next_line + ' ', '\n'))
+
+    if literal:
+        segments.append(''.join(literal))
+
+    return segments
+
+
+def load_template(path):
+    """
+    Return the compiled segments of the template at the given path,
+    compiling it only if it is not cached or it changed since.
+    """
+
+    mtime = os.path.getmtime(path)
+    cached = _cache.get(path)
+
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as template:
+            cached = (mtime, compile_lines(template.readlines()))
+
+        _cache[path] = cached
+
+    return cached[1]
+
+
+def render(segments, params):
+    """
+    Render the compiled template with the given parameters (a dictionary).
+    Returns the script's content as a string.
+    """
+
+    out = []
+
+    for seg in segments:
+        if not isinstance(seg, slot):
+            out.append(seg)
+            continue
+
+        # Only one of the line's keys should be among the given keys
+        matches = [k for k in seg.keys if k in params]
+        if len(matches) != 1:
+            continue
+
+        # If the value is None, the line is omitted
+        value = params[matches[0]]
+        if value is None:
+            continue
+
+        if seg.prefix is None:
+            raise ValueError("No line after '?{0}' to place its value."
+                             .format(matches[0]))
+
+        out.append(seg.prefix + str(value) + seg.suffix)
+
+    return ''.join(out)
+
+
+def render_batch(jobs, buffer_size=1 << 20):
+    """
+    Render many scripts in one pass.
+
+    Input:
+        jobs: [list] of (template path, output path, parameters) tuples
+
+    Every template is compiled once, and every output is written with a
+    single buffered write.
+
+    Returns: the list of the output paths
+    """
+
+    outputs = []
+
+    for template, output, params in jobs:
+        content = render(load_template(template), params)
+
+        with io.open(output, 'wb', buffering=buffer_size) as f:
+            f.write(content.encode('utf-8')
+                    if not isinstance(content, bytes) else content)
+
+        outputs.append(output)
+
+    return outputs
+
+
+def render_lines(lines, args_dict):
+    """
+    The original, line by line renderer (the template is scanned again
+    for every script). Kept as the reference of the compiled renderer.
+    """
+
+    # Get a set of the given keys
+    args_keys = set(args_dict.keys())
+    template_buf = iter(lines)
+    out = []
+
+    for line in template_buf:
+        # Lines starting with '?' in the template, indicate
+        # positions where the argument keys can be found
+        if line.startswith('?'):
+            # Gets the string after '?' in a list
+            linesplit = line[1:].split()
+
+            # Get the matches of the key set and the linesplit as list
+            arg_match = list(args_keys.intersection(linesplit))
+
+            # Check whether only one match found
+            if arg_match and len(arg_match) == 1:
+                # Get the value of the matched key
+                arg_val = args_dict[arg_match[0]]
+
+                # If the value is None, line should be omitted
+                if arg_val is None:
+                    line = ''
+                    next(template_buf, None)
+
+                else:
+                    # Get the next line and strip any extra whitespace
+                    next_line = next(template_buf).strip()
+
+                    # Is the last char of the line a quotation mark or a '='?
+                    if next_line[-1:] in ('"', "'"):
+                        # Place the argument value between quotation marks
+                        line = next_line[:-1] \
+                                + str(arg_val) \
+                                + next_line[-1:] + '\n'
+
+                    elif next_line[-1:] == '=':
+                        # Place the argument value next to '=' without space
+                        line = next_line + str(arg_val) + '\n'
+                    else:
+                        # Place the argument value at the end of the line
+                        line = next_line + ' ' + str(arg_val) + '\n'
+
+            else:
+                # If more or None matches found line should be omitted
+                line = ''
+                next(template_buf, None)
+
+        out.append(line)
+
+    return ''.join(out)
+
+
+def benchmark(template, n_scripts):
+    """
+    Render the template 'n_scripts' times with both renderers, check
+    that the outputs are identical and print the time each one took.
+    (The line by line renderer also re-reads the file every time.)
+    """
+
+    params = [{'uppmax_project_name': 'b2017001', 'partition': 'core',
+               'num_cores': 16, 'time_request': '1-02:00:00',
+               'job_description': 'bench_{0}'.format(i),
+               'sbatch_output': 'slurm_out/bench_{0}.out'.format(i),
+               'bash_lane_or_sample_list': 'S{0} S{1}'.format(i, i + 1),
+               'cranger_localcores': 8, 'cranger_localmem': 56,
+               'hiseq_datapath': '/data/run_{0}'.format(i),
+               'samplesheet_loc': 'sheet.csv', 'use_qos_short': None,
+               'reference_genome': 'mm'} for i in range(n_scripts)]
+
+    start = time.time()
+    reference = []
+    for p in params:
+        with open(template, 'r') as f:
+            reference.append(render_lines(f.readlines(), p))
+    line_secs = time.time() - start
+
+    _cache.pop(template, None)
+
+    start = time.time()
+    compiled = [render(load_template(template), p) for p in params]
+    compiled_secs = time.time() - start
+
+    if compiled != reference:
+        print('The outputs of the two renderers differ!')
+        return 1
+
+    print('{0} scripts, identical output'.format(n_scripts))
+    print('  line by line: {0:.3f}s'.format(line_secs))
+    print('  compiled:     {0:.3f}s ({1:.1f}x)'.format(
+            compiled_secs, line_secs / max(compiled_secs, 1e-9)))
+
+    return 0
+
+
+def main():
+    # Create a text wrapper for the help output text
+    w = textwrap.TextWrapper(width=90,
+                             break_long_words=False,
+                             replace_whitespace=False)
+
+    help_descr = "Benchmark the compiled template renderer."
+
+    # Initialize a parser
+    parser = argparse.ArgumentParser(
+                 description=help_descr,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # -- Add the appropriate arguments -- #
+    parser.add_argument(
+            '-v', '--version',
+            action='version',
+            version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument(
+            'template',
+            help='The template to render.')
+
+    parser.add_argument(
+            '-n', type=int, default=1000, dest='n_scripts',
+            help='Number of scripts to render (default: %(default)s).')
+
+    # Parse the given arguments
+    args = parser.parse_args()
+
+    sys.exit(benchmark(args.template, args.n_scripts))
+
+
+if __name__ == '__main__':
+    main()
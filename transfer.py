@@ -0,0 +1,341 @@
+#!/usr/bin/python
+
+"""
+A small transfer scheduler, used by make_deliverable.py.
+
+The work is split into independent units (e.g. the count folder of a
+sample), which are copied by a bounded pool of worker threads. Every
+unit is retried a few times before giving up, and rsync keeps the
+partially transferred files (--partial), so a retry (or a new run)
+resumes where the previous one stopped.
+
+When the source and the destination are on the same filesystem, the
+LinkCopier can be used instead of rsync: it creates reflinks (copy on
+write clones) or hardlinks instead of copying the data.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+from collections import OrderedDict
+
+import os
+import re
+import time
+import errno
+import shutil
+import threading
+import subprocess
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on this platform; no reflinks
+    fcntl = None
+
+
+# The ioctl that clones a file on Linux (btrfs, XFS, ...): _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+# A piece of work: copy 'source' (file or folder) into the 'dest' folder
+transfer_unit = namedtuple('transfer_unit', ['project', 'source', 'dest'])
+
+# The outcome of a unit
+unit_result = namedtuple('unit_result', [
+                        'unit', 'ok', 'bytes', 'secs',
+                        'start', 'end', 'attempts', 'error'
+                        ])
+
+
+class TransferError(Exception):
+    pass
+
+
+def rsync_copy(source, dest):
+    """
+    Copy the source into the dest folder with rsync, keeping the
+    partially transferred files so that a new attempt resumes them.
+    The mtimes are kept (-t), so that the files already copied are
+    skipped; any other file (a partial one, or one that changed
+    upstream, even without growing) is transferred again, with the
+    kept data as the basis of rsync's delta transfer.
+
+    Returns: the number of bytes transferred
+    """
+
+    cmd = ['rsync', '-rt', '--partial', '--stats', source, dest]
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    out, err = proc.communicate()
+
+    if proc.returncode != 0:
+        raise TransferError('rsync exited with {0}: {1}'.format(
+                            proc.returncode, err.strip()))
+
+    # e.g. "Total transferred file size: 1,234,567 bytes"
+    match = re.search(r'Total transferred file size: ([\d,.]+)', out)
+
+    return int(re.sub(r'[,.]', '', match.group(1))) if match else 0
+
+
+class LinkCopier(object):
+    """
+    A copier that materialises the source tree in the dest folder without
+    copying the data, when they are on the same filesystem: every file
+    is reflinked if the filesystem supports it, or hardlinked otherwise.
+    Files that can be neither (e.g. on another device) are copied.
+
+    The strategy used for every file is kept in 'records', as
+    (dest path, strategy, bytes) tuples.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._reflinks = fcntl is not None
+
+    def __call__(self, source, dest):
+        target = os.path.join(dest, os.path.basename(source.rstrip('/')))
+        total = 0
+
+        if os.path.isfile(source):
+            return self._link_file(source, target)
+
+        for root, dirs, files in os.walk(source):
+            out_dir = os.path.join(target, os.path.relpath(root, source))
+
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+
+            for f in files:
+                total += self._link_file(os.path.join(root, f),
+                                         os.path.join(out_dir, f))
+
+        return total
+
+    def _link_file(self, src, dst):
+        """
+        Link (or copy) a single file, and record the strategy used.
+        """
+
+        size = os.path.getsize(src)
+
+        if os.path.exists(dst):
+            # Already linked (e.g. a resumed deliverable)
+            if os.path.samefile(src, dst):
+                self._record(dst, 'hardlink', size)
+                return size
+
+            os.remove(dst)
+
+        same_dev = os.stat(src).st_dev == \
+            os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+
+        if same_dev and self._reflinks and reflink(src, dst):
+            strategy = 'reflink'
+        elif same_dev and hardlink(src, dst):
+            strategy = 'hardlink'
+        else:
+            shutil.copy2(src, dst)
+            strategy = 'copy'
+
+        self._record(dst, strategy, size)
+
+        return size
+
+    def _record(self, dst, strategy, size):
+        with self._lock:
+            self.records.append((os.path.normpath(dst), strategy, size))
+
+    def write_manifest(self, manifest_file):
+        """
+        Write the strategy used for every file in a tab separated file.
+        The files of an existing manifest (e.g. of a resumed or rebuilt
+        deliverable) that were not linked now are kept, unless they are
+        no longer in the deliverable.
+        """
+
+        entries = {}
+
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                next(f, None)
+
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 3 and os.path.lexists(fields[0]):
+                        entries[fields[0]] = (fields[1], fields[2])
+
+        for dst, strategy, size in self.records:
+            entries[dst] = (strategy, size)
+
+        with open(manifest_file, 'w') as f:
+            f.write('path\tstrategy\tbytes\n')
+
+            for dst in sorted(entries):
+                f.write('{0}\t{1}\t{2}\n'.format(dst, *entries[dst]))
+
+
+def reflink(src, dst):
+    """
+    Clone the src file as dst (copy on write). Returns False if the
+    filesystem does not support it.
+    """
+
+    try:
+        with open(src, 'rb') as s:
+            with open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except (IOError, OSError) as e:
+        if os.path.exists(dst):
+            os.remove(dst)
+
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                       errno.EINVAL, errno.ENOSYS, errno.EPERM):
+            return False
+        raise
+
+    shutil.copystat(src, dst)
+
+    return True
+
+
+def hardlink(src, dst):
+    """
+    Hardlink the src file as dst. Returns False if it is not possible.
+    """
+
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            return False
+        raise
+
+    return True
+
+
+def run_unit(unit, copier, retries, backoff):
+    """
+    Copy a unit, retrying it up to 'retries' times (waiting a bit
+    longer after every failed attempt).
+
+    Returns: a 'unit_result'
+    """
+
+    start = time.time()
+    error = None
+
+    for attempt in range(1, retries + 2):
+        try:
+            copied = copier(unit.source, unit.dest)
+        except TransferError as e:
+            error = str(e)
+
+            if attempt <= retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+        except (IOError, OSError) as e:
+            # e.g. the copy command is missing; retrying will not help
+            error = str(e)
+            break
+        else:
+            end = time.time()
+            return unit_result(unit, True, copied, end - start,
+                               start, end, attempt, None)
+
+    end = time.time()
+    return unit_result(unit, False, 0, end - start,
+                       start, end, attempt, error)
+
+
+def run_transfers(units, streams=4, retries=2, copier=rsync_copy,
+                  backoff=5):
+    """
+    Copy all the units, running up to 'streams' of them at the same time.
+
+    Returns: the list of 'unit_result's, in the order of the units
+    """
+
+    todo = queue.Queue()
+    for pos, unit in enumerate(units):
+        todo.put((pos, unit))
+
+    results = [None] * len(units)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                pos, unit = todo.get_nowait()
+            except queue.Empty:
+                return
+
+            result = run_unit(unit, copier, retries, backoff)
+            results[pos] = result
+
+            with lock:
+                print('{0} {1} ({2})'.format(
+                        'Done:  ' if result.ok else 'FAILED:',
+                        unit.source, format_bytes(result.bytes)))
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(max(1, min(streams, len(units))))]
+
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    for w in workers:
+        w.join()
+
+    return results
+
+
+def format_bytes(num_bytes):
+    """
+    Format the given number of bytes in a human readable way (e.g. 3.2G).
+    """
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if abs(num_bytes) < 1024 or unit == 'T':
+            return '{0:.1f}{1}'.format(num_bytes, unit)
+
+        num_bytes /= 1024
+
+
+def print_summary(results):
+    """
+    Print the bytes, the time and the throughput of every project, and
+    the units that failed (if any).
+
+    Returns: True if all the units were transferred
+    """
+
+    projects = OrderedDict()
+    for r in results:
+        projects.setdefault(r.unit.project, []).append(r)
+
+    print('\nTransfer summary:')
+
+    for project, res in projects.items():
+        copied = sum(r.bytes for r in res)
+        secs = max(r.end for r in res) - min(r.start for r in res)
+        failed = [r for r in res if not r.ok]
+
+        print('  {0}: {1} in {2:.0f}s ({3}/s), {4}/{5} units ok'.format(
+                project, format_bytes(copied), secs,
+                format_bytes(copied / max(secs, 1e-3)),
+                len(res) - len(failed), len(res)))
+
+        for r in failed:
+            print('    FAILED {0} after {1} attempt(s): {2}'.format(
+                    r.unit.source, r.attempts, r.error))
+
+    return all(r.ok for r in results)
@@ -1,58 +1,820 @@
 #!/usr/bin/python
 
+"""
+Zip a folder (excluding this script).
+
+The members are compressed in parallel by a pool of processes and
+written one after the other into a ZIP64 archive, which the standard
+'unzip' and Python's 'zipfile' can read. Files that are already
+compressed (e.g. .fastq.gz, .bam, .h5) are STORED as they are, since
+deflating them again only burns CPU time.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from collections import namedtuple
+from collections import deque
+
 import os
 import re
+import sys
+import time
+import zlib
+import struct
+import shutil
 import zipfile
 import fnmatch
+import tempfile
 import textwrap
 import argparse
+import multiprocessing
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # The backport of os.scandir(), for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 __version__ = "0.1.0"
 
 
-def zipdir(path, ziph, exclude=[], regex=[]):
+# Sizes and offsets above this need the ZIP64 extensions (as in zipfile)
+ZIP64_LIMIT = (1 << 31) - 1
+
+# Files are read and written in blocks of this size. The files that fit
+# in one block are compressed in memory, larger ones into a temporary file
+BLOCK_SIZE = 1 << 20
+
+# Members queued per worker, ahead of the one being written
+WINDOW = 4
+
+# Already compressed formats, by extension...
+COMPRESSED_EXT = ('.gz', '.bgz', '.bz2', '.xz', '.zst', '.zip', '.bam',
+                  '.cram', '.h5', '.hdf5', '.loom', '.png', '.jpg', '.jpeg')
+
+# ...and by magic bytes (gzip/bgzf, bzip2, xz, zip, zstd, HDF5, PNG,
+# JPEG, CRAM)
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00', b'PK\x03\x04',
+                    b'\x28\xb5\x2f\xfd', b'\x89HDF\r\n\x1a\n', b'\x89PNG',
+                    b'\xff\xd8\xff', b'CRAM')
+
+# The compiled exclusion rules of zipdir()
+matcher = namedtuple('matcher', ['dirs', 'files'])
+
+# An archive member, as needed for the central directory
+zip_member = namedtuple('zip_member', [
+                        'name', 'flags', 'method', 'dostime', 'dosdate',
+                        'crc', 'size', 'comp_size', 'offset', 'mode', 'zip64'
+                        ])
+
+# The outcome of a member: 'secs' is the time spent compressing (or
+# copying, for the STORED ones)
+member_stat = namedtuple('member_stat', [
+                        'name', 'method', 'size', 'comp_size', 'secs'
+                        ])
+
+
+def is_compressed(data):
     """
-    Inputs:
-        path    - the path of the directory you want to zip
-        ziph    - a zip handler [zipfile.ZipFile() object]
-        exclude - the files or folders you want to exclude (as list)
-        regex   - regular expression ONLY for the files to be excluded (optional)
+    Whether the first bytes of a file look like a compressed format.
     """
+    return any(data.startswith(m) for m in COMPRESSED_MAGIC)
 
-    # If exclude is not a list (e.g. single string), convert it to list
-    if not isinstance(exclude, list):
-        exclude = [exclude]
 
-    # If regex is not a list (e.g. single string), convert it to list
-    if not isinstance(regex, list):
-        regex = [regex]
+def choose_method(path):
+    """
+    ZIP_STORED for the files that are already compressed (by extension
+    or by their first bytes), ZIP_DEFLATED for the rest.
+    """
+
+    if path.lower().endswith(COMPRESSED_EXT):
+        return zipfile.ZIP_STORED
+
+    with open(path, 'rb') as f:
+        if is_compressed(f.read(16)):
+            return zipfile.ZIP_STORED
+
+    return zipfile.ZIP_DEFLATED
+
+
+def arc_name(path):
+    """
+    The name of the file in the archive (relative, '/' separated, as
+    zipfile.write() names it), and the flags it needs.
+
+    Returns: (name as bytes, flags)
+    """
+
+    name = os.path.normpath(os.path.splitdrive(path)[1])
+    name = name.replace(os.sep, '/').lstrip('/')
+
+    if not isinstance(name, bytes):
+        name = name.encode('utf-8', 'surrogateescape')
+
+    try:
+        name.decode('ascii')
+        flags = 0
+    except UnicodeDecodeError:
+        # Bit 11: the name is UTF-8
+        flags = 0x800
+
+    return name, flags
+
+
+def dos_time(mtime):
+    """
+    Convert a timestamp to the (time, date) fields of a zip header.
+    """
+
+    t = time.localtime(mtime)
+    year = min(max(t.tm_year, 1980), 2107)
+
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def local_header(m):
+    """
+    The local file header of a member. With ZIP64, the sizes go in an
+    extra field.
+    """
+
+    extra = b''
+    size, comp_size = m.size, m.comp_size
+
+    if m.zip64:
+        extra = struct.pack('<HHQQ', 1, 16, size, comp_size)
+        size = comp_size = 0xFFFFFFFF
+
+    return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if m.zip64 else 20,
+                       m.flags, m.method, m.dostime, m.dosdate, m.crc,
+                       comp_size, size, len(m.name), len(extra)) \
+        + m.name + extra
+
+
+def central_header(m):
+    """
+    The central directory entry of a member. The fields that do not
+    fit in 32 bits go in a ZIP64 extra field.
+    """
+
+    size, comp_size, offset = m.size, m.comp_size, m.offset
+    values = []
+
+    if size > ZIP64_LIMIT:
+        values.append(size)
+        size = 0xFFFFFFFF
+
+    if comp_size > ZIP64_LIMIT:
+        values.append(comp_size)
+        comp_size = 0xFFFFFFFF
+
+    if offset > ZIP64_LIMIT:
+        values.append(offset)
+        offset = 0xFFFFFFFF
+
+    extra = b''
+    if values:
+        extra = struct.pack('<HH' + 'Q' * len(values),
+                            1, 8 * len(values), *values)
+
+    version = 45 if values or m.zip64 else 20
+
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                       (3 << 8) | version, version, m.flags, m.method,
+                       m.dostime, m.dosdate, m.crc, comp_size, size,
+                       len(m.name), len(extra), 0, 0, 0,
+                       (m.mode & 0xFFFF) << 16, offset) + m.name + extra
+
+
+def deflate_member(path, level, tmpdir):
+    """
+    Compress a file with raw deflate (run in the worker processes).
+    Small files are compressed in memory, larger ones into a temporary
+    file in 'tmpdir'.
+
+    Returns: None if the file should be STORED instead (it looks
+             compressed, or deflate did not make it smaller), else
+             (crc, size, comp_size, data, temporary file, secs), where
+             only one of 'data' and 'temporary file' is set
+    """
+
+    start = time.time()
+
+    with open(path, 'rb') as f:
+        block = f.read(BLOCK_SIZE)
+
+        if is_compressed(block):
+            return None
+
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+
+        if len(block) < BLOCK_SIZE:
+            data = comp.compress(block) + comp.flush()
+
+            if len(data) >= len(block):
+                return None
+
+            return (zlib.crc32(block) & 0xFFFFFFFF, len(block), len(data),
+                    data, None, time.time() - start)
+
+        fd, tmp = tempfile.mkstemp(dir=tmpdir)
+
+        with os.fdopen(fd, 'wb') as out:
+            while block:
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                out.write(comp.compress(block))
+                block = f.read(BLOCK_SIZE)
+
+            out.write(comp.flush())
+            comp_size = out.tell()
+
+    if comp_size >= size:
+        os.remove(tmp)
+        return None
+
+    return (crc & 0xFFFFFFFF, size, comp_size, None, tmp, time.time() - start)
+
+
+def _deflate_task(args):
+    return deflate_member(*args)
+
+
+class ZipWriter(object):
+    """
+    Writes a ZIP64 archive to a file object.
+
+    If the file object is not seekable (e.g. stdout, a pipe or a socket)
+    the archive is streamed: the members whose size and CRC are not
+    known before they are written get a data descriptor after their
+    data, instead of having their local header rewritten. Only the
+    members that fit in one block are then compressed by the pool (in
+    memory), and larger ones are compressed while being written, so
+    the memory used does not depend on the size of the members, and
+    nothing is kept on disk.
+
+    write() adds a single file, like zipfile.ZipFile.write() does, and
+    write_all() adds many files, deflating them in a pool of 'workers'
+    processes. The members are written in the given order, while the
+    next ones are compressed. The stats of every member are kept in
+    'stats', as 'member_stat' namedtuples.
+    """
+
+    def __init__(self, fileobj, workers=1, level=6, tmpdir=None):
+        self.fp = fileobj
+        self.workers = max(1, workers)
+        self.level = level
+        self.tmpdir = tmpdir
+        self.members = []
+        self.stats = []
+
+        try:
+            self._pos = fileobj.tell()
+            fileobj.seek(self._pos)
+            self.streaming = False
+        except (AttributeError, IOError, OSError):
+            self._pos = 0
+            self.streaming = True
+
+        # Do not add the archive to itself (if it is in the zipped folder)
+        try:
+            st = os.fstat(fileobj.fileno())
+            self._self_id = (st.st_dev, st.st_ino)
+        except (AttributeError, OSError, ValueError):
+            self._self_id = None
+
+    def _write(self, data):
+        self.fp.write(data)
+        self._pos += len(data)
+
+    def _is_self(self, st):
+        return self._self_id == (st.st_dev, st.st_ino)
+
+    def _begin(self, path, st, method, crc=0, size=None, comp_size=0):
+        """
+        Write the local header of a member. When the size is not known
+        yet, it is guessed from the file's size, and the header is
+        rewritten by _end() with the real values (or followed by a data
+        descriptor, when streaming).
+        """
+
+        name, flags = arc_name(path)
+        dostime, dosdate = dos_time(st.st_mtime)
+
+        if size is None:
+            zip64 = st.st_size * 1.05 > ZIP64_LIMIT
+            size = 0
+
+            if self.streaming:
+                # Bit 3: the CRC and the sizes are in the data descriptor
+                flags |= 0x08
+        else:
+            zip64 = size > ZIP64_LIMIT or comp_size > ZIP64_LIMIT
+
+        m = zip_member(name, flags, method, dostime, dosdate, crc, size,
+                       comp_size, self._pos, st.st_mode, zip64)
+        self._write(local_header(m))
+
+        return m
+
+    def _end(self, m, crc, size, comp_size):
+        """
+        Rewrite the local header of a member with its final values, or
+        write its data descriptor when streaming.
+        """
+
+        if not m.zip64 and max(size, comp_size) > ZIP64_LIMIT:
+            raise RuntimeError("'{0}' grew over the ZIP64 limit while "
+                               "being zipped".format(m.name))
+
+        m = m._replace(crc=crc, size=size, comp_size=comp_size)
+
+        if self.streaming:
+            # With ZIP64 (extra field in the local header), the
+            # descriptor's sizes are 8 bytes long
+            self._write(struct.pack('<IIQQ' if m.zip64 else '<IIII',
+                                    0x08074b50, crc, comp_size, size))
+        else:
+            self.fp.seek(m.offset)
+            self.fp.write(local_header(m))
+            self.fp.seek(self._pos)
+
+        return m
+
+    def _copy(self, path, st, method):
+        """
+        Add a file, compressing it here (if 'method' is ZIP_DEFLATED).
+        """
+
+        start = time.time()
+        m = self._begin(path, st, method, size=None)
+
+        comp = None
+        if method == zipfile.ZIP_DEFLATED:
+            comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+
+        crc = 0
+        size = 0
+        data_start = self._pos
+
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                self._write(comp.compress(block) if comp else block)
+
+        if comp:
+            self._write(comp.flush())
+
+        m = self._end(m, crc & 0xFFFFFFFF, size, self._pos - data_start)
+        self._add(m, time.time() - start)
+
+    def _add_deflated(self, path, st, result):
+        """
+        Add a file that a worker already compressed.
+        """
+
+        crc, size, comp_size, data, tmp, secs = result
+        m = self._begin(path, st, zipfile.ZIP_DEFLATED, crc, size, comp_size)
+
+        if tmp is None:
+            self._write(data)
+        else:
+            with open(tmp, 'rb') as f:
+                shutil.copyfileobj(f, self.fp, BLOCK_SIZE)
+            self._pos += comp_size
+            os.remove(tmp)
+
+        self._add(m, secs)
+
+    def _add(self, m, secs):
+        self.members.append(m)
+        self.stats.append(member_stat(m.name.decode('utf-8', 'replace'),
+                                      m.method, m.size, m.comp_size, secs))
+
+    def write(self, path):
+        """
+        Add a single file (compressed in this process).
+        """
+
+        st = os.stat(path)
+        if self._is_self(st):
+            return
+
+        self._copy(path, st, choose_method(path))
+
+    def write_all(self, paths):
+        """
+        Add many files, deflating them in the pool of processes. Files
+        that are already compressed are copied as they are.
+        """
+
+        pool = None
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers)
+
+        # The temporary files of the members, removed in any case
+        tmpdir = tempfile.mkdtemp(prefix='zipper_', dir=self.tmpdir)
+        pending = deque()
+
+        try:
+            for path in paths:
+                st = os.stat(path)
+                if self._is_self(st):
+                    continue
+
+                method = zipfile.ZIP_STORED
+                result = None
+
+                if self.streaming and st.st_size >= BLOCK_SIZE:
+                    # Compressed while written, not spooled to disk
+                    method = choose_method(path)
+
+                elif not path.lower().endswith(COMPRESSED_EXT):
+                    task = (path, self.level, tmpdir)
+
+                    if pool is None:
+                        result = [deflate_member(*task)]
+                    else:
+                        result = pool.apply_async(_deflate_task, (task,))
+
+                pending.append((path, st, method, result))
+
+                # Write the oldest member, once enough are queued
+                if len(pending) >= self.workers * WINDOW:
+                    self._finish(*pending.popleft())
+
+            while pending:
+                self._finish(*pending.popleft())
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _finish(self, path, st, method, result):
+        if isinstance(result, list):
+            out = result[0]
+        elif result is not None:
+            out = result.get()
+        else:
+            out = None
+
+        if out is None:
+            self._copy(path, st, method)
+        else:
+            self._add_deflated(path, st, out)
+
+    def close(self):
+        """
+        Write the central directory (and the ZIP64 end records, when
+        needed) at the end of the archive.
+        """
+
+        cd_start = self._pos
+        for m in self.members:
+            self._write(central_header(m))
 
-    reg_patterns = []
-    for r in regex:
-        reg_patterns.append(re.compile(r))
+        cd_size = self._pos - cd_start
+        count = len(self.members)
+
+        if count >= 0xFFFF or cd_start > ZIP64_LIMIT \
+                or cd_size > ZIP64_LIMIT:
+            eocd64 = self._pos
+
+            # ZIP64 end of central directory record and its locator
+            self._write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44,
+                                    (3 << 8) | 45, 45, 0, 0, count, count,
+                                    cd_size, cd_start))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, eocd64, 1))
+
+            count = min(count, 0xFFFF)
+            cd_size = min(cd_size, 0xFFFFFFFF)
+            cd_start = min(cd_start, 0xFFFFFFFF)
+
+        self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                                cd_size, cd_start, 0))
+        self.fp.flush()
+
+
+def format_bytes(num_bytes):
+    """
+    Format the given number of bytes in a human readable way (e.g. 3.2G).
+    """
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if abs(num_bytes) < 1024 or unit == 'T':
+            return '{0:.1f}{1}'.format(num_bytes, unit)
+
+        num_bytes /= 1024
+
+
+def print_report(stats, secs, report=None):
+    """
+    Print the totals of the archive, and write the size, compressed
+    size, time and throughput of every member in the (tab separated)
+    'report' file ('-' for stderr), if given.
+    """
+
+    if report:
+        out = sys.stderr if report == '-' else open(report, 'w')
+
+        out.write('member\tmethod\tbytes\tcompressed\tsecs\tMB/s\n')
+        for s in stats:
+            out.write('{0}\t{1}\t{2}\t{3}\t{4:.3f}\t{5:.1f}\n'.format(
+                      s.name,
+                      'deflate' if s.method == zipfile.ZIP_DEFLATED
+                      else 'store',
+                      s.size, s.comp_size, s.secs,
+                      s.size / max(s.secs, 1e-6) / 1e6))
+
+        if out is not sys.stderr:
+            out.close()
+
+    size = sum(s.size for s in stats)
+    comp_size = sum(s.comp_size for s in stats)
+    stored = sum(1 for s in stats if s.method == zipfile.ZIP_STORED)
+
+    print('{0} member(s) ({1} stored): {2} -> {3} in {4:.1f}s ({5}/s)'
+          .format(len(stats), stored, format_bytes(size),
+                  format_bytes(comp_size), secs,
+                  format_bytes(size / max(secs, 1e-3))),
+          file=sys.stderr)
+
+
+def open_output(output=None, fd=None):
+    """
+    Open the output of the archive: a file, stdout ('-') or an already
+    open file descriptor (e.g. a pipe to a transfer tool).
+    """
+
+    if fd is not None:
+        return os.fdopen(fd, 'wb')
+
+    if output == '-':
+        return getattr(sys.stdout, 'buffer', sys.stdout)
+
+    return open(output, 'wb')
+
+
+def verify_archive(archive):
+    """
+    Read back every member of an archive with zipfile (which checks
+    their CRC). The archive may be a file or '-' for stdin; zipfile
+    needs to seek, so stdin is first copied in a temporary file.
+
+    Returns: (the number of members, the names of the bad members)
+    """
+
+    if archive == '-':
+        src = getattr(sys.stdin, 'buffer', sys.stdin)
+        archive = tempfile.TemporaryFile()
+        shutil.copyfileobj(src, archive, BLOCK_SIZE)
+        archive.seek(0)
+
+    bad = []
+
+    with zipfile.ZipFile(archive) as z:
+        members = z.infolist()
+
+        for info in members:
+            try:
+                with z.open(info) as f:
+                    while f.read(BLOCK_SIZE):
+                        pass
+            except (zipfile.BadZipfile, zlib.error, IOError):
+                bad.append(info.filename)
+
+    return len(members), bad
+
+
+def compile_matcher(exclude=[], regex=[]):
+    """
+    Compile all the exclusion rules, once, into a 'matcher':
+        dirs  - matches the names of the folders to skip (the exclude
+                patterns), so that they are not walked at all
+        files - matches the names of the files to skip (the exclude
+                patterns, the regex patterns and this script)
+
+    Either one is None when there is nothing to match.
+    """
+
+    # Unix wildcards, as regular expressions
+    wildcards = [fnmatch.translate(pat) for pat in exclude]
+
+    # The regex patterns match at the beginning of the name (re.match)
+    regexes = ['(?:{0})'.format(r) for r in regex]
+
+    # This script (not its compiled version)
+    script = re.sub(r'\.py[co]$', '.py', os.path.basename(__file__))
+
+    files = wildcards + regexes + [re.escape(script) + r'\Z']
+
+    return matcher(re.compile('|'.join(wildcards)) if wildcards else None,
+                   re.compile('|'.join(files)))
+
+
+def list_dir(root):
+    """
+    Yield (name, path, is folder, is link) for every entry of a folder,
+    with os.scandir() when available (or its backport), or with
+    os.listdir() and a stat() per entry otherwise.
+    """
+
+    if scandir is not None:
+        for e in scandir(root):
+            is_dir = e.is_dir()
+            yield e.name, e.path, is_dir, is_dir and e.is_symlink()
+        return
+
+    for name in os.listdir(root):
+        entry_path = os.path.join(root, name)
+        is_dir = os.path.isdir(entry_path)
+        yield name, entry_path, is_dir, is_dir and os.path.islink(entry_path)
+
+
+def walk_files(path, match):
+    """
+    Yield the paths of the files under 'path' that the 'matcher' does
+    not exclude. The excluded folders are pruned before being listed,
+    and the type of every entry comes from the directory listing, so no
+    file is stat()ed. Symbolic links to folders are not followed (as
+    with os.walk()).
+    """
+
+    stack = [path]
+
+    while stack:
+        root = stack.pop()
+        subdirs = []
+
+        for name, entry_path, is_dir, is_link in list_dir(root):
+            if is_dir:
+                if not is_link and (match.dirs is None
+                                    or not match.dirs.match(name)):
+                    subdirs.append(entry_path)
+            elif not match.files.match(name):
+                yield entry_path
+
+        # Walk the folders in the order they were listed
+        stack.extend(reversed(subdirs))
+
+
+def walk_files_original(path, exclude=[], regex=[]):
+    """
+    The walk of the original zipdir(), unchanged: every pattern runs
+    over every folder, removing the matches one by one, and the files
+    that match the regexes are the ones kept (each regex matched twice
+    per file), renamed to the matched part. Kept to time walk_files()
+    against it in the benchmark; it does not find the same files.
+    """
+
+    reg_patterns = [re.compile(r) for r in regex]
 
     for root, dirs, files in os.walk(path):
         dirs[:] = [dir for dir in dirs if not dir in exclude]
 
         try:
-            # Remove/exclude the current script from the file list
             files.remove(os.path.basename(__file__))
         except ValueError:
-            # If not there
             pass
 
-        # Remove the files that match the files/patterns in the exclude list
         for pat in exclude:
             for f in fnmatch.filter(files, pat):
                 files.remove(f)
 
-        # Remove the files that match the Regex patterns
         for p in reg_patterns:
             files[:] = [p.match(f).group() for f in files if p.match(f)]
 
-        # Zip the remaining files
         for f in files:
-            ziph.write(os.path.join(root, f))
+            yield os.path.join(root, f)
+
+
+def walk_files_legacy(path, exclude=[], regex=[]):
+    """
+    A reimplementation of the original walk (see walk_files_original())
+    with the regex behaviour of walk_files(): the files that match a
+    regex are dropped (once matched), not kept. It finds the same files
+    as walk_files(), so the benchmark checks one against the other.
+    """
+
+    reg_patterns = [re.compile(r) for r in regex]
+
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [dir for dir in dirs if not dir in exclude]
+
+        try:
+            files.remove(os.path.basename(__file__))
+        except ValueError:
+            pass
+
+        for pat in exclude:
+            for f in fnmatch.filter(files, pat):
+                files.remove(f)
+
+        for p in reg_patterns:
+            files[:] = [f for f in files if not p.match(f)]
+
+        for f in files:
+            yield os.path.join(root, f)
+
+
+def benchmark_walk(n_files, tmpdir=None):
+    """
+    Build a synthetic cellranger-like tree of 'n_files' empty files (in
+    folders of 1000, half of them matching the exclusion rules, and a
+    'journal' folder to skip in every stage), walk it with the original
+    walk, its reimplementation and walk_files(), check that the last two
+    find the same files and print the time each took.
+    """
+
+    exclude = ['*.lock', 'journal']
+    regex = [r'.*_args$']
+    top = tempfile.mkdtemp(prefix='zipper_bench_', dir=tmpdir)
+
+    try:
+        print('Creating {0} files in {1}...'.format(n_files, top))
+
+        for i in range(0, n_files, 1000):
+            stage = os.path.join(top, 'SC_RNA_COUNTER_CS',
+                                 'STAGE_{0}'.format(i // 50000))
+            chunk = os.path.join(stage, 'fork0', 'chnk{0}'.format(i % 50000))
+            os.makedirs(chunk)
+
+            if i % 50000 == 0:
+                os.makedirs(os.path.join(stage, 'journal'))
+
+            for j in range(min(1000, n_files - i)):
+                # 1/4 wildcard matches, 1/4 regex matches, 1/2 kept
+                name = ('{0}.lock', 'f{0}_args', 'f{0}.json',
+                        'f{0}.json')[j % 4].format(j)
+                open(os.path.join(chunk, name), 'w').close()
+
+        start = time.time()
+        original = sum(1 for _ in walk_files_original(top, exclude, regex))
+        original_secs = time.time() - start
+
+        start = time.time()
+        legacy = set(walk_files_legacy(top, exclude, regex))
+        legacy_secs = time.time() - start
+
+        start = time.time()
+        walked = set(walk_files(top, compile_matcher(exclude, regex)))
+        walk_secs = time.time() - start
+
+    finally:
+        shutil.rmtree(top, ignore_errors=True)
+
+    if walked != legacy:
+        print('The two walkers found different files!')
+        return 1
+
+    print('{0} files, {1} kept by both walkers ({2} by the original, '
+          'which keeps the regex matches)'.format(n_files, len(walked),
+                                                  original))
+    print('  {0:<24}{1:.2f}s'.format('original zipdir() walk:',
+                                     original_secs))
+    print('  {0:<24}{1:.2f}s'.format('os.walk + remove():', legacy_secs))
+    print('  {0:<24}{1:.2f}s ({2:.1f}x the original)'.format(
+            '{0} + matcher:'.format('scandir' if scandir is not None
+                                    else 'listdir'),
+            walk_secs, original_secs / max(walk_secs, 1e-9)))
+
+    return 0
+
+
+def zipdir(path, ziph, exclude=[], regex=[]):
+    """
+    Inputs:
+        path    - the path of the directory you want to zip
+        ziph    - a zip handler [ZipWriter() or zipfile.ZipFile() object]
+        exclude - the files or folders you want to exclude (as list)
+        regex   - regular expression ONLY for the files to be excluded (optional)
+    """
+
+    # If exclude is not a list (e.g. single string), convert it to list
+    if not isinstance(exclude, list):
+        exclude = [exclude] if exclude else []
+
+    # If regex is not a list (e.g. single string), convert it to list
+    if not isinstance(regex, list):
+        regex = [regex] if regex else []
+
+    paths = walk_files(path, compile_matcher(exclude, regex))
+
+    # Zip the remaining files (in parallel, with a ZipWriter)
+    if isinstance(ziph, ZipWriter):
+        ziph.write_all(paths)
+    else:
+        for p in paths:
+            ziph.write(p)
 
 
 if __name__ == "__main__":
@@ -86,18 +848,74 @@ if __name__ == "__main__":
             help='A list of the files and/or Unix wildcard patterns \
             to exclude the matching files.')
 
+    output = parser.add_mutually_exclusive_group(required=True)
+
+    output.add_argument(
+            '-o', '--output',
+            help="The name of the output zipped file to be created, \
+            or '-' to stream it to stdout.")
+
+    output.add_argument(
+            '--fd', type=int,
+            help='Stream the zipped file to this (open) file descriptor.')
+
+    output.add_argument(
+            '--verify', metavar='ZIPFILE',
+            help="Check that zipfile can read back every member of the \
+            given zipped file (or stream, '-' for stdin) and exit.")
+
+    output.add_argument(
+            '--benchmark-walk', type=int, metavar='N_FILES',
+            help='Compare the folder walk with the original one, on a \
+            synthetic tree of N_FILES files (created in --tmpdir), and exit.')
+
     parser.add_argument(
-            '-o', '--output', required=True,
-            help='The name of the output zipped file to be created.')
+            '-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+            help='Number of processes compressing the files \
+            (default: %(default)s).')
+
+    parser.add_argument(
+            '-l', '--level', type=int, default=6, choices=range(1, 10),
+            metavar='{1..9}',
+            help='The deflate compression level (default: %(default)s).')
+
+    parser.add_argument(
+            '--tmpdir',
+            help='Where to keep the large compressed members until they \
+            are written (default: the system temporary folder).')
+
+    parser.add_argument(
+            '--report',
+            help="Write the size, time and throughput of every member \
+            in this (tab separated) file, or '-' for stderr.")
 
     # Parse the given arguments
     args = parser.parse_args()
 
-    # Create a zip file object
-    zipf = zipfile.ZipFile(args.output, 'w', zipfile.ZIP_DEFLATED)
+    if args.benchmark_walk:
+        sys.exit(benchmark_walk(args.benchmark_walk, args.tmpdir))
+
+    if args.verify:
+        n_members, bad = verify_archive(args.verify)
+
+        for name in bad:
+            print('BAD: {0}'.format(name), file=sys.stderr)
+
+        print('{0} member(s), {1} bad'.format(n_members, len(bad)),
+              file=sys.stderr)
+
+        sys.exit(1 if bad else 0)
+
+    start = time.time()
+
+    # Create the archive (streamed, if the output cannot seek)
+    with open_output(args.output, args.fd) as out:
+        zipf = ZipWriter(out, args.jobs, args.level, args.tmpdir)
+
+        # Call the zipdir() function to organize and write the zip file
+        zipdir('.', zipf, args.exclude or [], args.regex or [])
 
-    # Call the zipdir() function to organize and write the zip file
-    zipdir('.', zipf, args.exclude, args.regex)
+        # Write the central directory
+        zipf.close()
 
-    # Close the zip object
-    zipf.close()
+    print_report(zipf.stats, time.time() - start, args.report)